@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+Admission control for the web workers.
+
+`AdmissionController` bounds the number of requests each worker processes concurrently. Requests beyond
+that wait in a bounded queue, for at most `queue_timeout` seconds. When the queue is full, or the wait
+times out, the request is shed, so that the caller can fail fast with a 503 instead of piling up behind
+slow backend calls.
+
+`RateLimiter` keeps a token bucket per client key, e.g. a known `Access-Token` or `API-KEY` header, or the client IP.
+
+Both are per web worker process.
+"""
+
+import tornado.gen
+from tornado.concurrent import Future
+from collections import deque, OrderedDict
+from datetime import timedelta
+from time import time
+
+
+class AdmissionController(object):
+
+    def __init__(self,
+                 max_inflight = 8,
+                 max_queue = 32,
+                 queue_timeout = 1.0,
+                 ):
+        """
+        Args:
+            max_inflight:  Maximum requests processed concurrently.
+            max_queue:     Maximum requests waiting for a slot. Further requests are shed immediately.
+            queue_timeout: Maximum seconds to wait for a slot.
+        """
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.waiters = deque()
+        self.num_shed = 0
+
+    @tornado.gen.coroutine
+    def acquire(self):
+        """
+        Wait for a processing slot. Returns True once the slot is held, or False if the request was shed.
+        Every True must be followed by exactly one `release()`.
+        """
+
+        if self.inflight < self.max_inflight:
+            self.inflight += 1
+            raise tornado.gen.Return(True)
+
+        if len(self.waiters) >= self.max_queue:
+            self.num_shed += 1
+            raise tornado.gen.Return(False)
+
+        fut = Future()
+        self.waiters.append(fut)
+
+        try:
+            yield tornado.gen.with_timeout(timedelta(seconds = self.queue_timeout), fut)
+        except tornado.gen.TimeoutError:
+            if fut.done():
+                ## Slot was handed over just as the wait timed out:
+                raise tornado.gen.Return(True)
+            self.waiters.remove(fut)
+            self.num_shed += 1
+            raise tornado.gen.Return(False)
+
+        raise tornado.gen.Return(True)
+
+    def release(self):
+        """
+        Hand the slot to the oldest waiting request, or free it.
+        """
+
+        while self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(True)
+                return
+
+        self.inflight -= 1
+
+    def stats(self):
+        return {'inflight':self.inflight,
+                'queued':len(self.waiters),
+                'shed':self.num_shed,
+                }
+
+
+class RateLimiter(object):
+
+    def __init__(self,
+                 rate = 5.0,
+                 burst = 20,
+                 max_keys = 10000,
+                 ):
+        """
+        Args:
+            rate:     Sustained requests per second allowed per key.
+            burst:    Bucket size, i.e. requests allowed at once after being idle.
+            max_keys: Least-recently seen keys beyond this are forgotten.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()   # {key: (tokens, last_time)}
+
+    def allow(self, key):
+        """
+        Take a token from `key`'s bucket. Returns False if the bucket is empty.
+        """
+
+        tm = time()
+
+        tokens, last = self.buckets.pop(key, (self.burst, tm))
+
+        tokens = min(self.burst, tokens + (tm - last) * self.rate)
+
+        rr = tokens >= 1.0
+
+        if rr:
+            tokens -= 1.0
+
+        self.buckets[key] = (tokens, tm)
+
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last = False)
+
+        return rr
+
+    def retry_after(self, key):
+        """
+        Seconds until `key` has a token again.
+        """
+
+        tm = time()
+
+        tokens, last = self.buckets.get(key, (self.burst, tm))
+
+        tokens = min(self.burst, tokens + (tm - last) * self.rate)
+
+        return max(0.0, (1.0 - tokens) / self.rate)
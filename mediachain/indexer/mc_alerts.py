@@ -1,21 +1,92 @@
 #!/usr/bin/env python
 
+"""
+Slack alerts.
+
+Alerts are deduplicated by `alert_key`, with a bounded, expiring set of recently seen keys. Instead of
+one webhook POST per alert, alerts are queued per channel and sent as one digest message per channel
+every `digest_interval` seconds. If the webhook fails or is slow `breaker_threshold` times in a row,
+digests are dropped for `breaker_cooldown` seconds before trying again.
+"""
+
 import mc_config
 from tempfile import NamedTemporaryFile
 import json
 import urllib
+from collections import OrderedDict, deque
+from time import time
 
 import tornado
 import tornado.gen
+import tornado.ioloop
 from tornado.httpclient import AsyncHTTPClient
 
 
 class MCAlerts:
-    
+
     def __init__(self,
+                 digest_interval = mc_config.MC_ALERTS_DIGEST_INTERVAL_INT,
+                 dedupe_size = 10000,
+                 dedupe_ttl = 24 * 60 * 60,
+                 max_pending = 200,
+                 max_message_chars = 1000,
+                 max_digest_chars = 3500,
+                 webhook_timeout = 5,
+                 breaker_threshold = 3,
+                 breaker_cooldown = 300,
                  ):
-        self.done_alerts = set()
-    
+        """
+        Args:
+            digest_interval:   Seconds between digests.
+            dedupe_size:       Maximum number of remembered alert keys. Oldest are forgotten first.
+            dedupe_ttl:        Seconds after which an alert key may alert again.
+            max_pending:       Maximum queued alerts per channel. Further alerts are only counted.
+            max_message_chars: Alerts are truncated to this length in digests.
+            max_digest_chars:  Maximum digest length. Remaining alerts are only counted.
+            webhook_timeout:   Webhook requests taking longer count as failures.
+            breaker_threshold: Consecutive webhook failures after which digests are dropped.
+            breaker_cooldown:  Seconds to drop digests for, before trying the webhook again.
+        """
+        self.digest_interval = digest_interval
+        self.dedupe_size = dedupe_size
+        self.dedupe_ttl = dedupe_ttl
+        self.max_pending = max_pending
+        self.max_message_chars = max_message_chars
+        self.max_digest_chars = max_digest_chars
+        self.webhook_timeout = webhook_timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+
+        self.done_alerts = OrderedDict()   # {alert_key: time}
+        self.pending = OrderedDict()       # {(channel, user_name, slack_webhook_url): deque([message, ...])}
+        self.num_overflow = {}             # {(channel, user_name, slack_webhook_url): count}
+        self.flush_scheduled = False
+        self.num_failures = 0
+        self.breaker_open_until = 0
+        self.num_dropped_digests = 0
+
+    def is_duplicate(self,
+                     alert_key,
+                     ):
+        """
+        Check and remember `alert_key`. Only alerts that are let through restart its `dedupe_ttl`.
+        """
+
+        tm = time()
+
+        last = self.done_alerts.pop(alert_key, None)
+
+        is_dupe = (last is not None) and (tm - last < self.dedupe_ttl)
+
+        ## Re-inserted either way, to keep recently seen keys in the LRU:
+
+        self.done_alerts[alert_key] = last if is_dupe else tm
+
+        if len(self.done_alerts) > self.dedupe_size:
+            self.done_alerts.popitem(last = False)
+
+        return is_dupe
+
     @tornado.gen.coroutine
     def send_alert_tornado(self,
                            message = False,
@@ -28,47 +99,141 @@ class MCAlerts:
                            slack_webhook_url = mc_config.MC_SLACK_WEBHOOK,
                            verbose = False,
                            ):
+        """
+        Queue an alert for the next digest. Returns immediately.
+        """
 
         if verbose:
             print ('PREPARING_ALERT', slack_webhook_url, '->', channel)
 
         alert_key = json.dumps(alert_key, sort_keys=True)
 
-        if only_first and (alert_key in self.done_alerts):
+        if only_first and self.is_duplicate(alert_key):
             return
-        self.done_alerts.add(alert_key)
-
 
         if not channel:
             channel = '#labs-tech-alerts'
 
         if (not channel.startswith('#')) and (not channel.startswith('@')):
             channel = '#' + channel
-        
+
         #assert channel.startswith('#')
-        
-        hh = {"text": message,
+
+        kk = (channel, user_name, slack_webhook_url)
+
+        if kk not in self.pending:
+            self.pending[kk] = deque()
+
+        if len(self.pending[kk]) >= self.max_pending:
+            self.num_overflow[kk] = self.num_overflow.get(kk, 0) + 1
+        else:
+            self.pending[kk].append(message)
+
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            tornado.ioloop.IOLoop.current().call_later(self.digest_interval, self.flush)
+
+    def make_digest(self,
+                    messages,
+                    num_overflow = 0,
+                    ):
+        """
+        Combine queued alerts into one message, within `max_digest_chars`.
+        """
+
+        parts = []
+        size = 0
+        num_left = len(messages) + num_overflow
+
+        for msg in messages:
+            msg = unicode(msg)
+
+            if len(msg) > self.max_message_chars:
+                msg = msg[:self.max_message_chars] + u'...'
+
+            if parts and (size + len(msg) > self.max_digest_chars):
+                break
+
+            parts.append(msg)
+            size += len(msg) + 2
+            num_left -= 1
+
+        if num_left:
+            parts.append(u'...and %d more.' % num_left)
+
+        if len(messages) + num_overflow > 1:
+            parts.insert(0, u'%d alerts:' % (len(messages) + num_overflow))
+
+        return u'\n\n'.join(parts)
+
+    @tornado.gen.coroutine
+    def flush(self):
+        """
+        Send one digest per channel, of all alerts queued since the last flush.
+        """
+
+        self.flush_scheduled = False
+
+        pending, self.pending = self.pending, OrderedDict()
+        num_overflow, self.num_overflow = self.num_overflow, {}
+
+        for kk, messages in pending.iteritems():
+
+            channel, user_name, slack_webhook_url = kk
+
+            text = self.make_digest(messages, num_overflow.get(kk, 0))
+
+            yield self.post_webhook(text,
+                                    user_name = user_name,
+                                    channel = channel,
+                                    slack_webhook_url = slack_webhook_url,
+                                    )
+
+    @tornado.gen.coroutine
+    def post_webhook(self,
+                     text,
+                     user_name,
+                     channel,
+                     slack_webhook_url,
+                     ):
+        """
+        POST one message to the webhook, unless the circuit breaker is open.
+        """
+
+        if time() < self.breaker_open_until:
+            self.num_dropped_digests += 1
+            print ('ALERT_DROPPED_BREAKER_OPEN', channel, 'dropped_digests:', self.num_dropped_digests)
+            return
+
+        hh = {"text": text,
               "username": user_name,
               "channel": channel,
               "icon_emoji": ":ghost:",
               }
 
-        repr_hh = repr(hh)
-        
-        
         body = urllib.urlencode({'payload': json.dumps(hh)}).encode('utf8')
 
-        print ('SENDING_ALERT', body)
-        
-        response = yield AsyncHTTPClient().fetch(slack_webhook_url,
-                                                 method = 'POST',
-                                                 connect_timeout = 10,
-                                                 request_timeout = 10,
-                                                 body = body,
-                                                 allow_nonstandard_methods = True,
-                                                 )
-        
+        print ('SENDING_ALERT', channel, len(body))
+
+        try:
+            response = yield AsyncHTTPClient().fetch(slack_webhook_url,
+                                                     method = 'POST',
+                                                     connect_timeout = self.webhook_timeout,
+                                                     request_timeout = self.webhook_timeout,
+                                                     body = body,
+                                                     allow_nonstandard_methods = True,
+                                                     )
+        except Exception as e:
+            self.num_failures += 1
+
+            if self.num_failures >= self.breaker_threshold:
+                self.breaker_open_until = time() + self.breaker_cooldown
+
+            print ('ALERT_FAILED', channel, e, 'consecutive_failures:', self.num_failures)
+            return
+
+        self.num_failures = 0
+
         d2 = response.body
-        
+
         print ('ALERT_SENT', d2)
-            
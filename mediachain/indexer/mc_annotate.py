@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+
+"""
+Relevance annotation storage and stats.
+
+`AnnotationLog` stores `handle_record_relevance` submissions in segmented, append-only log files, one
+JSON record per line. Each web process appends to its own segment, so writers never contend, and
+fsyncs are grouped: concurrent submissions are acknowledged together after a single fsync. Nonces are
+deduplicated across processes with an LMDB index. Readers iterate over all segments, optionally
+resuming from per-segment offsets.
+
+`AnnotationStats` keeps a running summary of all submissions, and only reads records appended since it
+last looked. The summary is persisted, along with its per-segment offsets, so restarts only tail new
+records.
+"""
+
+import mc_config
+import ujson
+import tornado.ioloop
+from tornado.concurrent import Future
+from os import listdir, rename, makedirs, getpid, fsync
+from os.path import join, exists, dirname, getsize
+from threading import Lock
+from time import time
+
+
+## Known annotator IPs:
+
+annotation_user_names = {"172.56.34.204": 'dennis',
+                         "67.244.113.119": 'jesse',
+                         "95.111.63.140": 'tg',
+                         "75.98.195.186": 'dennis2',
+                         }
+
+## Legacy one-file-per-submission directory, see `annotation_log_import`:
+
+annotate_dir = join(mc_config.MC_ANNOTATE_DIR, 'search_relevance')
+
+annotate_log_dir = join(mc_config.MC_ANNOTATE_DIR, 'search_relevance_log')
+
+annotate_stats_fn = join(mc_config.MC_ANNOTATE_DIR, 'search_relevance_stats.json')
+
+
+class AnnotationLog(object):
+
+    def __init__(self,
+                 log_dir = annotate_log_dir,
+                 segment_max_bytes = 64 * 1024 * 1024,
+                 commit_interval = 0.05,
+                 nonce_index = 'lmdb',
+                 ):
+        """
+        Args:
+            log_dir:           Directory of log segments, and of the nonce index.
+            segment_max_bytes: Start a new segment once the current one reaches this size.
+            commit_interval:   Seconds to wait for more appends before an fsync.
+            nonce_index:       'lmdb' - nonces shared by all processes, in `log_dir/nonces.lmdb`.
+                               'memory' - per-process set of nonces, loaded from the segments on first use.
+
+        Segments and the nonce index are opened on first use, so that they are opened after web workers are forked.
+        """
+        self.log_dir = log_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.commit_interval = commit_interval
+        self.nonce_index = nonce_index
+        
+        self.segment_num = 0
+        self.segment_name = False
+        self.segment_f = False
+        self.nonces = False
+        
+        self.pending = []
+        self.commit_scheduled = False
+
+    def segment_names(self):
+        """
+        All segment names, oldest first.
+        """
+        if not exists(self.log_dir):
+            return []
+        return list(sorted([x for x in listdir(self.log_dir) if x.endswith('.log')]))
+
+    def open_segment(self):
+        if not exists(self.log_dir):
+            makedirs(self.log_dir)
+
+        if self.segment_f:
+            self.segment_f.close()
+        
+        self.segment_num += 1
+        
+        ## Sorts by process start time:
+        
+        if self.segment_num == 1:
+            self.segment_prefix = '%010d_%d' % (int(time()), getpid())
+        
+        self.segment_name = '%s_%06d.log' % (self.segment_prefix, self.segment_num)
+        self.segment_f = open(join(self.log_dir, self.segment_name), 'ab')
+
+    def open_nonces(self):
+        if self.nonce_index == 'lmdb':
+            import lmdb
+            if not exists(self.log_dir):
+                makedirs(self.log_dir)
+            self.nonces = lmdb.open(join(self.log_dir, 'nonces.lmdb'),
+                                    map_size = 4 * 1024 ** 3,
+                                    )
+        else:
+            self.nonces = set([nonce_key(rh['user_id'], rh['nonce']) for rh in self])
+
+    def add_nonce(self,
+                  key,
+                  ):
+        """
+        Claim nonce `key`, as returned by `nonce_key()`. Returns False if it was already claimed.
+        """
+        
+        if self.nonces is False:
+            self.open_nonces()
+
+        if self.nonce_index == 'lmdb':
+            with self.nonces.begin(write = True) as txn:
+                return txn.put(key, str(int(time())), overwrite = False)
+        
+        if key in self.nonces:
+            return False
+        self.nonces.add(key)
+        return True
+        
+    def remove_nonce(self,
+                     key,
+                     ):
+        """
+        Release nonce `key` claimed by `add_nonce()`, e.g. when its record couldn't be written, so it can be retried.
+        """
+        
+        if self.nonces is False:
+            self.open_nonces()
+
+        if self.nonce_index == 'lmdb':
+            with self.nonces.begin(write = True) as txn:
+                txn.delete(key)
+            return
+        
+        self.nonces.discard(key)
+        
+    def write(self,
+              rh,
+              ):
+        """
+        Append record `rh` to this process's current segment, without waiting for it to be fsynced.
+        Returns (segment_name, offset).
+        """
+        
+        if (self.segment_f is False) or (self.segment_f.tell() >= self.segment_max_bytes):
+            if self.segment_f is not False:
+                self.commit()
+            self.open_segment()
+        
+        offset = self.segment_f.tell()
+        
+        self.segment_f.write(ujson.dumps(rh) + '\n')
+        self.segment_f.flush()
+        
+        return self.segment_name, offset
+
+    def append(self,
+               rh,
+               ):
+        """
+        Append record `rh`. Returns a Future of (segment_name, offset), resolved once the record is fsynced.
+        """
+        
+        rr = self.write(rh)
+        
+        fut = Future()
+        self.pending.append((fut, rr))
+        
+        if not self.commit_scheduled:
+            self.commit_scheduled = True
+            tornado.ioloop.IOLoop.current().call_later(self.commit_interval, self.commit)
+        
+        return fut
+
+    def commit(self):
+        """
+        Fsync the current segment, and resolve the Futures of all appends waiting on it.
+        """
+        
+        self.commit_scheduled = False
+        
+        pending, self.pending = self.pending, []
+
+        try:
+            if self.segment_f is not False:
+                fsync(self.segment_f.fileno())
+        except Exception as e:
+            print ('ANNOTATION_LOG_FSYNC_FAILED', self.segment_name, e)
+            for fut, rr in pending:
+                fut.set_exception(e)
+            return
+        
+        for fut, rr in pending:
+            fut.set_result(rr)
+
+    def iter_records(self,
+                     positions = None,
+                     ):
+        """
+        Iterate over all records, oldest segment first.
+
+        Args:
+            positions: Optional {segment_name: offset}, to resume from. Updated in place with the offset after
+                       each yielded record. Incomplete trailing records are left for the next call.
+
+        Yields (segment_name, offset_after, record).
+        """
+
+        if positions is None:
+            positions = {}
+        
+        for name in self.segment_names():
+
+            pos = positions.get(name, 0)
+            
+            ## Segments of other processes are usually finished, so skip them without opening them:
+            
+            if pos and (getsize(join(self.log_dir, name)) <= pos):
+                continue
+            
+            with open(join(self.log_dir, name), 'rb') as f:
+                f.seek(pos)
+
+                for line in f:
+                    if not line.endswith('\n'):
+                        ## Partially written, pick it up next time:
+                        break
+
+                    pos += len(line)
+                    positions[name] = pos
+
+                    try:
+                        rh = ujson.loads(line)
+                    except Exception as e:
+                        print ('BAD', name, pos, e)
+                        continue
+                    
+                    yield name, pos, rh
+
+    def __iter__(self):
+        for name, pos, rh in self.iter_records():
+            yield rh
+
+
+def nonce_key(user_id,
+              nonce,
+              ):
+    return (user_id + '_' + nonce).encode('utf8')
+
+
+def annotation_log_import(dir_in = annotate_dir,
+                          log_dir = annotate_log_dir,
+                          via_cli = False,
+                          ):
+    """
+    Import legacy one-file-per-submission annotations from `dir_in` into the annotation log, oldest first.
+    Submissions whose nonce is already in the log are skipped, so this can be re-run.
+    """
+
+    store = AnnotationLog(log_dir)
+
+    fns = [x for x in listdir(dir_in) if x.endswith('.json') and not x.startswith('test_')] if exists(dir_in) else []
+
+    rr = []
+    for fn in fns:
+        try:
+            with open(join(dir_in, fn)) as f:
+                rr.append(ujson.loads(f.read()))
+        except Exception as e:
+            print ('BAD', fn, e)
+
+    rr.sort(key = lambda x:x.get('created', 0))
+    
+    nn = 0
+    for rh in rr:
+        if not store.add_nonce(nonce_key(rh['user_id'], rh['nonce'])):
+            continue
+        store.write(rh)
+        nn += 1
+
+    store.commit()
+    
+    print ('ANNOTATION_LOG_IMPORTED', dir_in, log_dir, 'imported:', nn, 'skipped:', len(rr) - nn)
+
+
+class AnnotationStats(object):
+
+    def __init__(self,
+                 store = False,
+                 stats_fn = annotate_stats_fn,
+                 save_interval = 60,
+                 ):
+        """
+        Args:
+            store:         `AnnotationLog` to read submissions from.
+            stats_fn:      Where the running summary is persisted.
+            save_interval: Minimum seconds between saves of the summary.
+        """
+        self.store = store or AnnotationLog()
+        self.stats_fn = stats_fn
+        self.save_interval = save_interval
+        self.last_save = 0
+        self.summary_cache = False
+        self.lock = Lock()
+
+        self.positions = {}      # {segment_name: offset}
+        self.users = {}          # {uname: {'num_tasks', 'num_images', 'num_queries', 'num_bad'}}
+        self.user_queries = {}   # {uname: set([query, ...])}
+        self.user_tasks = set()  # set([(uname, query), ...]), for which a task was counted
+        self.query_counts = {}   # {query: count}
+
+        if exists(stats_fn):
+            try:
+                with open(stats_fn) as f:
+                    hh = ujson.loads(f.read())
+                self.positions = hh['positions']
+                self.users = hh['users']
+                self.user_queries = {k:set(v) for k,v in hh['user_queries'].iteritems()}
+                self.user_tasks = set([tuple(x) for x in hh['user_tasks']])
+                self.query_counts = hh['query_counts']
+            except Exception as e:
+                print ('ANNOTATION_STATS_LOAD_FAILED', stats_fn, e)
+                self.positions = {}
+                self.users = {}
+                self.user_queries = {}
+                self.user_tasks = set()
+                self.query_counts = {}
+
+    def add(self, h):
+        """
+        Add one submission, as written by `handle_record_relevance`.
+        """
+
+        if h['user_id'] == 'test':
+            return
+        
+        self.summary_cache = False
+
+        the_query = h['data']['query_info']['query_args'].get('q')
+
+        self.query_counts[the_query] = self.query_counts.get(the_query, 0) + 1
+
+        uname = h['user_ip']
+
+        uname = annotation_user_names.get(uname, uname)
+
+        if uname not in self.users:
+            self.users[uname] = {'num_tasks':0,
+                                 'num_images':0,
+                                 'num_queries':0,
+                                 'num_bad':0,
+                                 }
+            self.user_queries[uname] = set()
+
+        uu = self.users[uname]
+
+        if not the_query:
+            uu['num_bad'] += 1
+            return
+
+        self.user_queries[uname].add(the_query)
+
+        for answers_set in h['data']['data']:
+
+            overall = [x for x in answers_set['ratings'] if x['_id'] == 'Overall']
+
+            if overall:
+                overall = overall[0]['rating']
+            else:
+                overall = -1
+
+            if overall < 1:
+                continue
+
+            uu['num_images'] += 1
+
+        if not uu['num_images']:
+            ## ignore tasks with 0 images rated.
+            return
+
+        uu['num_tasks'] += 1
+
+        if (uname, the_query) not in self.user_tasks:
+            uu['num_queries'] += 1
+            self.user_tasks.add((uname, the_query))
+
+    def catch_up(self):
+        """
+        Add all submissions written since the last call. Returns the number added.
+        Thread-safe, so it can be run off the IOLoop.
+        """
+
+        nn = 0
+
+        with self.lock:
+            for name, pos, h in self.store.iter_records(self.positions):
+                try:
+                    self.add(h)
+                    nn += 1
+                except Exception as e:
+                    print ('BAD', name, pos, e)
+
+            if nn and (time() - self.last_save > self.save_interval):
+                self.save()
+
+        return nn
+
+    def save(self):
+        """
+        Atomically persist the summary and segment offsets.
+        """
+
+        if not exists(dirname(self.stats_fn)):
+            makedirs(dirname(self.stats_fn))
+
+        fn_temp = self.stats_fn + '.%d.temp' % getpid()
+        
+        with open(fn_temp, 'w') as f:
+            f.write(ujson.dumps({'positions':self.positions,
+                                 'users':self.users,
+                                 'user_queries':{k:list(v) for k,v in self.user_queries.iteritems()},
+                                 'user_tasks':list(self.user_tasks),
+                                 'query_counts':self.query_counts,
+                                 }))
+
+        rename(fn_temp, self.stats_fn)
+
+        self.last_save = time()
+
+    def summary(self):
+        """
+        Stats in the `/stats_annotation` format. Cached until the next `add()`.
+        """
+
+        with self.lock:
+            if self.summary_cache is False:
+                rh = {'users':{}}
+                for uname, uu in self.users.iteritems():
+                    rh['users'][uname] = dict(uu)
+                    rh['users'][uname]['queries'] = list(sorted(self.user_queries.get(uname, [])))
+                self.summary_cache = rh
+
+            return self.summary_cache
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+File-backed Bloom filter.
+
+The bit array is a memory-mapped file, so all processes that open the same file share one copy in the
+page cache, and see each other's additions immediately. Lookups of many keys are vectorized.
+
+False positives occur at a rate set by `num_bits` per key and `num_hashes`, e.g. ~1% for 10 bits per
+key and 7 hashes. Additions are locked within a process, but not across processes, so concurrent
+additions from different processes can rarely lose a bit, i.e. cause a false negative.
+"""
+
+import numpy as np
+from hashlib import md5
+from threading import Lock
+from os import rename, access, W_OK
+from os.path import exists, getsize
+
+
+class BloomFilter(object):
+
+    def __init__(self,
+                 fn,
+                 num_bits = 2 ** 29,
+                 num_hashes = 7,
+                 create = True,
+                 ):
+        """
+        Args:
+            fn:         Bit array file. Created with `num_bits` bits if it doesn't exist, otherwise its size is used.
+            num_bits:   Size of new filters.
+            num_hashes: Bits set per key. Must be the same for all users of a file.
+            create:     Create `fn` if it doesn't exist. Otherwise, raises IOError.
+        """
+
+        if not exists(fn):
+            if not create:
+                raise IOError('No Bloom filter file: ' + fn)
+            with open(fn + '.temp', 'wb') as f:
+                f.truncate(num_bits // 8)
+            rename(fn + '.temp', fn)
+
+        self.fn = fn
+        self.num_hashes = num_hashes
+        self.num_bits = np.uint64(getsize(fn) * 8)
+        self.bits = np.memmap(fn,
+                              dtype = np.uint8,
+                              mode = access(fn, W_OK) and 'r+' or 'r',
+                              )
+        self.lock = Lock()
+
+    def positions(self, keys):
+        """
+        Bit positions of each of `keys`, as a (len(keys), num_hashes) array, by double hashing of the key's md5.
+        """
+        hh = np.frombuffer(''.join([md5(x).digest() for x in keys]), dtype = np.uint64).reshape(-1, 2)
+        ii = np.arange(self.num_hashes, dtype = np.uint64)
+        return (hh[:,:1] + ii * (hh[:,1:] | np.uint64(1))) % self.num_bits
+
+    def add_many(self, keys):
+        if not keys:
+            return
+        pp = self.positions(keys).ravel()
+        with self.lock:
+            np.bitwise_or.at(self.bits,
+                             (pp >> np.uint64(3)).astype(np.int64),
+                             (np.uint8(1) << (pp & np.uint64(7)).astype(np.uint8)),
+                             )
+
+    def add(self, key):
+        self.add_many([key])
+
+    def contains_many(self, keys):
+        """
+        Returns a bool array, True for each of `keys` that was probably added.
+        """
+        if not keys:
+            return np.zeros(0, dtype = bool)
+        pp = self.positions(keys)
+        vv = self.bits[(pp >> np.uint64(3)).astype(np.int64)] & (np.uint8(1) << (pp & np.uint64(7)).astype(np.uint8))
+        return (vv != 0).all(axis = 1)
+
+    def __contains__(self, key):
+        return bool(self.contains_many([key])[0])
+
+    def flush(self):
+        self.bits.flush()
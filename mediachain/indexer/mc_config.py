@@ -56,6 +56,10 @@ cfg = {'1. Model Settings. NOTE - WIP. These settings are not enabled yet.':
            {'MC_QUERY_CACHE_DIR':('/datasets/datasets/query_cache/', 'Location of where to store query cache.'),
             'MC_IMAGE_CACHE_DIR':('/datasets/datasets/indexer_cache/images/', 'Location of where to store cached images, for serving to frontend.'),
             'MC_IMAGE_CACHE_HOST':('http://cdn.mediachainlabs.com/images/', 'Image host, for serving cached images to frontend.'),
+            'MC_IMAGE_CACHE_BLOOM_PATH':('/datasets/datasets/indexer_cache/cached_images.bloom', 'Bloom filter of cached images. Build with `cached_image_filter_rebuild`, then maintained by `cache_image()`.'),
+            'MC_IMAGE_STORE_INT':('0', 'Cache images in the packed image store, instead of one file per image. Migrate existing images first with `image_store_migrate`.'),
+            'MC_IMAGE_STORE_DIR':('/datasets/datasets/indexer_cache/image_store/', 'Location of the packed image store: segment files and their LMDB index.'),
+            'MC_IMAGE_CACHE_BLOOM_BITS_INT':(str(2 ** 29), 'Size of new cached image Bloom filters. ~10 bits per cached image gives ~1% false positives.'),
             'MC_ALLOW_SKIP_QUERY_CACHE_INT':('1', 'Allow Indexer `skip_cache` arg.'),
             'MC_FILTER_INCOMPLETE_INT':('0', ["Temporary - ",
                                               "Set to \"1\" filter out image results for which we don't have a high-res image. ",
@@ -64,6 +68,29 @@ cfg = {'1. Model Settings. NOTE - WIP. These settings are not enabled yet.':
             'MC_DO_FORWARDING_INT':('0', 'Quick hack - forwards search queries to cluster.'),
             'MC_DO_FORWARDING_URL':('http://10.99.0.44:23456/search', 'URL to forward search queries to, if forwarding is enabled.'),
             'MC_NEURAL_MODEL_NAME':('order_model', 'Choices: "order_model", "order_model_2"'),
+            'MC_QUERY_CACHE_STALE_AGE_INT':(str(60 * 60 * 24 * 7), 'Seconds past expiry during which stale query cache entries are still served, while being refreshed in the background.'),
+            'MC_QUERY_CACHE_PARTIAL_AGE_INT':('60', 'Seconds that results missing a candidate source, which timed out, are cached for. They are never served stale.'),
+            'MC_QUERY_CACHE_REFRESH_URL':('http://127.0.0.1:23456/search', 'Search URL used for background refreshes of stale query cache entries, and for cache warming.'),
+            'MC_PRELOAD_MODELS_INT':('1', 'Load the neural order model before forking web workers, instead of in each worker.'),
+            'MC_SPELLING_INDEX_DIR':('/datasets/datasets/spelling_index/', 'Location of persisted query-correction spelling indexes.'),
+            'MC_BLOCKED_IDS_FILE':('/datasets/datasets/blocked_ids.txt', 'Document IDs to exclude from all search results, one per line.'),
+            'MC_COMPRESS_RESPONSE_INT':('1', 'Gzip responses for clients that accept it.'),
+            'MC_QUERY_CACHE_WARM_ARGS_JSON':('{}', 'Extra search arguments used when warming the query cache. Should match what the frontend sends.'),
+            'MC_METRICS_DIR':('/tmp/mc_metrics/', 'Location where each web worker periodically writes its latency histograms, merged by the `/metrics` endpoint.'),
+            'MC_METRICS_FLUSH_INTERVAL_INT':('10', 'Seconds between writes of latency histograms by each web worker.'),
+            'MC_ADMISSION_MAX_INFLIGHT_INT':('8', 'Maximum `/search` requests processed concurrently by each web worker.'),
+            'MC_ADMISSION_MAX_QUEUE_INT':('32', 'Maximum `/search` requests waiting for a slot in each web worker. Further requests get an immediate 503.'),
+            'MC_ADMISSION_QUEUE_TIMEOUT_FLOAT':('1.0', 'Seconds a `/search` request may wait for a slot, before getting a 503.'),
+            'MC_RATE_LIMIT_JSON':('{"rate":5, "burst":20}', 'Token bucket per known `Access-Token` or `API-KEY`, otherwise per client IP, in each web worker. `rate` is requests per second.'),
+            'MC_RATE_LIMIT_KEYS_JSON':('[]', 'Known `Access-Token` / `API-KEY` values, each rate limited in its own bucket. Keys are not authenticated, so unknown keys share the bucket of the client IP.'),
+            'MC_NEURAL_RELEVANCE_TIMEOUT_FLOAT':('2.0', 'Seconds a `/search` request waits for neural relevance scores, before continuing without them.'),
+            'MC_EXECUTOR_THREADS_INT':('4', 'Threads per web worker for CPU-heavy `/search` stages, run off the IOLoop.'),
+            'MC_EXECUTOR_MAX_PENDING_INT':('64', 'Maximum stages queued on the thread pool of each web worker. Further stages run on the IOLoop.'),
+            'MC_EXECUTOR_MIN_JSON_BYTES_INT':('65536', 'Elasticsearch responses larger than this are parsed on the thread pool.'),
+            'MC_IOLOOP_LAG_INTERVAL_FLOAT':('0.5', 'Seconds between measurements of IOLoop lag, reported as `ioloop.lag` on `/metrics`.'),
+            'MC_LOCAL_IMAGE_SEARCH_INT':('1', 'Search by uploaded image or `q_id` data URI with the local Hamming index, instead of the external reverse image lookup.'),
+            'MC_IMAGE_HAMMING_INDEX_PATH':('/datasets/datasets/image_search/dedupe_hsh.npz', 'Location of the `dedupe_hsh` Hamming index for local image search, built by `image_index_build`.'),
+            'MC_IMAGE_SEARCH_MAX_DISTANCE_INT':('3', 'Maximum Hamming distance between `dedupe_hsh` values of the query image and local image search results.'),
             },
        '5. Settings for Automated Tests':
            {'MC_TEST_WEB_HOST':('http://127.0.0.1:23456', ''),
@@ -77,10 +104,15 @@ cfg = {'1. Model Settings. NOTE - WIP. These settings are not enabled yet.':
        '7. Annotation Settings':
            {'MC_ANNOTATE_DIR':('/datasets/datasets/annotate/', 'Location for query relevance annotation.'),
             'MC_TYPEAHEAD_TSV_PATH':('/datasets/datasets/retrain/deploy/order_model_3/typeahead_4.tsv', 'Typeahead queries location, used for `/random_query` endpoint.'),
+            'MC_TYPEAHEAD_INDEX_PATH':('/datasets/datasets/retrain/deploy/order_model_3/typeahead_4.index.json', 'Typeahead index generated by `typeahead_generate`, used for `/typeahead` and `/random_query` endpoints.'),
             },
        '8. Slack API Settings':
            {'MC_SLACK_WEBHOOK':('','Slack API key for logging.'),
             'MC_SLACK_CHANNEL':('','Slack channel for logging.'),
+            'MC_ALERTS_DIGEST_INTERVAL_INT':('60','Seconds between Slack alert digests. Alerts are queued and sent as one message per channel per interval.'),
+            },
+       '9. Logging Settings':
+           {'MC_LOG_LEVEL':('INFO', 'Minimum level of hot-path log messages: "DEBUG", "INFO", "WARNING" or "ERROR".'),
             },
        }
 
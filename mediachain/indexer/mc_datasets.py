@@ -45,6 +45,7 @@ from dateutil import parser as date_parser
 from mc_generic import igroup, group, setup_main, raw_input_enter, download_streamed, tcache, pretty_print, tarfile_extract_if_not_exists, walk_files
 import mc_config
 import mc_ingest
+from mc_log import log
 
 import base64
 import hashlib
@@ -434,7 +435,7 @@ def iter_compactsplit(fn_in_glob,
             tot_c += 1
             
             if (tot_c % 100 == 0):
-                print ('iter_compactsplit', 'tot_c', tot_c, 'nn', nn, 'max_num', max_num, 'per_sec', (tot_c - last_tot_c) / (time() - t1))
+                log.progress('iter_compactsplit', 'tot_c', tot_c, 'nn', nn, 'max_num', max_num, 'per_sec', (tot_c - last_tot_c) / (time() - t1))
                 t1 = time()
                 last_tot_c = tot_c
                 
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Running CPU-heavy request stages off the IOLoop.
+
+`Executor.submit()` runs a function on a bounded thread pool and returns a Tornado Future, so that
+coroutine handlers can `yield` it while the IOLoop keeps serving other connections. When too many
+calls are already pending, further calls run inline instead of queueing without bound.
+
+`IOLoopLagMonitor` measures how late the IOLoop runs a periodic callback, i.e. how long the IOLoop was
+blocked, and adds it to the `ioloop.lag` latency histogram.
+"""
+
+import mc_config
+import tornado.ioloop
+from tornado.concurrent import Future
+from multiprocessing.pool import ThreadPool
+from os import getpid
+import sys
+
+
+class Executor(object):
+
+    def __init__(self,
+                 num_threads = mc_config.MC_EXECUTOR_THREADS_INT,
+                 max_pending = mc_config.MC_EXECUTOR_MAX_PENDING_INT,
+                 ):
+        """
+        Args:
+            num_threads: Thread pool size.
+            max_pending: Maximum calls queued or running on the pool. Further calls run inline.
+
+        Submitted functions must not touch state shared with the IOLoop thread, other than what they are
+        passed and return. The thread pool is created on first use, and re-created in forked child processes.
+        """
+        self.num_threads = num_threads
+        self.max_pending = max_pending
+        self.pool = False
+        self.pid = False
+        self.pending = 0
+        self.num_done = 0
+        self.num_inline = 0
+
+    def submit(self,
+               func,
+               *args,
+               **kw):
+        """
+        Run `func(*args, **kw)` on the thread pool. Returns a Future of its result.
+        """
+
+        fut = Future()
+
+        if self.pending >= self.max_pending:
+            self.num_inline += 1
+            try:
+                fut.set_result(func(*args, **kw))
+            except Exception:
+                fut.set_exc_info(sys.exc_info())
+            return fut
+
+        if self.pid != getpid():
+            self.pool = ThreadPool(self.num_threads)
+            self.pid = getpid()
+
+        io_loop = tornado.ioloop.IOLoop.current()
+
+        self.pending += 1
+
+        def done(set_func, rr):
+            self.pending -= 1
+            self.num_done += 1
+            set_func(rr)
+
+        def run():
+            try:
+                rr = func(*args, **kw)
+            except Exception:
+                io_loop.add_callback(done, fut.set_exc_info, sys.exc_info())
+                return
+            io_loop.add_callback(done, fut.set_result, rr)
+
+        self.pool.apply_async(run)
+
+        return fut
+
+    def stats(self):
+        return {'threads':self.num_threads,
+                'pending':self.pending,
+                'done':self.num_done,
+                'inline':self.num_inline,
+                }
+
+
+class IOLoopLagMonitor(object):
+
+    def __init__(self,
+                 metrics,
+                 interval = mc_config.MC_IOLOOP_LAG_INTERVAL_FLOAT,
+                 name = 'ioloop.lag',
+                 ):
+        """
+        Args:
+            metrics:  `Metrics` to add the lag to.
+            interval: Seconds between measurements.
+            name:     Histogram name.
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.name = name
+        self.io_loop = False
+        self.expected = 0
+
+    def start(self):
+        """
+        Start measuring on the current IOLoop. Call after forking.
+        """
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.schedule()
+
+    def schedule(self):
+        self.expected = self.io_loop.time() + self.interval
+        self.io_loop.call_at(self.expected, self.tick)
+
+    def tick(self):
+        self.metrics.observe(self.name, max(0.0, (self.io_loop.time() - self.expected) * 1000))
+        self.metrics.maybe_flush()
+        self.schedule()
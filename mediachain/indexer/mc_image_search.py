@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+"""
+Local content-based image search, for image upload and `q_id` data URI searches.
+
+The query image is decoded and hashed with the `baseline` dedupe model (64-bit dhash, as stored in the
+`dedupe_hsh` field), then looked up in a `HammingIndex` of all indexed `dedupe_hsh` values. Optionally, a
+dense-vector index, e.g. `AnnoyDenseIndex`, contributes further results.
+
+`LocalImageSearch.search_async()` runs this on an `mc_executor.Executor`, off the IOLoop, and caches results
+by image content hash, so repeat uploads of the same image return immediately.
+
+Build the Hamming index with `image_index_build`.
+"""
+
+import mc_config
+import ujson
+import numpy as np
+from tornado.concurrent import Future
+from collections import OrderedDict
+from itertools import combinations
+from os import rename, makedirs
+from os.path import exists, dirname
+from time import time
+
+
+def popcount64(x):
+    """
+    Number of set bits of each element of uint64 array `x`.
+    """
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+class HammingIndex(object):
+
+    def __init__(self,
+                 hashes,
+                 ids,
+                 num_chunks = 4,
+                 ):
+        """
+        Multi-index hashing over 64-bit hashes: each hash is split into `num_chunks` chunks, and each chunk
+        position is indexed separately. Any hash within Hamming distance `d` of the query matches the
+        query exactly on at least one chunk when `d < num_chunks`, and within `d // num_chunks` bits on at
+        least one chunk otherwise. Candidates are then verified with the full distance.
+
+        Args:
+            hashes:     uint64 array of hashes.
+            ids:        Array of document IDs, aligned with `hashes`.
+            num_chunks: Number of chunks. Must divide 64.
+        """
+        assert 64 % num_chunks == 0, num_chunks
+
+        self.hashes = np.asarray(hashes, dtype = np.uint64)
+        self.ids = np.asarray(ids)
+        self.num_chunks = num_chunks
+        self.chunk_bits = 64 // num_chunks
+        self.chunk_mask = np.uint64((1 << self.chunk_bits) - 1)
+
+        self.chunk_orders = []
+        self.chunk_keys = []
+
+        for i in xrange(num_chunks):
+            keys = self.chunk(self.hashes, i)
+            order = np.argsort(keys, kind = 'mergesort').astype(np.int32)
+            self.chunk_orders.append(order)
+            self.chunk_keys.append(keys[order])
+
+    def chunk(self, hashes, i):
+        return ((hashes >> np.uint64(i * self.chunk_bits)) & self.chunk_mask).astype(np.uint32)
+
+    def chunk_neighbors(self, key, radius):
+        """
+        `key`, and all chunk values within `radius` bit flips of it.
+        """
+        rr = [key]
+        for r in xrange(1, radius + 1):
+            for bits in combinations(xrange(self.chunk_bits), r):
+                x = key
+                for b in bits:
+                    x ^= (1 << b)
+                rr.append(x)
+        return rr
+
+    def lookup(self,
+               hsh,
+               max_distance = 3,
+               num = 1000,
+               ):
+        """
+        Indexed hashes within `max_distance` bits of integer `hsh`, closest first.
+
+        Returns [(distance, id), ...]
+        """
+
+        q = np.array([hsh], dtype = np.uint64)
+
+        radius = max_distance // self.num_chunks
+
+        cands = []
+
+        for i in xrange(self.num_chunks):
+            qk = int(self.chunk(q, i)[0])
+            for key in self.chunk_neighbors(qk, radius):
+                lo = np.searchsorted(self.chunk_keys[i], key, 'left')
+                hi = np.searchsorted(self.chunk_keys[i], key, 'right')
+                if hi > lo:
+                    cands.append(self.chunk_orders[i][lo:hi])
+
+        if not cands:
+            return []
+
+        cands = np.unique(np.concatenate(cands))
+
+        dists = popcount64(self.hashes[cands] ^ q[0])
+
+        keep = dists <= max_distance
+
+        cands = cands[keep]
+        dists = dists[keep]
+
+        order = np.argsort(dists, kind = 'mergesort')[:num]
+
+        return [(int(dists[x]), self.ids[cands[x]]) for x in order]
+
+    def save(self, fn):
+        """
+        Atomically write to `fn`.
+        """
+        if not exists(dirname(fn)):
+            makedirs(dirname(fn))
+        with open(fn + '.temp', 'wb') as f:
+            np.savez(f,
+                     hashes = self.hashes,
+                     ids = self.ids,
+                     num_chunks = self.num_chunks,
+                     )
+        rename(fn + '.temp', fn)
+
+    @classmethod
+    def load(cls, fn):
+        hh = np.load(fn)
+        return cls(hh['hashes'],
+                   hh['ids'],
+                   num_chunks = int(hh['num_chunks']),
+                   )
+
+
+class AnnoyDenseIndex(object):
+
+    def __init__(self,
+                 fn,
+                 ):
+        """
+        Dense-vector index, from an Annoy index file `fn`, and a JSON sidecar `fn + '.json'` containing
+        {"n_dims":..., "metric":..., "ids":[...]}, with `ids` aligned with the Annoy item numbers.
+        """
+        from annoy import AnnoyIndex
+
+        with open(fn + '.json') as f:
+            hh = ujson.loads(f.read())
+
+        self.ids = hh['ids']
+        self.ann = AnnoyIndex(hh['n_dims'], hh.get('metric', 'angular'))
+        self.ann.load(fn)
+
+    def query(self,
+              vector,
+              num = 1000,
+              ):
+        """
+        Returns [(distance, id), ...], closest first.
+        """
+        nums, dists = self.ann.get_nns_by_vector(vector, num, include_distances = True)
+        return [(d, self.ids[n]) for n, d in zip(nums, dists)]
+
+
+class LocalImageSearch(object):
+
+    def __init__(self,
+                 hamming_index = False,
+                 dense_index = False,
+                 vectorize = False,
+                 max_distance = 3,
+                 executor = False,
+                 cache_size = 1000,
+                 ):
+        """
+        Args:
+            hamming_index: `HammingIndex` of `dedupe_hsh` values. If not available, `search()` only returns the
+                           query hash, for an exact `dedupe_hsh` term lookup.
+            dense_index:   Optional dense-vector index, with a `query(vector, num)` method like `AnnoyDenseIndex`.
+            vectorize:     `vectorize(img_bytes)`, returning the query vector for `dense_index`.
+            max_distance:  Maximum Hamming distance of results.
+            executor:      `mc_executor.Executor` that `search_async()` runs searches on. Defaults to a new one.
+            cache_size:    Number of results cached by content hash.
+        """
+        import mc_models
+
+        self.model = mc_models.VECTORS_MODEL_NAMES['baseline']()
+        self.hamming_index = hamming_index
+        self.dense_index = dense_index
+        self.vectorize = vectorize
+        self.max_distance = max_distance
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        if executor is False:
+            from mc_executor import Executor
+            executor = Executor()
+
+        self.executor = executor
+
+    def search(self,
+               img_bytes,
+               num = 1000,
+               ):
+        """
+        Returns {'dedupe_hsh': query hash, 'ids': [matching ID, ...] or False if there is no local index}.
+        """
+
+        hsh = self.model.img_to_terms(img_bytes = img_bytes)['dedupe_hsh']
+
+        if self.hamming_index is False:
+            return {'dedupe_hsh':hsh, 'ids':False}
+
+        ids = [x for d, x in self.hamming_index.lookup(int(hsh, 16),
+                                                       max_distance = self.max_distance,
+                                                       num = num,
+                                                       )]
+
+        if (self.dense_index is not False) and (self.vectorize is not False):
+            seen = set(ids)
+            for d, x in self.dense_index.query(self.vectorize(img_bytes), num = num):
+                if x not in seen:
+                    seen.add(x)
+                    ids.append(x)
+
+        return {'dedupe_hsh':hsh, 'ids':ids[:num]}
+
+    def search_async(self,
+                     img_bytes,
+                     cache_key = False,
+                     num = 1000,
+                     ):
+        """
+        `search()` on the executor. Returns a Future. Results are cached by `cache_key`, e.g. the md5 of `img_bytes`.
+        """
+
+        if cache_key and (cache_key in self.cache):
+            rr = self.cache.pop(cache_key)
+            self.cache[cache_key] = rr
+            fut = Future()
+            fut.set_result(rr)
+            return fut
+
+        fut = self.executor.submit(self.search, img_bytes, num = num)
+
+        def done(ff):
+            ## Runs on the IOLoop, once the search is done:
+            if cache_key and (ff.exception() is None):
+                self.cache[cache_key] = ff.result()
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last = False)
+
+        fut.add_done_callback(done)
+
+        return fut
+
+
+def load_local_image_search(fn = mc_config.MC_IMAGE_HAMMING_INDEX_PATH,
+                            max_distance = mc_config.MC_IMAGE_SEARCH_MAX_DISTANCE_INT,
+                            executor = False,
+                            ):
+    """
+    `LocalImageSearch` using the Hamming index at `fn`, if it exists.
+    """
+
+    hamming_index = False
+
+    if fn and exists(fn):
+        t0 = time()
+        hamming_index = HammingIndex.load(fn)
+        print ('LOADED_HAMMING_INDEX', fn, len(hamming_index.ids), time() - t0)
+    else:
+        print ('NO_HAMMING_INDEX', fn)
+
+    return LocalImageSearch(hamming_index,
+                            max_distance = max_distance,
+                            executor = executor,
+                            )
+
+
+def image_index_build(index_name = mc_config.MC_INDEX_NAME,
+                      doc_type = mc_config.MC_DOC_TYPE,
+                      fn_out = mc_config.MC_IMAGE_HAMMING_INDEX_PATH,
+                      batch_size = 5000,
+                      via_cli = False,
+                      ):
+    """
+    Build the `HammingIndex` used for local image search, from the `dedupe_hsh` field of all documents.
+    """
+
+    from elasticsearch.helpers import scan
+    from mc_neighbors import low_level_es_connect
+
+    es = low_level_es_connect()
+
+    hashes = []
+    ids = []
+
+    t0 = time()
+
+    for c, hit in enumerate(scan(client = es,
+                                 index = index_name,
+                                 doc_type = doc_type,
+                                 scroll = '10m',
+                                 size = batch_size,
+                                 query = {"query": {"exists": {"field": "dedupe_hsh"}}},
+                                 _source_include = ['dedupe_hsh'],
+                                 )):
+
+        if c % 100000 == 0:
+            print ('IMAGE_INDEX_BUILD', c, time() - t0)
+
+        try:
+            hashes.append(int(hit['_source']['dedupe_hsh'], 16))
+        except (KeyError, ValueError, TypeError):
+            continue
+
+        ids.append(hit['_id'])
+
+    hi = HammingIndex(np.array(hashes, dtype = np.uint64),
+                      np.array(ids),
+                      )
+
+    hi.save(fn_out)
+
+    print ('IMAGE_INDEX_BUILT', fn_out, len(ids), time() - t0)
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+"""
+Packed image cache.
+
+Instead of one file per cached image, images are appended to large segment files, and an LMDB index
+maps each image key to its (segment, offset, length). Reads are served from memory-mapped segments.
+
+Layout of `store_dir`:
+
+    segments/<start time>_<pid>_<num>.seg   Append-only. Each process writes to its own segment.
+    index.lmdb                               {key: pack('<QI', offset, length) + segment name}
+
+Each record in a segment is a header, pack('<4sII', 'MCIM', len(key), len(data)), then the key, then the
+data. Reads check the header against the key, so an index entry whose data was lost in a crash reads as a
+miss. The index can be rebuilt from the segments with `image_store_reindex`.
+
+Keys are 'size/hashed_id', e.g. '1024x1024/00afa8d8fbacbc14ee33aab59261f5b7', as in the cached image
+Bloom filter. See `image_store_migrate` to pack an existing `MC_IMAGE_CACHE_DIR`.
+"""
+
+import mc_config
+import struct
+import mmap
+from os import listdir, makedirs, getpid, fsync, unlink
+from os.path import join, exists, getsize
+from threading import Lock
+from time import time
+
+
+header_struct = struct.Struct('<4sII')
+header_magic = 'MCIM'
+
+index_struct = struct.Struct('<QI')
+
+
+def key_bytes(key):
+    """
+    LMDB keys must be byte strings. Tornado passes URL path arguments as unicode.
+    """
+    if isinstance(key, unicode):
+        return key.encode('utf8')
+    return key
+
+
+class PackedImageStore(object):
+
+    def __init__(self,
+                 store_dir = mc_config.MC_IMAGE_STORE_DIR,
+                 segment_max_bytes = 1024 ** 3,
+                 map_size = 64 * 1024 ** 3,
+                 sync_interval = 5.0,
+                 ):
+        """
+        Args:
+            store_dir:         Directory of segments and the index.
+            segment_max_bytes: Start a new segment once the current one reaches this size.
+            map_size:          Maximum LMDB index size. Sparse, so only uses what is written.
+            sync_interval:     Maximum seconds between fsyncs of the current segment and the index.
+                               Images written since the last fsync may be lost in a crash, and are then re-cached.
+
+        Segments and the index are opened on first use, and re-opened in forked child processes.
+        """
+        self.store_dir = store_dir
+        self.segments_dir = join(store_dir, 'segments')
+        self.segment_max_bytes = segment_max_bytes
+        self.map_size = map_size
+        self.sync_interval = sync_interval
+
+        self.lock = Lock()
+        self.pid = False
+        self.index = False
+        self.inherited = []
+
+    def open(self):
+        with self.lock:
+            if self.pid == getpid():
+                return
+
+            import lmdb
+
+            ## Closing an index inherited from the parent process would release the parent's LMDB reader slots:
+
+            if self.index is not False:
+                self.inherited.append(self.index)
+
+            if not exists(self.segments_dir):
+                makedirs(self.segments_dir)
+
+            self.index = lmdb.open(join(self.store_dir, 'index.lmdb'),
+                                   map_size = self.map_size,
+                                   max_readers = 1024,
+                                   sync = False,
+                                   metasync = False,
+                                   )
+            self.maps = {}          # {segment_name: mmap}
+            self.segment_num = 0
+            self.segment_prefix = '%010d_%d' % (int(time()), getpid())
+            self.segment_name = False
+            self.segment_f = False
+            self.segment_size = 0
+            self.last_sync = time()
+            self.pid = getpid()
+
+    def open_segment(self):
+        if self.segment_f:
+            self.segment_f.flush()
+            fsync(self.segment_f.fileno())
+            self.segment_f.close()
+
+        self.segment_num += 1
+        self.segment_name = '%s_%06d.seg' % (self.segment_prefix, self.segment_num)
+        self.segment_f = open(join(self.segments_dir, self.segment_name), 'ab')
+        self.segment_size = self.segment_f.tell()
+
+    def write(self,
+              key,
+              data,
+              ):
+        """
+        Append one record to this process's current segment. Returns the record's (segment, offset).
+        Call with `lock` held.
+        """
+
+        if (self.segment_f is False) or (self.segment_size >= self.segment_max_bytes):
+            self.open_segment()
+
+        offset = self.segment_size
+
+        self.segment_f.write(header_struct.pack(header_magic, len(key), len(data)))
+        self.segment_f.write(key)
+        self.segment_f.write(data)
+        self.segment_size += header_struct.size + len(key) + len(data)
+
+        return self.segment_name, offset
+
+    def put_many(self,
+                 items,
+                 ):
+        """
+        Store [(key, data), ...], replacing any earlier data for the same keys, and index them in one transaction.
+        """
+
+        if self.pid != getpid():
+            self.open()
+
+        with self.lock:
+
+            entries = []
+
+            for key, data in items:
+                key = key_bytes(key)
+                segment_name, offset = self.write(key, data)
+                entries.append((key, index_struct.pack(offset, len(data)) + segment_name))
+
+            ## Make the data readable by other processes, before it is indexed:
+
+            self.segment_f.flush()
+
+            with self.index.begin(write = True) as txn:
+                for key, vv in entries:
+                    txn.put(key, vv)
+
+            if time() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+    def put(self,
+            key,
+            data,
+            ):
+        self.put_many([(key, data)])
+
+    def sync(self):
+        """
+        Fsync the current segment, then the index. Call with `lock` held.
+        """
+        if self.segment_f:
+            fsync(self.segment_f.fileno())
+        self.index.sync(True)
+        self.last_sync = time()
+
+    def close(self):
+        if self.pid != getpid():
+            return
+        with self.lock:
+            self.sync()
+            if self.segment_f:
+                self.segment_f.close()
+                self.segment_f = False
+
+    def segment_map(self,
+                    segment_name,
+                    min_size,
+                    ):
+        """
+        Memory map of `segment_name`, covering at least `min_size` bytes. Segments that are still
+        being appended to are re-mapped as they grow.
+        """
+
+        mm = self.maps.get(segment_name)
+
+        if (mm is None) or (len(mm) < min_size):
+            with self.lock:
+                mm = self.maps.get(segment_name)
+                if (mm is None) or (len(mm) < min_size):
+                    with open(join(self.segments_dir, segment_name), 'rb') as f:
+                        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                    self.maps[segment_name] = mm
+
+        return mm
+
+    def get_buffer(self,
+                   key,
+                   ):
+        """
+        Zero-copy read-only buffer of the data stored for `key`, or None.
+        """
+
+        if self.pid != getpid():
+            self.open()
+
+        key = key_bytes(key)
+
+        with self.index.begin() as txn:
+            vv = txn.get(key)
+
+        if vv is None:
+            return None
+
+        offset, length = index_struct.unpack_from(vv)
+        segment_name = vv[index_struct.size:]
+
+        data_offset = offset + header_struct.size + len(key)
+
+        try:
+            mm = self.segment_map(segment_name, data_offset + length)
+        except (IOError, ValueError):
+            return None
+
+        if len(mm) < data_offset + length:
+            return None
+
+        magic, key_len, data_len = header_struct.unpack_from(mm, offset)
+
+        if (magic != header_magic) or (data_len != length) or (mm[offset + header_struct.size:data_offset] != key):
+            return None
+
+        return buffer(mm, data_offset, length)
+
+    def get(self,
+            key,
+            ):
+        """
+        Data stored for `key`, as a string, or None.
+        """
+        buf = self.get_buffer(key)
+        if buf is None:
+            return None
+        return str(buf)
+
+    def __contains__(self,
+                     key,
+                     ):
+        if self.pid != getpid():
+            self.open()
+        with self.index.begin() as txn:
+            return txn.get(key_bytes(key)) is not None
+
+    def contains_many(self,
+                      keys,
+                      ):
+        """
+        Returns [bool, ...], True for each of `keys` that is in the index, looked up in one transaction.
+        """
+        if self.pid != getpid():
+            self.open()
+        with self.index.begin() as txn:
+            return [txn.get(key_bytes(key)) is not None for key in keys]
+
+    def iter_keys(self):
+        """
+        Yields the key of each indexed image, in key order.
+        """
+        if self.pid != getpid():
+            self.open()
+        with self.index.begin() as txn:
+            for key in txn.cursor().iternext(keys = True, values = False):
+                yield key
+
+    def iter_segment(self,
+                     segment_name,
+                     ):
+        """
+        Yields (key, offset, length) of each complete record in `segment_name`.
+        """
+
+        fn = join(self.segments_dir, segment_name)
+
+        size = getsize(fn)
+
+        if not size:
+            return
+
+        with open(fn, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        offset = 0
+
+        while offset + header_struct.size <= size:
+            magic, key_len, data_len = header_struct.unpack_from(mm, offset)
+
+            end = offset + header_struct.size + key_len + data_len
+
+            if (magic != header_magic) or (end > size):
+                print ('BAD_RECORD', segment_name, offset)
+                break
+
+            yield mm[offset + header_struct.size:offset + header_struct.size + key_len], offset, data_len
+
+            offset = end
+
+        mm.close()
+
+
+## One store per process, opened lazily:
+
+image_stores = {}
+
+def image_store(store_dir = mc_config.MC_IMAGE_STORE_DIR,
+                ):
+    if store_dir not in image_stores:
+        image_stores[store_dir] = PackedImageStore(store_dir)
+    return image_stores[store_dir]
+
+
+def image_store_migrate(image_cache_dir = mc_config.MC_IMAGE_CACHE_DIR,
+                        store_dir = mc_config.MC_IMAGE_STORE_DIR,
+                        batch_size = 1000,
+                        delete_files = False,
+                        via_cli = False,
+                        ):
+    """
+    Pack all images of a one-file-per-image cache directory into the packed image store. Images already
+    in the store are skipped, so this can be re-run, e.g. after switching `cache_image()` to the store,
+    to pick up images cached in the meantime.
+
+    Args:
+        image_cache_dir: Directory containing the `hh_<size>/` image directories.
+        store_dir:       Packed image store directory.
+        batch_size:      Images per index transaction.
+        delete_files:    Delete each image file once it has been packed and synced.
+    """
+
+    from mc_log import log
+
+    store = PackedImageStore(store_dir)
+
+    t0 = time()
+
+    nn = 0
+    nn_skipped = 0
+
+    batch = []
+
+    def flush_batch():
+        store.put_many([(key, data) for key, data, fn in batch])
+        if delete_files:
+            with store.lock:
+                store.sync()
+            for key, data, fn in batch:
+                unlink(fn)
+        del batch[:]
+
+    for size_dir in sorted(listdir(image_cache_dir)):
+
+        if not size_dir.startswith('hh_'):
+            continue
+
+        size = size_dir[len('hh_'):]
+
+        for sub in sorted(listdir(join(image_cache_dir, size_dir))):
+
+            dr = join(image_cache_dir, size_dir, sub)
+
+            for fn in sorted(listdir(dr)):
+
+                if not fn.endswith('.jpg'):
+                    continue
+
+                key = size + '/' + fn[:-len('.jpg')]
+
+                if key in store:
+                    nn_skipped += 1
+                    continue
+
+                with open(join(dr, fn), 'rb') as f:
+                    batch.append((key, f.read(), join(dr, fn)))
+
+                nn += 1
+
+                if len(batch) >= batch_size:
+                    flush_batch()
+                    log.progress('IMAGE_STORE_MIGRATE', 'packed:', nn, 'skipped:', nn_skipped, 'per_second:', nn / (time() - t0))
+
+    if batch:
+        flush_batch()
+
+    store.close()
+
+    print ('IMAGE_STORE_MIGRATED', store_dir, 'packed:', nn, 'skipped:', nn_skipped, 'time:', time() - t0)
+
+
+def image_store_reindex(store_dir = mc_config.MC_IMAGE_STORE_DIR,
+                        batch_size = 10000,
+                        via_cli = False,
+                        ):
+    """
+    Rebuild the index of the packed image store from its segments, e.g. after losing the index. Segments are
+    replayed in name order, i.e. process start order, so the latest record of each key wins.
+    """
+
+    store = PackedImageStore(store_dir)
+    store.open()
+
+    t0 = time()
+
+    nn = 0
+
+    for segment_name in sorted(listdir(store.segments_dir)):
+
+        if not segment_name.endswith('.seg'):
+            continue
+
+        entries = []
+
+        for key, offset, length in store.iter_segment(segment_name):
+
+            entries.append((key, index_struct.pack(offset, length) + segment_name))
+
+            if len(entries) >= batch_size:
+                with store.index.begin(write = True) as txn:
+                    for kk, vv in entries:
+                        txn.put(kk, vv)
+                nn += len(entries)
+                entries = []
+
+        with store.index.begin(write = True) as txn:
+            for kk, vv in entries:
+                txn.put(kk, vv)
+
+        nn += len(entries)
+
+        print ('REINDEXED_SEGMENT', segment_name, nn, time() - t0)
+
+    store.close()
+
+    print ('IMAGE_STORE_REINDEXED', store_dir, 'records:', nn, 'time:', time() - t0)
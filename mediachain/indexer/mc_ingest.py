@@ -18,6 +18,8 @@ from mc_generic import setup_main, group, raw_input_enter, pretty_print, intget,
 
 import mc_config
 import mc_datasets
+from mc_log import log
+from mc_image_store import image_store, image_store_migrate, image_store_reindex
 import mc_neighbors
 
 from time import sleep,time
@@ -27,7 +29,7 @@ from os.path import exists, join
 from os import mkdir, listdir, makedirs, walk, rename, unlink
 
 from Queue import Queue
-from threading import current_thread,Thread
+from threading import current_thread,Thread,Lock
 
 import requests
 from random import shuffle
@@ -248,9 +250,11 @@ def lookup_cached_image(_id,
         _id:               Note - Assumed to be already cryptographically hashed, for even distribution.
         do_sizes:          Output resized versions, with these sizes.
         return_as:         'urls', 'filenames', 'bytes', 'base64'
-        check_exists:      Check that the files actually exist. Can considerably slow down lookups.
+        check_exists:      Check that the files actually exist, via the cached image Bloom filter if there is one.
                            TODO: auto-generate lower res versions from the higher-res versions, if needed?
         image_hash_sha256: TODO: Optionally verify that retrieved original matches this hash?
+
+    See also: `lookup_cached_images()`, for many IDs at once.
     """
 
     orig_id = _id
@@ -278,15 +282,21 @@ def lookup_cached_image(_id,
         ## TODO: handle cache misses here?
         
         if check_exists:
-            if not exists(fn_cache):
+            if not cached_images_exist([_id], size, image_cache_dir)[0]:
                 print ('CACHE_MISS', orig_id, _id, fn_cache)
                 return False
             else:
                 print ('CACHE_HIT', orig_id, _id, fn_cache)
 
         if return_as in ['bytes', 'base64']:
-            with open(fn_cache) as f:
-                bytes_out = f.read()
+            bytes_out = None
+            
+            if mc_config.MC_IMAGE_STORE_INT:
+                bytes_out = image_store().get(size + '/' + _id)
+            
+            if bytes_out is None:
+                with open(dr2 + _id + '.jpg') as f:
+                    bytes_out = f.read()
             
         if return_as == 'urls':
             rh[size] = image_cache_host + 'hh_' + size + '/' + _id[:3] + '/' + _id + '.jpg'
@@ -307,6 +317,205 @@ def lookup_cached_image(_id,
     
     return rh
 
+
+## {bloom_path: (inode, BloomFilter)}, opened lazily:
+
+cached_image_filters = {}
+cached_image_filters_lock = Lock()
+
+def cached_image_filter(bloom_path = mc_config.MC_IMAGE_CACHE_BLOOM_PATH,
+                        ):
+    """
+    Bloom filter of cached images, keyed by 'size/hashed_id'. Returns False if it hasn't been built yet
+    with `cached_image_filter_rebuild`. Re-opened when a rebuild replaces the file.
+    """
+    
+    from mc_bloom import BloomFilter
+    
+    try:
+        ino = os.stat(bloom_path).st_ino
+    except OSError:
+        return False
+    
+    rr = cached_image_filters.get(bloom_path)
+    
+    if (rr is None) or (rr[0] != ino):
+        
+        with cached_image_filters_lock:
+            rr = cached_image_filters.get(bloom_path)
+            if (rr is None) or (rr[0] != ino):
+                rr = (ino, BloomFilter(bloom_path,
+                                       create = False,
+                                       ))
+                cached_image_filters[bloom_path] = rr
+    
+    return rr[1]
+
+
+def cached_images_exist(hashed_ids,
+                        size = '1024x1024',
+                        image_cache_dir = mc_config.MC_IMAGE_CACHE_DIR,
+                        bloom_path = mc_config.MC_IMAGE_CACHE_BLOOM_PATH,
+                        ):
+    """
+    Which of `hashed_ids` are cached, at `size`. Uses the Bloom filter, so can have ~1% false positives.
+    Falls back to checking the packed image store, if `MC_IMAGE_STORE_INT` is set, and the files, if there
+    is no Bloom filter yet.
+    """
+    
+    keys = [size + '/' + x for x in hashed_ids]
+    
+    bf = cached_image_filter(bloom_path)
+    
+    if bf is not False:
+        return bf.contains_many(keys).tolist()
+    
+    if mc_config.MC_IMAGE_STORE_INT:
+        rr = image_store().contains_many(keys)
+    else:
+        rr = [False] * len(keys)
+    
+    if not image_cache_dir.endswith('/'):
+        image_cache_dir = image_cache_dir + '/'
+    
+    dr1 = image_cache_dir + 'hh_' + size + '/'
+    
+    return [is_cached or exists(dr1 + x[:3] + '/' + x + '.jpg') for x, is_cached in zip(hashed_ids, rr)]
+
+
+def lookup_cached_images(ids,
+                         do_sizes = ['1024x1024'],
+                         return_as = 'urls',
+                         image_cache_dir = mc_config.MC_IMAGE_CACHE_DIR,
+                         image_cache_host = mc_config.MC_IMAGE_CACHE_HOST,
+                         bloom_path = mc_config.MC_IMAGE_CACHE_BLOOM_PATH,
+                         ):
+    """
+    Batch version of `lookup_cached_image()`.
+    
+    Args:
+        ids:       Document IDs. IDs containing '_' are md5 hashed, as in `lookup_cached_image()`.
+        do_sizes:  Sizes to look up.
+        return_as: 'urls', 'filenames', or 'exists', for whether each size is cached, via `cached_images_exist()`.
+    
+    Returns:
+        [{size: url, filename or bool}, ...], aligned with `ids`.
+    """
+    
+    hashed_ids = [('_' in x) and hashlib.md5(x).hexdigest() or x for x in ids]
+    
+    if not image_cache_dir.endswith('/'):
+        image_cache_dir = image_cache_dir + '/'
+    
+    if not image_cache_host.endswith('/'):
+        image_cache_host = image_cache_host + '/'
+    
+    columns = []
+    
+    for size in do_sizes:
+        
+        if return_as == 'urls':
+            pre = image_cache_host + 'hh_' + size + '/'
+            columns.append([pre + x[:3] + '/' + x + '.jpg' for x in hashed_ids])
+        
+        elif return_as == 'filenames':
+            pre = image_cache_dir + 'hh_' + size + '/'
+            columns.append([pre + x[:3] + '/' + x + '.jpg' for x in hashed_ids])
+        
+        elif return_as == 'exists':
+            columns.append(cached_images_exist(hashed_ids,
+                                               size = size,
+                                               image_cache_dir = image_cache_dir,
+                                               bloom_path = bloom_path,
+                                               ))
+        
+        else:
+            assert False, ('TODO', return_as)
+    
+    return [dict(zip(do_sizes, xx)) for xx in zip(*columns)]
+
+
+def cached_image_filter_rebuild(image_cache_dir = mc_config.MC_IMAGE_CACHE_DIR,
+                                bloom_path = mc_config.MC_IMAGE_CACHE_BLOOM_PATH,
+                                num_bits = mc_config.MC_IMAGE_CACHE_BLOOM_BITS_INT,
+                                batch_size = 100000,
+                                via_cli = False,
+                                ):
+    """
+    Rebuild the cached image Bloom filter from the image cache directory, and from the packed image store if
+    `MC_IMAGE_STORE_INT` is set, e.g. for the first time, or to resize it.
+    `cache_image()` only records images once the filter has been built.
+
+    The new filter replaces the old file, and running processes switch to it on their next lookup or addition.
+    Images cached during the rebuild may be missing from it, so are looked up as not cached until re-cached.
+    """
+    
+    from mc_bloom import BloomFilter
+    
+    if not image_cache_dir.endswith('/'):
+        image_cache_dir = image_cache_dir + '/'
+    
+    fn_temp = bloom_path + '.rebuild'
+    
+    if exists(fn_temp):
+        unlink(fn_temp)
+    
+    bf = BloomFilter(fn_temp,
+                     num_bits = num_bits,
+                     )
+    
+    t0 = time()
+    
+    nn = 0
+    keys = []
+    
+    for size_dir in (exists(image_cache_dir) and listdir(image_cache_dir) or []):
+        
+        if not size_dir.startswith('hh_'):
+            continue
+        
+        size = size_dir[len('hh_'):]
+        
+        for dir_name, subdir_list, file_list in walk(image_cache_dir + size_dir):
+            
+            for fn in file_list:
+                
+                if not fn.endswith('.jpg'):
+                    continue
+                
+                keys.append(size + '/' + fn[:-len('.jpg')])
+                
+                if len(keys) >= batch_size:
+                    bf.add_many(keys)
+                    nn += len(keys)
+                    keys = []
+                    log.progress('BLOOM_REBUILD', nn, time() - t0)
+    
+    ## Packed images, including those whose files `image_store_migrate` deleted:
+    
+    if mc_config.MC_IMAGE_STORE_INT:
+        for key in image_store().iter_keys():
+            
+            keys.append(key)
+            
+            if len(keys) >= batch_size:
+                bf.add_many(keys)
+                nn += len(keys)
+                keys = []
+                log.progress('BLOOM_REBUILD', nn, time() - t0)
+    
+    bf.add_many(keys)
+    nn += len(keys)
+    
+    bf.flush()
+    
+    rename(fn_temp, bloom_path)
+    
+    print ('BLOOM_REBUILT', bloom_path, 'images:', nn, 'bits:', int(bf.num_bits), 'time:', time() - t0)
+    
+    if nn * 10 > bf.num_bits:
+        print ('WARN: Fewer than 10 bits per image. Increase MC_IMAGE_CACHE_BLOOM_BITS_INT for fewer false positives.')
+
 from random import randint
 import errno
 
@@ -353,9 +562,15 @@ def cache_image(_id,
                 image_cache_dir = mc_config.MC_IMAGE_CACHE_DIR,
                 image_cache_host = mc_config.MC_IMAGE_CACHE_HOST,
                 true_if_exists = False,
+                bloom_path = mc_config.MC_IMAGE_CACHE_BLOOM_PATH,
                 ):
     """
     NOTE!!! - image must already be 1024x1024 and in a normalized encoding format.
+
+    Also records the image in the cached image Bloom filter at `bloom_path`, used by `lookup_cached_images()`,
+    if it has been built.
+
+    If `MC_IMAGE_STORE_INT` is set, the image is appended to the packed image store instead of written to its own file.
     """
     
     assert tuple(do_sizes) == ('1024x1024',), do_sizes
@@ -372,20 +587,29 @@ def cache_image(_id,
     
     fn_cache = dr2 + _id + '.jpg'
     
-    for x in xrange(2):
-        try:
-            with open(fn_cache, 'w') as f:
-                f.write(image_bytes)
-        except OSError as exception:
-            if exception.errno != errno.EEXIST:
-                raise
-            #import sys
-            #exc_info = sys.exc_info()
-            makedirs(dr2)
-            continue
-        break
+    if mc_config.MC_IMAGE_STORE_INT:
+        image_store().put(size + '/' + _id, image_bytes)
+    
     else:
-        raise
+        for x in xrange(2):
+            try:
+                with open(fn_cache, 'w') as f:
+                    f.write(image_bytes)
+            except OSError as exception:
+                if exception.errno != errno.EEXIST:
+                    raise
+                #import sys
+                #exc_info = sys.exc_info()
+                makedirs(dr2)
+                continue
+            break
+        else:
+            raise
+    
+    bf = cached_image_filter(bloom_path)
+    
+    if bf is not False:
+        bf.add(size + '/' + _id)
     
 
 def old_cache_image(_id,
@@ -1125,7 +1349,7 @@ def ingest_worker(hh):
                                         return_as = 'bytes',
                                         )
                 if the_bytes is False:
-                    print ('skip do_lazy',)
+                    log.debug('skip do_lazy', hh['_id'])
                     return False
                 
                 img_bytes = the_bytes['1024x1024']
@@ -1325,7 +1549,7 @@ def ingest_bulk(iter_json = False,
             #if cb < 100000:
             #    continue
             
-            print ('BATCH iter_wrap()', cb * batch_size)
+            log.debug('BATCH iter_wrap()', cb * batch_size)
             
             hh_batch = pool.imap_unordered(ingest_worker, hh_batch)
             #hh_batch = [ingest_worker(x) for x in hh_batch]
@@ -1335,8 +1559,8 @@ def ingest_bulk(iter_json = False,
                 if hh is False:
                     continue
                 
-                #if nnn % 100 == 0:
-                print ('ITER_WRAP','num:',nnn, 'index_name:',index_name, 'doc_type:',doc_type,'total_per_sec:',nnn / (time() - t0))
+                if log.progress_due('ITER_WRAP'):
+                    log.info('ITER_WRAP','num:',nnn, 'index_name:',index_name, 'doc_type:',doc_type,'total_per_sec:',nnn / (time() - t0))
                 
                 xdoc = {'_op_type': 'index',
                         '_index': index_name,
@@ -1428,7 +1652,7 @@ def ingest_bulk(iter_json = False,
 
                 while qqw.qsize() > 100:
                     while qqw.qsize() > 50:
-                        print ('BLOCKING, qqw:', qqw.qsize())
+                        log.progress('BLOCKING', 'qqw:', qqw.qsize())
                         sleep(1)
                 
                 qqw.put(hh)
@@ -1463,7 +1687,8 @@ def ingest_bulk(iter_json = False,
                         continue
                     break
                 
-                print ('SLOW_INDEXED', 'per_sec?', 1.0 / (time() - t1),)
+                if log.progress_due('SLOW_INDEXED'):
+                    log.info('SLOW_INDEXED', 'num:', c, 'per_sec?', 1.0 / (time() - t1),)
             
             #print 'DONE-NON_PARALLEL_BULK',xaction,xid
             
@@ -2017,6 +2242,9 @@ functions=['receive_blockchain_into_indexer',
            'config',
            'tail_blockchain',
            'test_image_cache',
+           'cached_image_filter_rebuild',
+           'image_store_migrate',
+           'image_store_reindex',
            'fix_hh_hash',
            'backfill_aesthetics',
            'backfill_xann',
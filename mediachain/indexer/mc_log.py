@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Level-gated, buffered logging for hot paths.
+
+Calls below the configured level (`MC_LOG_LEVEL`) return after a single comparison, without formatting
+their arguments. Enabled calls are formatted like the `print (...)` tuples used elsewhere, truncated to
+`max_line_length`, and queued for a background writer thread, so that the caller never blocks on stdout.
+If the queue is full, messages are dropped and counted rather than blocking.
+
+Usage:
+    from mc_log import log
+
+    log.debug('BODY', hh)                 # Not formatted unless MC_LOG_LEVEL=DEBUG.
+    log.info('ITER_WRAP', 'num:', nnn)
+    log.progress('iter_wrap', 'num:', nnn) # INFO, at most once per `progress_interval` seconds per key.
+
+    if log.progress_due('iter_wrap'):     # Same, without computing the arguments when not due.
+        log.info('iter_wrap', 'per_sec:', nnn / (time() - t0))
+"""
+
+import mc_config
+import sys
+import atexit
+from os import getpid
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock
+from time import time
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {'DEBUG':DEBUG,
+               'INFO':INFO,
+               'WARNING':WARNING,
+               'ERROR':ERROR,
+               }
+
+
+class Logger(object):
+
+    def __init__(self,
+                 level = mc_config.MC_LOG_LEVEL,
+                 out = sys.stdout,
+                 max_queue = 10000,
+                 max_line_length = 2000,
+                 flush_interval = 0.5,
+                 progress_interval = 5.0,
+                 ):
+        """
+        Args:
+            level:             Minimum level to output. Level name or number.
+            out:               File to write to.
+            max_queue:         Maximum number of messages waiting to be written.
+            max_line_length:   Longer messages are truncated.
+            flush_interval:    Maximum seconds between flushes of `out`.
+            progress_interval: Minimum seconds between `progress()` messages, per key.
+
+        The writer thread is started on first use, and restarted in forked child processes.
+        """
+        self.level = level_names.get(level, level)
+        self.out = out
+        self.max_queue = max_queue
+        self.max_line_length = max_line_length
+        self.flush_interval = flush_interval
+        self.progress_interval = progress_interval
+        self.progress_times = {}
+        self.num_dropped = 0
+        self.lock = Lock()
+        self.pid = False
+        self.queue = False
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def start(self):
+        with self.lock:
+            if self.pid != getpid():
+                self.queue = Queue(self.max_queue)
+                thread = Thread(target = self.run)
+                thread.daemon = True
+                thread.start()
+                self.pid = getpid()
+
+    def format(self, args):
+        if len(args) == 1:
+            s = str(args[0])
+        else:
+            s = str(args)
+        if len(s) > self.max_line_length:
+            s = s[:self.max_line_length] + '...[%d chars]' % len(s)
+        return s
+
+    def log(self, level, *args):
+        if level < self.level:
+            return
+
+        if self.pid != getpid():
+            self.start()
+
+        try:
+            self.queue.put_nowait(self.format(args))
+        except Full:
+            self.num_dropped += 1
+
+    def debug(self, *args):
+        if DEBUG >= self.level:
+            self.log(DEBUG, *args)
+
+    def info(self, *args):
+        if INFO >= self.level:
+            self.log(INFO, *args)
+
+    def warning(self, *args):
+        if WARNING >= self.level:
+            self.log(WARNING, *args)
+
+    def error(self, *args):
+        if ERROR >= self.level:
+            self.log(ERROR, *args)
+
+    def progress_due(self, key):
+        """
+        True if a `progress()` message for `key` would be output now, and records it as output. For per-record
+        call sites, to skip computing the message arguments:
+
+            if log.progress_due('ITER_WRAP'):
+                log.info('ITER_WRAP', 'per_sec:', nnn / (time() - t0))
+        """
+        if INFO < self.level:
+            return False
+
+        tm = time()
+
+        if tm - self.progress_times.get(key, 0) < self.progress_interval:
+            return False
+
+        self.progress_times[key] = tm
+
+        return True
+
+    def progress(self, key, *args):
+        """
+        INFO message, rate-limited to one per `progress_interval` seconds for each `key`.
+        """
+        if self.progress_due(key):
+            self.log(INFO, key, *args)
+
+    def write_lines(self, lines):
+        if self.num_dropped:
+            lines.append(str(('LOG_DROPPED', self.num_dropped)))
+            self.num_dropped = 0
+        self.out.write('\n'.join(lines) + '\n')
+
+    def run(self):
+        queue = self.queue
+
+        while True:
+            try:
+                lines = [queue.get(timeout = self.flush_interval)]
+            except Empty:
+                continue
+
+            while True:
+                try:
+                    lines.append(queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                self.write_lines(lines)
+                self.out.flush()
+            except Exception:
+                pass
+
+    def drain(self):
+        """
+        Write out everything still queued, from the calling thread. Called at exit.
+        """
+        if (self.queue is False) or (self.pid != getpid()):
+            return
+
+        lines = []
+        while True:
+            try:
+                lines.append(self.queue.get_nowait())
+            except Empty:
+                break
+
+        if lines or self.num_dropped:
+            self.write_lines(lines)
+
+        self.out.flush()
+
+
+log = Logger()
+
+atexit.register(log.drain)
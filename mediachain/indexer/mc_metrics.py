@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+Request latency metrics.
+
+Handlers time the stages of each request with a `SpanRecorder`. When the request finishes, the stage
+durations are added to per-process `Histogram`s. Histograms use fixed, log-spaced buckets, so histograms
+from all web worker processes can be merged by summing bucket counts.
+
+Each process periodically writes its histograms to `MC_METRICS_DIR`, and `Metrics.summary()` merges the
+recently written ones, for the `/metrics` endpoint.
+"""
+
+import mc_config
+import ujson
+from os import listdir, rename, makedirs, getpid
+from os.path import join, exists
+from time import time
+from math import log
+from contextlib import contextmanager
+
+
+## Bucket 0 is everything up to `bucket_min_ms`. Bucket `i` is up to `bucket_min_ms * bucket_factor ** i`.
+## Percentiles are reported as the geometric middle of their bucket, so are accurate to within 5%, up to ~3 hours:
+
+bucket_min_ms = 0.01
+bucket_factor = 1.1
+num_buckets = 220
+
+log_bucket_factor = log(bucket_factor)
+
+
+def bucket_num(ms):
+    if ms <= bucket_min_ms:
+        return 0
+    return min(num_buckets - 1, int(log(ms / bucket_min_ms) / log_bucket_factor) + 1)
+
+
+def bucket_middle_ms(i):
+    if i == 0:
+        return bucket_min_ms
+    return bucket_min_ms * (bucket_factor ** (i - 0.5))
+
+
+class Histogram(object):
+
+    def __init__(self,
+                 counts = False,
+                 total_ms = 0.0,
+                 max_ms = 0.0,
+                 ):
+        """
+        Args:
+            counts:   Sparse {bucket_num: count}, e.g. from `to_dict()`.
+            total_ms: Sum of all added values.
+            max_ms:   Largest added value.
+        """
+        self.counts = [0] * num_buckets
+        self.total_ms = total_ms
+        self.max_ms = max_ms
+
+        if counts:
+            for i, n in counts.iteritems():
+                self.counts[int(i)] += n
+
+    def add(self, ms):
+        self.counts[bucket_num(ms)] += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """
+        Middle of the bucket containing the `p`-th percentile, capped at the largest value seen.
+        """
+        nn = self.count()
+        if not nn:
+            return 0.0
+
+        target = p / 100.0 * nn
+        cur = 0
+        for i, n in enumerate(self.counts):
+            cur += n
+            if cur >= target:
+                return min(bucket_middle_ms(i), self.max_ms)
+        return self.max_ms
+
+    def summary(self):
+        nn = self.count()
+        return {'count':nn,
+                'mean_ms':nn and round(self.total_ms / nn, 3) or 0.0,
+                'p50_ms':round(self.percentile(50), 3),
+                'p95_ms':round(self.percentile(95), 3),
+                'p99_ms':round(self.percentile(99), 3),
+                'max_ms':round(self.max_ms, 3),
+                }
+
+    def to_dict(self):
+        return {'counts':{i:n for i, n in enumerate(self.counts) if n},
+                'total_ms':self.total_ms,
+                'max_ms':self.max_ms,
+                }
+
+
+class Metrics(object):
+
+    def __init__(self,
+                 metrics_dir = mc_config.MC_METRICS_DIR,
+                 flush_interval = mc_config.MC_METRICS_FLUSH_INTERVAL_INT,
+                 ):
+        """
+        Per-process latency histograms, keyed by 'endpoint.stage'.
+
+        Args:
+            metrics_dir:    Where each process periodically writes its histograms.
+            flush_interval: Minimum seconds between writes.
+        """
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self.histograms = {}
+        self.since = int(time())
+        self.last_flush = time()
+
+    def observe(self,
+                name,
+                ms,
+                ):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].add(ms)
+
+    def fn(self, pid):
+        return join(self.metrics_dir, 'metrics_%d.json' % pid)
+
+    def maybe_flush(self):
+        if time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Atomically write this process's histograms.
+        """
+
+        self.last_flush = time()
+
+        try:
+            if not exists(self.metrics_dir):
+                makedirs(self.metrics_dir)
+
+            fn = self.fn(getpid())
+
+            with open(fn + '.temp', 'w') as f:
+                f.write(ujson.dumps({'pid':getpid(),
+                                     'time':int(time()),
+                                     'since':self.since,
+                                     'histograms':{k:v.to_dict() for k,v in self.histograms.iteritems()},
+                                     }))
+
+            rename(fn + '.temp', fn)
+
+        except Exception as e:
+            print ('METRICS_FLUSH_FAILED', self.metrics_dir, e)
+
+    def summary(self,
+                all_processes = True,
+                max_age = 300,
+                ):
+        """
+        Percentile summaries of this process's histograms, merged with those of the other processes that
+        were written in the last `max_age` seconds, if `all_processes` is set.
+        """
+
+        merged = {}
+
+        for k, v in self.histograms.iteritems():
+            merged[k] = Histogram()
+            merged[k].merge(v)
+
+        pids = [getpid()]
+
+        if all_processes and exists(self.metrics_dir):
+
+            for fn in listdir(self.metrics_dir):
+
+                if not (fn.startswith('metrics_') and fn.endswith('.json')):
+                    continue
+
+                if fn == 'metrics_%d.json' % getpid():
+                    continue
+
+                try:
+                    with open(join(self.metrics_dir, fn)) as f:
+                        hh = ujson.loads(f.read())
+                except Exception as e:
+                    print ('BAD', fn, e)
+                    continue
+
+                if time() - hh['time'] > max_age:
+                    continue
+
+                pids.append(hh['pid'])
+
+                for k, v in hh['histograms'].iteritems():
+                    if k not in merged:
+                        merged[k] = Histogram()
+                    merged[k].merge(Histogram(**v))
+
+        return {'pids':pids,
+                'metrics':{k:v.summary() for k,v in merged.iteritems()},
+                }
+
+
+class SpanRecorder(object):
+
+    def __init__(self,
+                 metrics,
+                 endpoint,
+                 ):
+        """
+        Stage timings of one request. Stages recorded more than once are summed.
+
+        Args:
+            metrics:  `Metrics` to add the timings to, on `finish()`.
+            endpoint: Histogram name prefix. Can be changed before `finish()`, e.g. to separate cache hits.
+        """
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.t0 = time()
+        self.spans = {}
+        self.finished = False
+
+    def add(self,
+            name,
+            ms,
+            ):
+        self.spans[name] = self.spans.get(name, 0.0) + ms
+
+    @contextmanager
+    def span(self, name):
+        """
+        Time the enclosed block as stage `name`. Includes time spent waiting on yields inside the block.
+        """
+        t1 = time()
+        try:
+            yield
+        finally:
+            self.add(name, (time() - t1) * 1000)
+
+    def track(self,
+              name,
+              fut,
+              ):
+        """
+        Time Future `fut`, from now until it resolves, as stage `name`. Returns `fut`.
+        """
+        t1 = time()
+        fut.add_done_callback(lambda f: (not self.finished) and self.add(name, (time() - t1) * 1000))
+        return fut
+
+    def finish(self):
+        """
+        Add all stage timings, and the request total, to the histograms.
+        """
+
+        if self.finished:
+            return
+
+        self.finished = True
+
+        self.add('total', (time() - self.t0) * 1000)
+
+        for name, ms in self.spans.iteritems():
+            self.metrics.observe(self.endpoint + '.' + name, ms)
+
+        self.metrics.maybe_flush()
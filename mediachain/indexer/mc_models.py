@@ -744,10 +744,169 @@ def dedupe_reindex(lookup_name = False,
 
 
 
-def typeahead_generate():
+class TypeaheadIndex(object):
+    """
+    Weighted query completions. Queries are kept sorted by lowercased text, so every prefix maps to
+    a contiguous range found by binary search, along with cumulative weights for sampling queries in
+    proportion to their weight, also by binary search.
+
+    Completions of short prefixes, which match large ranges, are precomputed.
+    """
+
+    def __init__(self,
+                 queries,
+                 weights,
+                 top = False,
+                 top_prefix_length = 2,
+                 top_num = 20,
+                 ):
+        """
+        Args:
+            queries: Queries, sorted by `query.lower()`. See `TypeaheadIndex.from_weighted()`.
+            weights: Weight of each query.
+            top:     Precomputed {prefix: [query_num, ...]}, for all prefixes up to `top_prefix_length`.
+        """
+        self.queries = queries
+        self.keys = [x.lower() for x in queries]
+        self.weights = np.array(weights, dtype = np.float64)
+        self.cum_weights = np.cumsum(self.weights)
+
+        ## Multi-word queries, i.e. with 3+ words:
+
+        self.mwe = np.array([c for c, x in enumerate(queries) if x.count(' ') > 1], dtype = np.int64)
+        self.mwe_cum_weights = np.cumsum(self.weights[self.mwe])
+
+        self.top_prefix_length = top_prefix_length
+        self.top_num = top_num
+        
+        if top is False:
+            top = {}
+            for prefix in set([x[:n] for x in self.keys for n in xrange(1, top_prefix_length + 1)]):
+                top[prefix] = self.complete_range(prefix, top_num)
+        
+        self.top = top
+
+    @classmethod
+    def from_weighted(cls, rr, **kw):
+        """
+        Build from [(weight, query), ...]. Weights of duplicate queries are summed.
+        """
+        hh = {}
+        for weight, query in rr:
+            hh[query] = hh.get(query, 0) + weight
+        
+        queries = list(sorted(hh, key = lambda x: (x.lower(), x)))
+        
+        return cls(queries, [hh[x] for x in queries], **kw)
+
+    def prefix_range(self, prefix):
+        from bisect import bisect_left
+        prefix = prefix.lower()
+        return (bisect_left(self.keys, prefix),
+                bisect_left(self.keys, prefix + u'\uffff'),
+                )
+
+    def complete_range(self, prefix, num):
+        from heapq import nlargest
+        a, b = self.prefix_range(prefix)
+        return [c for w, c in nlargest(num, [(self.weights[c], c) for c in xrange(a, b)])]
+
+    def complete(self,
+                 prefix,
+                 num = 10,
+                 ):
+        """
+        Highest-weighted completions of `prefix`. Returns [(weight, query), ...].
+        """
+        
+        prefix = prefix.lower()
+
+        if num <= self.top_num:
+            if prefix in self.top:
+                rr = self.top[prefix][:num]
+            elif len(prefix) <= self.top_prefix_length:
+                ## All short prefixes with any completions are precomputed:
+                rr = []
+            else:
+                rr = self.complete_range(prefix, num)
+        elif prefix:
+            ## More completions than were precomputed:
+            rr = self.complete_range(prefix, num)
+        else:
+            rr = []
+        
+        return [(float(self.weights[c]), self.queries[c]) for c in rr]
+
+    def sample(self,
+               only_mwe = False,
+               weighted = True,
+               ):
+        """
+        Random query, chosen in proportion to its weight if `weighted`, else uniformly.
+        """
+        
+        if only_mwe:
+            if not len(self.mwe):
+                return False
+            if weighted:
+                c = self.mwe[np.searchsorted(self.mwe_cum_weights, np.random.uniform(0, self.mwe_cum_weights[-1]), side = 'right')]
+            else:
+                c = self.mwe[np.random.randint(len(self.mwe))]
+        else:
+            if not len(self.queries):
+                return False
+            if weighted:
+                c = np.searchsorted(self.cum_weights, np.random.uniform(0, self.cum_weights[-1]), side = 'right')
+            else:
+                c = np.random.randint(len(self.queries))
+
+        return self.queries[min(c, len(self.queries) - 1)]
+
+    def save(self, fn):
+        """
+        Atomically write to `fn`.
+        """
+        from os import rename
+        
+        with open(fn + '.temp', 'w') as f:
+            f.write(json.dumps({'queries':self.queries,
+                                'weights':self.weights.tolist(),
+                                'top_prefix_length':self.top_prefix_length,
+                                'top_num':self.top_num,
+                                'top':self.top,
+                                }))
+        rename(fn + '.temp', fn)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn) as f:
+            hh = json.loads(f.read())
+        return cls(**hh)
+
+
+def iter_typeahead_tsv(tsv_path = mc_config.MC_TYPEAHEAD_TSV_PATH):
+    """
+    Yields (weight, query) from typeahead TSV lines of "weight<TAB>query<TAB>...".
+    """
+    with open(tsv_path) as f:
+        for line in f:
+            try:
+                score, query, _ = line.split('\t')
+                yield int(score), query.decode('utf8')
+            except ValueError:
+                continue
+
+
+def typeahead_generate(tsv_path = mc_config.MC_TYPEAHEAD_TSV_PATH,
+                       index_path = mc_config.MC_TYPEAHEAD_INDEX_PATH,
+                       via_cli = False,
+                       ):
     """
     Re-generate typeahead search. This consists of a weighted set of completions for every possible query.
 
+    Currently the weights are the query frequencies from `tsv_path`. The `TypeaheadIndex` is saved
+    to `index_path`, and served by the `/typeahead` and `/random_query` endpoints.
+
     Weighing ideas:
         - query frequency.
         - query results quality / count.
@@ -757,27 +916,35 @@ def typeahead_generate():
           Is that approach really better in a clustered setup?
     """
     
-    assert False,'WIP'
+    from time import time
+
+    t0 = time()
     
-    if mc_config.LOW_LEVEL:
-        es = mc_neighbors.low_level_es_connect()    
-        
-        res = scan(client = es,
-                   index = index_name,
-                   doc_type = doc_type,
-                   scroll = '5m', #TODO - hard coded.
-                   query = {"query": {'match_all': {}
-                                     },
-                           #'from':0,
-                           #'size':1,                           
-                           },
-                   )
-    else:
-        nes = mc_neighbors.high_level_connect(index_name = index_name,
-                                              doc_type = doc_type,
-                                              )
-        
-        res = nes.scan_all()
+    ti = TypeaheadIndex.from_weighted(iter_typeahead_tsv(tsv_path))
+    
+    ti.save(index_path)
+    
+    print ('TYPEAHEAD_GENERATED', index_path, 'queries:', len(ti.queries), 'mwe:', len(ti.mwe), 'prefixes:', len(ti.top), time() - t0)
+    
+    return ti
+
+
+def load_typeahead_index(index_path = mc_config.MC_TYPEAHEAD_INDEX_PATH,
+                         tsv_path = mc_config.MC_TYPEAHEAD_TSV_PATH,
+                         ):
+    """
+    Load the `TypeaheadIndex` written by `typeahead_generate()`, or build it directly from `tsv_path` if
+    it hasn't been generated yet.
+    """
+    
+    from os.path import exists
+
+    if exists(index_path):
+        return TypeaheadIndex.load(index_path)
+
+    print ('TYPEAHEAD_INDEX_NOT_FOUND', index_path, 'building from', tsv_path)
+    
+    return TypeaheadIndex.from_weighted(iter_typeahead_tsv(tsv_path))
 
 
 functions=['dedupe_train',
@@ -15,6 +15,7 @@ from math import sqrt, log, floor, ceil
 import struct
 
 import mc_config
+from mc_log import log as mc_log
 
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import parallel_bulk as es_parallel_bulk, scan as es_scan
@@ -693,7 +694,7 @@ class ElasticSearchNN(NearestNeighborsBase):
         
         for hh in the_iter:
 
-            print 'NON_PARALLEL_BULK',hh
+            mc_log.debug('NON_PARALLEL_BULK', hh)
             
             xaction = hh['_op_type']
             xindex = hh['_index']
@@ -704,7 +705,7 @@ class ElasticSearchNN(NearestNeighborsBase):
                 if k.startswith('_'):
                     del hh[k]
                         
-            print 'BODY',hh
+            mc_log.debug('BODY', hh)
 
             if xaction == 'index':
                 res = self.es.index(index = xindex, doc_type = xtype, id = xid, body = hh)
@@ -713,14 +714,14 @@ class ElasticSearchNN(NearestNeighborsBase):
             else:
                 assert False,repr(xaction)
             
-            print 'DONE-NON_PARALLEL_BULK',xaction,xid
+            mc_log.debug('DONE-NON_PARALLEL_BULK', xaction, xid)
             
             yield True,res
 
             try:
                 self.es.indices.refresh(index = xindex)
             except:
-                print 'REFRESH_ERROR'
+                mc_log.error('REFRESH_ERROR', xindex)
             
             try:
                 import mc_models
@@ -730,9 +731,9 @@ class ElasticSearchNN(NearestNeighborsBase):
                                              vectors_model = name,
                                              )
             except:
-                print 'REINDEX_ERROR'
+                mc_log.error('REINDEX_ERROR', xindex)
             
-            print 'REFRESHED'
+            mc_log.debug('REFRESHED', xid)
         
         print 'EXIT-LOOP_NON_PARALLEL_BULK'
     
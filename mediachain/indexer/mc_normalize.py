@@ -10,7 +10,9 @@ Future:
 
 """
 
+import re
 import urlparse
+import mc_config
 
 def walk_json_leaves(hh, path = []):
     """yields (path, value) tuples"""
@@ -1898,6 +1900,147 @@ def apply_normalizer_for_simpleclient(iter_json,
         yield {'raw': dumps(orig), 'metadata': x}
 
 
+## Post-ingestion rules. Each rule is `(match, token, func)`: it applies to native IDs that start with
+## `token` if `match` is 'prefix', or that contain `token` anywhere if `match` is 'contains'. `func(ii, native_id)`
+## modifies the hit in place.
+
+def _strip_url_scheme(x):
+    for pre in ['https://', 'http://', 'www.']:
+        if x.startswith(pre):
+            x = x[len(pre):]
+    return x
+
+
+def _post_pexels_title(ii, native_id):
+    ii['_source']['title'] = None
+
+
+def _post_pexels(ii, native_id):
+    source_tags = ['pexels.com']
+
+    if ii['_source'].get('source',{}).get('name'):
+        source_tags.append(ii['_source']['source']['name'])
+
+    ii['_source']['source_tags'] = list(set([_strip_url_scheme(x) for x in source_tags]))
+
+    ii['_source']['license_tags'] = ['CC0']
+    ii['_source']['license_name'] = "CC0"
+    ii['_source']['license_name_long'] = "Creative Commons Zero (CC0)"
+    ii['_source']['license_url'] = None
+    ii['_source']['license_attribution'] = ii.get('artist_names') and ', '.join(ii['artist_names']) or None
+
+
+def _post_getty(ii, native_id):
+    
+    ## add permalinks here:
+    
+    ii['_source']['source']['url'] = 'http://www.gettyimages.com/detail/photo/permalink/' + native_id.replace('getty_','')
+    
+    ii['_source']['source_tags'] = ['gettyimages.com']
+
+    ii['_source']['license_tags'] = ['Non-Commercial Use']
+    ii['_source']['license_name'] = "Getty Embed"
+    ii['_source']['license_name_long'] = "Getty Embed"
+    ii['_source']['license_url'] = "http://www.gettyimages.com/Corporate/LicenseAgreements.aspx#RF"
+    ii['_source']['license_attribution'] = ii.get('artist_names') and ', '.join(ii['artist_names']) or None
+
+
+def _post_dpla(ii, native_id):
+    ii['_source']['source_tags'] = ['dp.la']
+
+
+def _post_flickr(ii, native_id):
+    ii['_source']['source_tags'] = ['flickr.com']
+
+
+def _post_500px(ii, native_id):
+    ii['_source']['source_tags'] = ['500px.com']
+
+
+def _post_eyeem(ii, native_id):
+    
+    ## TODO - fake sizes, remove when re-ingestion is complete:
+    
+    assert 'sizes' in ii['_source'],repr(ii['_source'])
+
+
+post_ingestion_rules = [('prefix', 'pexels', _post_pexels_title),
+                        ('contains', 'pexels_', _post_pexels),
+                        ('contains', 'dpla_', _post_dpla),
+                        ('contains', 'getty_', _post_getty),
+                        ('contains', 'flickr', _post_flickr),
+                        ('contains', '500px_', _post_500px),
+                        ('contains', 'eyeem_', _post_eyeem),
+                        ]
+
+def post_ingestion_rules_scan(native_id):
+    """
+    Rule functions that apply to `native_id`, by testing each rule in order.
+    """
+    return [func
+            for match, token, func
+            in post_ingestion_rules
+            if (native_id.startswith(token) if match == 'prefix' else (token in native_id))
+            ]
+
+## Rule tokens can only span the first '_' of a native ID at their own end, so the rules matching
+## "<source>_<rest>" are those matching "<source>_", plus those matching within <rest>:
+
+post_ingestion_tokens_re = re.compile('|'.join([re.escape(token) for match, token, func in post_ingestion_rules]))
+
+## {"<source>_": [rule func, ...]}, filled in lazily by `post_ingestion_rules_for()`:
+
+post_ingestion_dispatch = {}
+
+def post_ingestion_rules_for(native_id):
+    """
+    Return the post-ingestion rule functions for `native_id`, from a table keyed by its source prefix,
+    e.g. "getty_" for "getty_123456". Native IDs without a prefix, or with a rule token after it, are scanned.
+    """
+    
+    pre, sep, rest = native_id.partition('_')
+    
+    if (not sep) or post_ingestion_tokens_re.search(rest):
+        return post_ingestion_rules_scan(native_id)
+    
+    pre += sep
+    
+    rules = post_ingestion_dispatch.get(pre)
+    
+    if rules is None:
+        rules = post_ingestion_rules_scan(pre)
+        post_ingestion_dispatch[pre] = rules
+    
+    return rules
+
+
+## Fields written by `apply_post_ingestion_normalizers()`, and fields it removes for the 'new' schema:
+
+post_ingestion_fields = ['title', 'source', 'source_tags', 'sizes', 'max_width', 'node_id',
+                         'license_tags', 'license_name', 'license_name_long', 'license_url', 'license_attribution',
+                         'artist_name', 'date_created', 'license', 'origin', 'image_url',
+                         ]
+
+## Fields of the 'new' schema that are derived at query time, even for documents stamped by `normalize_reindex()`,
+## because the ingested documents already map them with a different type, e.g. `origin` as a string:
+
+post_ingestion_query_time_fields = ['date_created', 'license', 'origin', 'image_url']
+
+post_ingestion_superseded = ['artist_names', 'date_created_original', 'date_created_at_source', 'licenses',
+                             'url_shown_at', 'url_direct_cache',
+                             ]
+
+## Bump to invalidate all documents stamped by `normalize_reindex()`:
+
+post_ingestion_version = 2
+
+## Documents already normalized by `normalize_reindex()` store their version in this field:
+
+post_ingestion_version_field = 'post_ingestion_version'
+
+def post_ingestion_version_key(schema_variant):
+    return '%s:%d' % (schema_variant, post_ingestion_version)
+
 def apply_post_ingestion_normalizers(rr,
                                      schema_variant = 'old',
                                      cache_key = 'v=1',
@@ -1912,168 +2055,248 @@ def apply_post_ingestion_normalizers(rr,
     
     TODO - 
         Do both pre-ingestion and post-ingestion normalization?
+
+    Documents already stamped with the current version by `normalize_reindex()` only get the
+    query-time parts: `post_ingestion_query_time_fields`, and removal of superseded fields.
     """
 
     #print ('schema_variant',schema_variant)
+
+    version_key = post_ingestion_version_key(schema_variant)
     
     for ii in rr:
-        native_id = ''
-        try:
-            native_id = ii['_source']['native_id']
-        except:
-            ## Likely images that didn't go through the mc_normalizers path and don't have `native_id`s.
-            pass
 
-        if native_id.startswith('pexels'):
-            ii['_source']['title'] = None
+        if ii['_source'].pop(post_ingestion_version_field, None) == version_key:
+            
+            if schema_variant == 'new':
+                post_ingestion_query_time(ii)
+                
+                for xx in post_ingestion_superseded:
+                    ii['_source'].pop(xx, None)
+            continue
+        
+        apply_post_ingestion_normalizers_one(ii, schema_variant = schema_variant)
 
-        ## add permalinks here:
 
-        if 'getty_' in native_id:
-            ii['_source']['source']['url'] = 'http://www.gettyimages.com/detail/photo/permalink/' + native_id.replace('getty_','')
-            
-        if False:#'pexels_' in native_id:
-            ii['_source']['source']['url'] = ii['url_shown_at']['url']
+def post_ingestion_query_time(ii):
+    """
+    Derive the 'new' schema `post_ingestion_query_time_fields` of a hit, in place, from its stored fields.
+    """
+    
+    ii['_source']['date_created'] = ii['_source'].get('date_created_original') or ii['_source'].get('date_created_at_source') or None
 
-        ##
+    if ii['_source'].get('licenses'):
 
-        if ii['_source'].get('source',{}).get('name') == 'flickr.com':
-            ii['_source']['source']['name'] = 'flickr'
-            
-        ## license stuff:
-        
-        if 'pexels_' in native_id:
-            source_tags = ['pexels.com']
-        
-            if ii['_source'].get('source',{}).get('name'):
-                source_tags.append(ii['_source']['source']['name'])
-            
-            source_tags = list(set([(x[len('https://'):] if x.startswith('https://') else x) for x in source_tags]))
-            source_tags = list(set([(x[len('http://'):] if x.startswith('http://') else x) for x in source_tags]))
-            source_tags = list(set([(x[len('www.'):] if x.startswith('www.') else x) for x in source_tags]))
-            
-            ii['_source']['source_tags'] = source_tags
-            
-            ii['_source']['license_tags'] = ['CC0']
-            ii['_source']['license_name'] = "CC0"
-            ii['_source']['license_name_long'] = "Creative Commons Zero (CC0)"
-            ii['_source']['license_url'] = None
-            ii['_source']['license_attribution'] = ii.get('artist_names') and ', '.join(ii['artist_names']) or None
-            
-        if 'dpla_' in native_id:            
-            ii['_source']['source_tags'] = ['dp.la']
-            
-        if 'getty_' in native_id:
-            ii['_source']['source_tags'] = ['gettyimages.com']
-            
-            ii['_source']['license_tags'] = ['Non-Commercial Use']
-            ii['_source']['license_name'] = "Getty Embed"
-            ii['_source']['license_name_long'] = "Getty Embed"
-            ii['_source']['license_url'] = "http://www.gettyimages.com/Corporate/LicenseAgreements.aspx#RF"
-            ii['_source']['license_attribution'] = ii.get('artist_names') and ', '.join(ii['artist_names']) or None
-            
-        if 'flickr' in native_id:
-            ii['_source']['source_tags'] = ['flickr.com']
-            
-        if '500px_' in native_id:
-            ii['_source']['source_tags'] = ['500px.com']
-            
-        if 'eyeem_' in native_id:
+        ii['_source']['license'] = ii['_source']['licenses'][0]
+        ii['_source']['license']['url'] = ii['_source'].get('license_url')
 
-            ## TODO - fake sizes, remove when re-ingestion is complete:
+        if ii['_source']['license'].get('name') == 'CC0':
+            ii['_source']['license']['url'] = 'https://creativecommons.org/publicdomain/zero/1.0/'
 
-            assert 'sizes' in ii['_source'],repr(ii['_source'])
-            
-            if 'sizes' not in ii['_source']:
-                
-                sizes = [{'width':1920,                   # fake width
-                          'height':1280,                  # fake height
-                          'dpi':None,                     # DPI - Use to estimate real-world width / height if needed?
-                          'bytes':None,                   # bytes size of this version
-                          'content_type':'image/jpeg',    # Image mime-type
-                          'uri_external':None,            # External URI.
-                          }
-                         ]
+        if ii['_source']['license'].get('name_long') == 'Getty Embed':
+            ii['_source']['license']['url'] = 'http://www.gettyimages.com/company/terms'
 
-                ii['_source']['sizes'] = sizes
-        
-        if schema_variant == 'new':
-            ## New Schema Format
-            ## See: https://rawgit.com/mediachain/mediachain-indexer/master/doc/index.html
+    else:
+        ii['_source']['license'] = None
 
-            if not ii['_source'].get('artist_name'):
-                try:
-                    if ii['_source'].get('artist_names') and (type(ii['_source'].get('artist_names')[0]) == list):
-                        ii['_source']['artist_name'] = ', '.join(ii['_source']['artist_names'][0])
-                    else:
-                        ii['_source']['artist_name'] = ', '.join(ii['_source']['artist_names']) if ii['_source'].get('artist_names') else None
-                except:
-                    print repr(ii['_source'].get('artist_names'))
-                    ii['_source']['artist_name'] = None
-            
-            ii['_source']['date_created'] = ii['_source'].get('date_created_original') or ii['_source'].get('date_created_at_source') or None
+    if ii['_source'].get('url_shown_at',{}).get('url'):
+        ii['_source']['origin'] = {'url': ii['_source']['url_shown_at']['url']}
+        ii['_source']['origin']['name'] = urlparse.urlsplit(ii['_source']['url_shown_at']['url']).netloc
+    else:
+        ii['_source']['origin'] = None
 
-            if ii['_source']['title'] and ii['_source']['title'][0]:
-                
-                if isinstance(ii['_source']['title'], basestring):
-                    ii['_source']['title'] = ii['_source']['title']
+    ii['_source']['image_url'] = ii['_source']['url_direct_cache']['url']
+
+
+def apply_post_ingestion_normalizers_one(ii,
+                                         schema_variant = 'old',
+                                         ):
+    """
+    Apply the post-ingestion normalizers to a single hit, in place. See `apply_post_ingestion_normalizers()`.
+    """
+    
+    native_id = ''
+    try:
+        native_id = ii['_source']['native_id']
+    except:
+        ## Likely images that didn't go through the mc_normalizers path and don't have `native_id`s.
+        pass
+
+    if ii['_source'].get('source',{}).get('name') == 'flickr.com':
+        ii['_source']['source']['name'] = 'flickr'
+    
+    for func in post_ingestion_rules_for(native_id):
+        func(ii, native_id)
+    
+    if schema_variant == 'new':
+        ## New Schema Format
+        ## See: https://rawgit.com/mediachain/mediachain-indexer/master/doc/index.html
+
+        if not ii['_source'].get('artist_name'):
+            try:
+                if ii['_source'].get('artist_names') and (type(ii['_source'].get('artist_names')[0]) == list):
+                    ii['_source']['artist_name'] = ', '.join(ii['_source']['artist_names'][0])
                 else:
-                    ii['_source']['title'] = ' '.join(ii['_source']['title'])
-            
-            else:
-                ii['_source']['title'] = None
-            
-            if ii['_source'].get('licenses'):
-                                
-                ii['_source']['license'] = ii['_source']['licenses'][0]
-                ii['_source']['license']['url'] = ii['_source'].get('license_url')
-
-                if ii['_source']['license'].get('name') == 'CC0':
-                    ii['_source']['license']['url'] = 'https://creativecommons.org/publicdomain/zero/1.0/'
-                    
-                if ii['_source']['license'].get('name_long') == 'Getty Embed':
-                    ii['_source']['license']['url'] = 'http://www.gettyimages.com/company/terms'
-                
-            else:
-                ii['_source']['license'] = None
-            
-            if ii['_source'].get('url_shown_at',{}).get('url'):
-                ii['_source']['origin'] = {'url': ii['_source']['url_shown_at']['url']}
-                ii['_source']['origin']['name'] = urlparse.urlsplit(ii['_source']['url_shown_at']['url']).netloc
+                    ii['_source']['artist_name'] = ', '.join(ii['_source']['artist_names']) if ii['_source'].get('artist_names') else None
+            except:
+                print repr(ii['_source'].get('artist_names'))
+                ii['_source']['artist_name'] = None
+
+        if ii['_source']['title'] and ii['_source']['title'][0]:
+
+            if isinstance(ii['_source']['title'], basestring):
+                ii['_source']['title'] = ii['_source']['title']
             else:
-                ii['_source']['origin'] = None
-            
-            ii['_source']['image_url'] = ii['_source']['url_direct_cache']['url'] #+ '?' + cache_key
+                ii['_source']['title'] = ' '.join(ii['_source']['title'])
 
-            ## Blockchain getty stuff:
-            
-            if ii['_source'].get('artist') and (not ii['_source']['artist_name']):
-                ii['_source']['artist_name'] = ii['_source']['artist']
+        else:
+            ii['_source']['title'] = None
 
-            ## TODO - license for blockchain getty.
-            
-            ## Delete superseded:
-            
-            for kk in ['artist_names', 'date_created_original', 'date_created_at_source', 'licenses',
-                       'url_shown_at', 'url_direct_cache',
-                       ]:
-                if kk in ii['_source']:
-                    del ii['_source'][kk]
+        post_ingestion_query_time(ii)
 
-        if ii['_source'].get('sizes') and len(ii['_source'].get('sizes')):
-            ii['_source']['max_width'] = max([x.get('width',0) for x in ii['_source']['sizes']])
+        ## Blockchain getty stuff:
+
+        if ii['_source'].get('artist') and (not ii['_source']['artist_name']):
+            ii['_source']['artist_name'] = ii['_source']['artist']
+
+        ## TODO - license for blockchain getty.
+
+        ## Delete superseded:
+
+        for kk in post_ingestion_superseded:
+            if kk in ii['_source']:
+                del ii['_source'][kk]
+
+    if ii['_source'].get('sizes') and len(ii['_source'].get('sizes')):
+        ii['_source']['max_width'] = max([x.get('width',0) for x in ii['_source']['sizes']])
 
     """
     flickr: QmZ6dckUhRouVr6AsBTpK6vMLVpcz1KAeJAJVQEZQ5gCek
     everything else: QmeiY2eHMwK92Zt6X4kUUC3MsjMmVb2VnGZ17DhnhRPCEQ
     """
-    for ii in rr:
-        if ii['_source']['source_dataset'] == 'flickr100mm':
-            ii['_source']['node_id'] = 'QmZ6dckUhRouVr6AsBTpK6vMLVpcz1KAeJAJVQEZQ5gCek'
-        else:
-            ii['_source']['node_id'] = 'QmeiY2eHMwK92Zt6X4kUUC3MsjMmVb2VnGZ17DhnhRPCEQ'
+    if ii['_source']['source_dataset'] == 'flickr100mm':
+        ii['_source']['node_id'] = 'QmZ6dckUhRouVr6AsBTpK6vMLVpcz1KAeJAJVQEZQ5gCek'
+    else:
+        ii['_source']['node_id'] = 'QmeiY2eHMwK92Zt6X4kUUC3MsjMmVb2VnGZ17DhnhRPCEQ'
+            
+    
+def normalize_reindex(index_name = mc_config.MC_INDEX_NAME,
+                      doc_type = mc_config.MC_DOC_TYPE,
+                      schema_variant = 'new',
+                      batch_size = 500,
+                      num_threads = 0,
+                      force = False,
+                      via_cli = False,
+                      ):
+    """
+    Apply the post-ingestion normalizers to all stored documents, and stamp each one with the
+    current `post_ingestion_version_key()`, so search no longer has to normalize them per request.
+
+    Each shard is scrolled and bulk-updated in its own thread, via `preference=_shards:N`.
+    Superseded fields are left in the stored documents, and are still dropped at query time.
+
+    Args:
+        schema_variant: Schema variant to normalize for. Documents are only skipped at query time for this variant.
+        num_threads:    Number of shards to process at once. Defaults to the number of shards.
+        force:          Re-normalize documents already stamped with the current version.
+    """
+    
+    from elasticsearch.helpers import scan, streaming_bulk
+    from multiprocessing.pool import ThreadPool
+    from mc_neighbors import low_level_es_connect
+    from mc_ingest import lookup_cached_image
+    from time import time
+    
+    es = low_level_es_connect()
+    
+    num_shards = int(es.indices.get_settings(index = index_name).values()[0]['settings']['index']['number_of_shards'])
+    
+    version_key = post_ingestion_version_key(schema_variant)
+    
+    print ('NORMALIZE_REINDEX', index_name, doc_type, version_key, 'shards:', num_shards)
+
+    query = {"query": {"match_all": {}}}
+
+    if not force:
+        query = {"query": {"bool": {"must_not": {"term": {post_ingestion_version_field: version_key}}}}}
+    
+    def iter_updates(shard):
+        
+        for c, hit in enumerate(scan(client = es,
+                                     index = index_name,
+                                     doc_type = doc_type,
+                                     scroll = '10m',
+                                     size = batch_size,
+                                     preference = '_shards:%d' % shard,
+                                     query = query,
+                                     _source_exclude = ['image_thumb', 'thumbnail_base64', 'dedupe_*'],
+                                     )):
+            
+            if c % 10000 == 0:
+                print ('NORMALIZE_REINDEX_SHARD', shard, c)
+
+            ## In case the version field was mapped as an analyzed string, and the query couldn't filter it:
+            
+            if (not force) and (hit['_source'].get(post_ingestion_version_field) == version_key):
+                continue
+            
+            urls = lookup_cached_image(_id = hit['_id'],
+                                       do_sizes = ['1024x1024',],
+                                       )
+            
+            hit['_source']['url_direct_cache'] = {'url':urls['1024x1024']}
+            
+            apply_post_ingestion_normalizers([hit],
+                                             schema_variant = schema_variant,
+                                             )
             
+            doc = {xx:hit['_source'][xx]
+                   for xx
+                   in post_ingestion_fields
+                   if (xx in hit['_source']) and (xx not in post_ingestion_query_time_fields)
+                   }
+            
+            doc[post_ingestion_version_field] = version_key
+            
+            yield {'_op_type': 'update',
+                   '_index': index_name,
+                   '_type': doc_type,
+                   '_id': hit['_id'],
+                   'doc': doc,
+                   }
+    
+    def do_shard(shard):
+        nn = 0
+        nf = 0
+        for is_success, res in streaming_bulk(es,
+                                              iter_updates(shard),
+                                              chunk_size = batch_size,
+                                              raise_on_error = False,
+                                              ):
+            nn += 1
+            if not is_success:
+                nf += 1
+                if nf <= 10:
+                    print ('NORMALIZE_REINDEX_FAILED', shard, res)
+        
+        print ('NORMALIZE_REINDEX_SHARD_DONE', shard, 'updated:', nn - nf, 'failed:', nf)
+        return nn, nf
+    
+    t0 = time()
+    
+    pool = ThreadPool(num_threads or num_shards)
     
+    rr = pool.map(do_shard, range(num_shards))
+
+    pool.close()
+    
+    print ('NORMALIZE_REINDEX_DONE', version_key,
+           'updated:', sum([x[0] - x[1] for x in rr]),
+           'failed:', sum([x[1] for x in rr]),
+           'time:', int(time() - t0),
+           )
+    
+
 def dump_normalized_schemas(dir_in = '/datasets/datasets/compactsplit/',
                             fn_out = '/datasets/datasets/schemas_normalized.js',
                             via_cli = False,
@@ -2180,6 +2403,7 @@ from mc_generic import setup_main, raw_input_enter, space_pad
 
 
 functions=['dump_normalized_schemas',
+           'normalize_reindex',
            ]
 
 
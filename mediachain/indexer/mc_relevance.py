@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+Neural relevance scoring off the IOLoop.
+
+Search handlers submit (query, hits) pairs and get back a Tornado Future. A single worker thread
+collects the submissions of concurrent requests into micro-batches, and scores each batch with one
+call to the batch scoring function, if the model provides one.
+"""
+
+import tornado.ioloop
+from tornado.concurrent import Future
+from Queue import Queue, Empty
+from threading import Thread, Lock
+from time import time
+import sys
+
+
+class RelevanceBatcher(object):
+
+    def __init__(self,
+                 score_one,
+                 score_batch = False,
+                 max_batch = 16,
+                 max_wait = 0.005,
+                 ):
+        """
+        Args:
+            score_one:   `score_one(q_text, hits, **kw)`, e.g. `get_neural_relevance`.
+            score_batch: Optional `score_batch([(q_text, hits, kw), ...])`, returning a list of `score_one` results.
+                         If not available, each item of a batch is scored with `score_one`.
+            max_batch:   Maximum number of submissions per batch.
+            max_wait:    Seconds to wait for more submissions, after the first submission of a batch.
+
+        The worker thread is started on first use, so that it is created after web workers are forked.
+        """
+        self.score_one = score_one
+        self.score_batch = score_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.thread = False
+        self.lock = Lock()
+
+    def submit(self,
+               q_text,
+               hits,
+               **kw):
+        """
+        Queue `hits` for scoring against `q_text`. Returns a Future of the `score_one` result.
+        """
+
+        if not self.thread:
+            with self.lock:
+                if not self.thread:
+                    self.thread = Thread(target = self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+        fut = Future()
+        self.queue.put((q_text, hits, kw, fut, tornado.ioloop.IOLoop.current()))
+        return fut
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+
+        deadline = time() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout = remaining))
+            except Empty:
+                break
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = []
+            try:
+                batch = self.next_batch()
+                self.run_batch(batch)
+            except Exception:
+                ## Keep the only worker thread alive, and fail the batch instead of leaving its callers waiting:
+                exc_info = sys.exc_info()
+                print ('RELEVANCE_WORKER_ERROR', repr(exc_info[1]))
+                for q_text, hits, kw, fut, io_loop in batch:
+                    try:
+                        io_loop.add_callback(resolve, fut.set_exc_info, fut, exc_info)
+                    except Exception:
+                        pass
+
+    def run_batch(self, batch):
+        results = False
+
+        if self.score_batch and (len(batch) > 1):
+            try:
+                results = self.score_batch([(q_text, hits, kw) for q_text, hits, kw, fut, io_loop in batch])
+            except Exception as e:
+                print ('RELEVANCE_BATCH_ERROR', e)
+                results = False
+
+            if (results is not False) and (len(results) != len(batch)):
+                print ('RELEVANCE_BATCH_ERROR', 'got %d results for %d submissions' % (len(results), len(batch)))
+                results = False
+
+        for c, (q_text, hits, kw, fut, io_loop) in enumerate(batch):
+
+            if results is not False:
+                io_loop.add_callback(resolve, fut.set_result, fut, results[c])
+                continue
+
+            try:
+                rr = self.score_one(q_text, hits, **kw)
+            except Exception:
+                io_loop.add_callback(resolve, fut.set_exc_info, fut, sys.exc_info())
+                continue
+
+            io_loop.add_callback(resolve, fut.set_result, fut, rr)
+
+
+def resolve(set_func, fut, value):
+    """
+    Resolve `fut` on its IOLoop, unless it already was, e.g. before a later failure of the same batch.
+    """
+    if not fut.done():
+        set_func(value)
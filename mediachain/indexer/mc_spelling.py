@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Spelling suggestions for query correction.
+
+SymSpell-style deletion index over a fixed vocabulary: every word is indexed under all the strings
+obtained by deleting up to `max_distance` characters from its prefix. A misspelled word is looked up
+by generating its own deletes, so candidates are found with a few dict lookups instead of a scan of
+the vocabulary. Candidates are then verified with the real edit distance.
+
+Indexes are built once per vocabulary, and persisted to `MC_SPELLING_INDEX_DIR`.
+"""
+
+import mc_config
+import marshal
+import hashlib
+from os import rename, makedirs
+from os.path import exists, join
+from time import time
+from difflib import SequenceMatcher
+from editdistance import eval as eval_dist
+
+
+class SpellingIndex(object):
+
+    def __init__(self,
+                 words,
+                 max_distance = 2,
+                 prefix_length = 7,
+                 deletes = False,
+                 ):
+        """
+        Args:
+            words:         Vocabulary.
+            max_distance:  Maximum edit distance of suggestions.
+            prefix_length: Only deletes of this many leading characters are indexed.
+            deletes:       Precomputed {delete: [word_num, ...]}, e.g. from `load()`. Built from `words` if not passed.
+        """
+        self.words = list(sorted(set(words)))
+        self.word_set = set(self.words)
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+
+        if deletes is False:
+            deletes = {}
+            for c, w in enumerate(self.words):
+                for d in self.get_deletes(w[:prefix_length]):
+                    if d in deletes:
+                        deletes[d].append(c)
+                    else:
+                        deletes[d] = [c]
+
+        self.deletes = deletes
+
+    def get_deletes(self, w):
+        """
+        `w`, and all strings that are up to `max_distance` deletions away from `w`.
+        """
+        rr = set([w])
+        cur = [w]
+        for dist in xrange(self.max_distance):
+            nxt = []
+            for x in cur:
+                if len(x) <= 1:
+                    continue
+                for i in xrange(len(x)):
+                    y = x[:i] + x[i + 1:]
+                    if y not in rr:
+                        rr.add(y)
+                        nxt.append(y)
+            cur = nxt
+        return rr
+
+    def lookup(self,
+               word,
+               num = 4,
+               cutoff = 0.5,
+               ):
+        """
+        Vocabulary words within `max_distance` edits of `word`, and with a `difflib` similarity ratio of
+        at least `cutoff`, best `num` first by ratio. Same ordering as `difflib.get_close_matches()`.
+
+        Returns [(edit_distance, word), ...]
+        """
+
+        nums = set()
+        for d in self.get_deletes(word[:self.prefix_length]):
+            nums.update(self.deletes.get(d, ()))
+
+        sm = SequenceMatcher()
+        sm.set_seq2(word)
+
+        rr = []
+        for c in nums:
+            w2 = self.words[c]
+
+            if abs(len(w2) - len(word)) > self.max_distance:
+                continue
+
+            dist = eval_dist(word, w2)
+
+            if dist > self.max_distance:
+                continue
+
+            sm.set_seq1(w2)
+
+            if sm.real_quick_ratio() >= cutoff and sm.quick_ratio() >= cutoff:
+                ratio = sm.ratio()
+                if ratio >= cutoff:
+                    rr.append((ratio, w2, dist))
+
+        rr.sort(reverse = True)
+
+        return [(dist, w2) for ratio, w2, dist in rr[:num]]
+
+    def save(self, fn):
+        """
+        Atomically write to `fn`.
+        """
+        with open(fn + '.temp', 'wb') as f:
+            marshal.dump({'words':self.words,
+                          'max_distance':self.max_distance,
+                          'prefix_length':self.prefix_length,
+                          'deletes':self.deletes,
+                          },
+                         f,
+                         )
+        rename(fn + '.temp', fn)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'rb') as f:
+            hh = marshal.load(f)
+        return cls(**hh)
+
+
+def vocabulary_hash(words):
+    return hashlib.md5(u'\n'.join(sorted(words)).encode('utf8')).hexdigest()
+
+
+## {id(word_dict): SpellingIndex}, one per vocabulary per process:
+
+spelling_indexes = {}
+
+def get_spelling_index(word_dict,
+                       index_dir = mc_config.MC_SPELLING_INDEX_DIR,
+                       max_distance = 2,
+                       prefix_length = 7,
+                       ):
+    """
+    Return the `SpellingIndex` for vocabulary `word_dict`, loading it from `index_dir`, or building and
+    saving it there if it doesn't exist yet.
+    """
+
+    kk = (id(word_dict), max_distance, prefix_length)
+
+    if kk in spelling_indexes:
+        return spelling_indexes[kk]
+
+    t0 = time()
+
+    words = [(isinstance(x, unicode) and x or x.decode('utf8')) for x in word_dict]
+
+    fn = join(index_dir, 'spelling_%s_%d_%d.marshal' % (vocabulary_hash(words), max_distance, prefix_length))
+
+    si = False
+
+    if exists(fn):
+        try:
+            si = SpellingIndex.load(fn)
+            print ('LOADED_SPELLING_INDEX', fn, len(si.words), time() - t0)
+        except Exception as e:
+            print ('SPELLING_INDEX_LOAD_FAILED', fn, e)
+
+    if si is False:
+        si = SpellingIndex(words,
+                           max_distance = max_distance,
+                           prefix_length = prefix_length,
+                           )
+
+        print ('BUILT_SPELLING_INDEX', len(si.words), len(si.deletes), time() - t0)
+
+        try:
+            if not exists(index_dir):
+                makedirs(index_dir)
+            si.save(fn)
+        except Exception as e:
+            print ('SPELLING_INDEX_SAVE_FAILED', fn, e)
+
+    spelling_indexes[kk] = si
+
+    return si
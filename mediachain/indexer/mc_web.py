@@ -73,17 +73,21 @@ class Application(tornado.web.Application):
                     (r'/ping',handle_ping,),
                     (r'/stats',handle_stats,),
                     (r'/stats_annotation',handle_stats_annotation,),
+                    (r'/metrics',handle_metrics,),
                     (r'/search',handle_search,),
                     (r'/list_facets',handle_list_facets),
                     (r'/get_embed_url',handle_get_embed_url,),
                     (r'/record_relevance',handle_record_relevance,),
                     (r'/random_query',handle_random_query,),
+                    (r'/typeahead',handle_typeahead,),
+                    (r'/images/hh_([0-9a-z]+)/[0-9a-zA-Z_]+/([0-9a-zA-Z_\-]+)\.jpg',handle_cached_image,),
                     #(r'.*', handle_notfound,),
                     ]
         
         settings = {'template_path':join(dirname(__file__), 'templates_mc'),
                     'static_path':join(dirname(__file__), 'static_mc'),
                     'xsrf_cookies':False,
+                    'compress_response':bool(mc_config.MC_COMPRESS_RESPONSE_INT),
                     }
         
         tornado.web.Application.__init__(self, handlers, **settings)
@@ -91,8 +95,95 @@ class Application(tornado.web.Application):
         self.INDEX_NAME = mc_config.MC_INDEX_NAME
         self.DOC_TYPE = mc_config.MC_DOC_TYPE
 
+        ## Set once `warm_models()` completes. `/ping` reports unhealthy until then:
+        
+        self.models_ready = False
+
+    def warm_models(self,
+                    ):
+        """
+        Load the order model and the query-correction spelling index. Called before forking the
+        web workers, so that all workers share the loaded models copy-on-write.
+        """
+
+        from mc_spelling import get_spelling_index
+        
+        t0 = time()
+        
+        if not hasattr(self, 'order_model_cache'):
+            self.order_model_cache = init_order_model(mc_config.MC_NEURAL_MODEL_NAME)
+
+        if self.order_model_cache and self.order_model_cache.get('order_model'):
+            get_spelling_index(self.order_model_cache['order_model']['worddict'])
+
+        if (not hasattr(self, 'typeahead_index')) and \
+           (exists(mc_config.MC_TYPEAHEAD_INDEX_PATH) or exists(mc_config.MC_TYPEAHEAD_TSV_PATH)):
+            self.typeahead_index = mc_models.load_typeahead_index()
+        
+        self.models_ready = True
+
+        print ('MODELS_READY', time() - t0)
+
 
 from mc_alerts import MCAlerts
+from mc_annotate import AnnotationLog, AnnotationStats, nonce_key, annotation_log_import
+from mc_metrics import Metrics, SpanRecorder
+from mc_log import log, DEBUG
+from mc_admission import AdmissionController, RateLimiter
+from mc_image_search import load_local_image_search, image_index_build
+from mc_executor import Executor, IOLoopLagMonitor
+from mc_image_store import image_store
+
+
+## Result arrays at least this long are written out in chunks of `write_json_chunk_size` hits:
+
+write_json_stream_min = 200
+write_json_chunk_size = 100
+
+def json_dumps(hh,
+               sort_keys = False,
+               ):
+    """
+    Compact JSON encoding. Uses `ujson`, except when `sort_keys` is needed.
+
+    Note - the pinned ujson 1.33 always escapes forward slashes, as "\\/". This is valid JSON.
+    """
+    if sort_keys:
+        return json.dumps(hh,
+                          sort_keys = True,
+                          separators = (',', ':'),
+                          )
+    
+    return ujson.dumps(hh,
+                       ensure_ascii = False,
+                       )
+
+
+def json_chunks(hh,
+                sort_keys = False,
+                ):
+    """
+    Compact JSON encoding of `hh`, as a sequence of strings. Large `results` arrays are encoded in chunks
+    of `write_json_chunk_size`, so the whole response never has to be encoded as one string.
+    """
+    
+    if not (isinstance(hh.get('results'), list) and (len(hh['results']) >= write_json_stream_min)):
+        yield json_dumps(hh, sort_keys = sort_keys) + '\n'
+        return
+    
+    results = hh['results']
+    rest = json_dumps({k:v for k,v in hh.iteritems() if k != 'results'}, sort_keys = sort_keys)
+    
+    yield '{"results":['
+    
+    for c in xrange(0, len(results), write_json_chunk_size):
+        yield (c and ',' or '') + ','.join([json_dumps(x, sort_keys = sort_keys)
+                                            for x
+                                            in results[c:c + write_json_chunk_size]
+                                            ])
+    
+    yield ']' + (rest != '{}' and (',' + rest[1:]) or '}') + '\n'
+
 
 class BaseHandler(tornado.web.RequestHandler):
     
@@ -100,6 +191,10 @@ class BaseHandler(tornado.web.RequestHandler):
         RequestHandler.__init__(self, application, request, **kwargs)
         
         self._current_user=False
+
+        self._spans = False
+
+        self._admitted = False
         
         self.loader=tornado.template.Loader('templates_mc/')
     
@@ -134,64 +229,127 @@ class BaseHandler(tornado.web.RequestHandler):
         return self.application.alerts
 
     @property
-    def rand_typeahead(self):
-        if not hasattr(self.application,'rand_typeahead'):
-            
-            total = 0
-            rr = []
+    def metrics(self):
+        if not hasattr(self.application,'metrics'):
+            self.application.metrics = Metrics()
+        return self.application.metrics
 
-            total_mwe = 0
-            rr_mwe = []
-            
-            with open(mc_config.MC_TYPEAHEAD_TSV_PATH) as f:
-                for c, line in enumerate(f):
-                    if c >= 1000:
-                        break
-                    
-                    if not line:
-                        break
-                    
-                    score, query, _ = line.split('\t')
-                    score = int(score)
+    @property
+    def spans(self):
+        """
+        Stage timings of this request, added to `metrics` when the request finishes. Only requests that
+        use this are recorded.
+        """
+        if self._spans is False:
+            self._spans = SpanRecorder(self.metrics, self.__class__.__name__.replace('handle_', ''))
+        return self._spans
 
-                    if c < 1000:
-                        rr.append((score, query))
-                        total += score
+    @property
+    def admission(self):
+        if not hasattr(self.application,'admission'):
+            self.application.admission = AdmissionController(max_inflight = mc_config.MC_ADMISSION_MAX_INFLIGHT_INT,
+                                                             max_queue = mc_config.MC_ADMISSION_MAX_QUEUE_INT,
+                                                             queue_timeout = mc_config.MC_ADMISSION_QUEUE_TIMEOUT_FLOAT,
+                                                             )
+        return self.application.admission
 
-                    if query.count(' ') > 1:
-                        rr_mwe.append((score, query))
-                        total_mwe += score
+    @property
+    def rate_limiter(self):
+        if not hasattr(self.application,'rate_limiter'):
+            self.application.rate_limiter = RateLimiter(**mc_config.MC_RATE_LIMIT_JSON)
+        return self.application.rate_limiter
+
+    def client_key(self):
+        """
+        Rate limiting key: the API key if it is one of `MC_RATE_LIMIT_KEYS_JSON`, otherwise the client IP.
+        Keys are caller-chosen, so unknown keys must not each get a fresh bucket.
+        """
+        if not hasattr(self.application,'rate_limit_keys'):
+            self.application.rate_limit_keys = set(mc_config.MC_RATE_LIMIT_KEYS_JSON)
+        
+        for k in ['Access-Token', 'API-KEY']:
+            v = self.request.headers.get(k)
+            if v and (v in self.application.rate_limit_keys):
+                return 'key:' + v
+        
+        return 'ip:' + (self.request.headers.get('X-Real-Ip') or self.request.remote_ip or '')
+
+    @tornado.gen.coroutine
+    def admit(self):
+        """
+        Rate limiting and admission control. Returns True if the request may proceed. Otherwise, a 429 or
+        503 error response has already been written.
+
+        Local cache warming and refresh requests are not rate limited.
+        """
+
+        is_internal = (self.request.remote_ip in ['127.0.0.1', '::1']) and \
+                      (self.request.headers.get('X-Cache-Refresh') or ('mc_cache_warm' in self.request.headers.get('User-Agent', '').lower()))
+
+        key = self.client_key()
+        
+        if (not is_internal) and (not self.rate_limiter.allow(key)):
+            self.set_status(429)
+            self.set_header('Retry-After', str(int(self.rate_limiter.retry_after(key)) + 1))
+            self.write_json({'error':'RATE_LIMITED',
+                             'error_message':'Too many requests. Please retry later.',
+                             })
+            raise tornado.gen.Return(False)
+
+        ok = yield self.admission.acquire()
+
+        if not ok:
+            self.set_status(503)
+            self.set_header('Retry-After', '1')
+            self.write_json({'error':'OVERLOADED',
+                             'error_message':'Server busy. Please retry later.',
+                             })
+            raise tornado.gen.Return(False)
+
+        self._admitted = True
+        
+        raise tornado.gen.Return(True)
+
+    def on_finish(self):
+        if self._admitted:
+            self._admitted = False
+            self.admission.release()
+        
+        if self._spans is not False:
+            self._spans.finish()
 
-            if False:#order_model:
-                print ('USE_WORDDICT',)
-                rr = [(1.0, x) for x in order_model['worddict'].keys()]
-                rr_mwe = rr
-                        
-            self.application.rand_typeahead_total = total
-            self.application.rand_typeahead = rr
-            
-            self.application.rand_typeahead_mwe_total = total_mwe
-            self.application.rand_typeahead_mwe = rr_mwe
-            
-        return self.application.rand_typeahead
-    
     @property
-    def rand_typeahead_total(self):
-        if not hasattr(self.application,'rand_typeahead_total'):
-            self.rand_typeahead
-        return self.application.rand_typeahead_total
-            
+    def executor(self):
+        """
+        Thread pool for CPU-heavy stages, so that one heavy request doesn't stall the IOLoop.
+        """
+        if not hasattr(self.application,'executor'):
+            self.application.executor = Executor()
+        return self.application.executor
+
     @property
-    def rand_typeahead_mwe(self):
-        if not hasattr(self.application,'rand_typeahead_mwe'):
-            self.rand_typeahead
-        return self.application.rand_typeahead_mwe
+    def local_image_search(self):
+        if not hasattr(self.application,'local_image_search'):
+            self.application.local_image_search = load_local_image_search(executor = self.executor)
+        return self.application.local_image_search
 
     @property
-    def rand_typeahead_mwe_total(self):
-        if not hasattr(self.application,'rand_typeahead_mwe_total'):
-            self.rand_typeahead
-        return self.application.rand_typeahead_mwe_total
+    def annotation_log(self):
+        if not hasattr(self.application,'annotation_log'):
+            self.application.annotation_log = AnnotationLog()
+        return self.application.annotation_log
+
+    @property
+    def annotation_stats(self):
+        if not hasattr(self.application,'annotation_stats'):
+            self.application.annotation_stats = AnnotationStats(self.annotation_log)
+        return self.application.annotation_stats
+    
+    @property
+    def typeahead_index(self):
+        if not hasattr(self.application,'typeahead_index'):
+            self.application.typeahead_index = mc_models.load_typeahead_index()
+        return self.application.typeahead_index
     
     @tornado.gen.engine
     def render_template(self,template_name, kwargs):
@@ -233,27 +391,64 @@ class BaseHandler(tornado.web.RequestHandler):
                    ):
         """
         Central point where we can customize the JSON output.
+
+        Output is compact unless `pretty` is set. Large `results` arrays are encoded in chunks, see
+        `json_chunks()`. Use `write_json_streaming()` to also wait for each chunk to be sent.
         """
         if 'error' in hh:
-            print ('ERROR',hh)
+            log.warning('ERROR', hh)
+
+        t0 = time()
         
-        self.set_header("Content-Type", "application/json")
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
 
-        self.write(json.dumps(hh,
-                              sort_keys = sort_keys,
-                              indent = 4,
-                              ) + '\n')
-        if False:
-            if pretty:
-                self.write(pretty_print(hh,
-                                        indent = indent,
-                                        max_indent_depth = max_indent_depth,
-                                        ).replace('\n','\r\n') + '\n')
+        if pretty:
+            self.write(pretty_print(hh,
+                                    indent = indent,
+                                    max_indent_depth = max_indent_depth,
+                                    ) + '\n')
+        
+        else:
+            for chunk in json_chunks(hh, sort_keys = sort_keys):
+                self.write(chunk)
 
-            else:
-                self.write(json.dumps(hh,
-                                      sort_keys = sort_keys,
-                                      ) + '\n')
+        if self._spans is not False:
+            self._spans.add('serialize', (time() - t0) * 1000)
+        
+        self.finish()
+
+    @tornado.gen.coroutine
+    def write_json_streaming(self,
+                             hh,
+                             sort_keys = False,
+                             pretty = False,
+                             max_indent_depth = False,
+                             ):
+        """
+        Like `write_json()`, but flushes each chunk of a large `results` array and waits for it to be sent
+        before encoding the next, so slow clients don't make whole responses pile up in memory.
+        """
+        
+        if pretty or ('error' in hh):
+            self.write_json(hh,
+                            sort_keys = sort_keys,
+                            pretty = pretty,
+                            max_indent_depth = max_indent_depth,
+                            )
+            return
+        
+        t0 = time()
+        
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        
+        for chunk in json_chunks(hh, sort_keys = sort_keys):
+            self.write(chunk)
+            if len(chunk) > 1:
+                yield self.flush()
+        
+        if self._spans is not False:
+            self._spans.add('serialize', (time() - t0) * 1000)
+        
         self.finish()
         
 
@@ -288,116 +483,88 @@ class handle_ping(BaseHandler):
         
         #rr = yield self.es.ping()
         #self.write_json({'results':rr})
+
+        if not self.application.models_ready:
+            self.set_status(503)
+            self.write_json({'pong':0, 'ready':0})
+            return
         
         self.write_json({'pong':1})
 
-from collections import Counter
-
-class handle_stats_annotation(BaseHandler):
-    @tornado.gen.coroutine
-    def get(self):
+class handle_cached_image(BaseHandler):
+    
+    @property
+    def image_store(self):
+        if not hasattr(self.application,'image_store'):
+            self.application.image_store = image_store()
+        return self.application.image_store
+    
+    def get(self, size, _id):
         """
-        Annotation stats.
-
+        Serve a cached image at its `MC_IMAGE_CACHE_HOST` path, from the packed image store, or else from
+        `MC_IMAGE_CACHE_DIR`, so that the CDN can use this as its origin.
+        
+        Example:
+            $ curl "http://127.0.0.1:23456/images/hh_1024x1024/00a/00afa8d8fbacbc14ee33aab59261f5b7.jpg"
         """
-        uu = {
-            "172.56.34.204": 'dennis', 
-            "67.244.113.119": 'jesse', 
-            "95.111.63.140": 'tg',
-            "75.98.195.186": 'dennis2',
-        }
         
-        dir_in = '/datasets/datasets/annotate/search_relevance_001/'
-        dir_in = '/datasets/datasets/annotate/search_relevance/'
+        data = None
         
-        rh = {'users':{}}
-
-        qc = Counter()
-
-        uq = set() #set([(uname,query)])
+        if mc_config.MC_IMAGE_STORE_INT:
+            data = self.image_store.get(size + '/' + _id)
         
-        for fn in listdir(dir_in):
-
-            if fn.startswith('test_'):
-                continue
-            
-            fn = join(dir_in, fn)
-
+        if data is None:
             try:
-                with open(fn) as f:
-                    d = f.read()
-                h = json.loads(d)
-            except:
-                print ('BAD',fn)
-                continue
-
-            
-            #h['data']['query_info']:
-            #{u'query_args': {u'doc_type': u'image', u'skip_query_cache': 0, u'allow_nsfw': 0, u'include_docs': 1, u'schema_variant': u'new', u'q_text': u'women in tech', u'index_name': u'getty_test', u'canonical_id': 0, u'enrich_tags': 1, u'filter_incomplete': 0, u'debug': 1, u'filter_licenses': [u'Creative Commons'], u'full_limit': 200, u'pretty': 1, u'include_thumb': False, u'rerank_eq': u'neural_hybrid', u'q': u'women in tech', u'token': u'5d70d87058a8349e910b7dbda1eda85b', u'filter_sources': u'ALL'}, u'query_elapsed_ms': 5, u'query_time': 1472230434}
+                with open(join(mc_config.MC_IMAGE_CACHE_DIR, 'hh_' + size, _id[:3], _id + '.jpg'), 'rb') as f:
+                    data = f.read()
+            except IOError:
+                raise tornado.web.HTTPError(404)
+        
+        self.set_header('Content-Type', 'image/jpeg')
+        self.set_header('Cache-Control', 'public, max-age=31536000')
+        self.write(data)
 
-            
-            #print fn, len(h['data']['data'])
-            the_query = h['data']['query_info']['query_args'].get('q')
-            
-            qc[the_query] += 1
-                        
-            #{u'ratings': [{u'rating': 1, u'_id': u'Overall'}, {u'rating': 0, u'_id': u'is_bad_nsfw'}, {u'rating': 0, u'_id': u'is_bad_spam'}, {u'rating': 0, u'_id': u'is_bad_watermarks'}], u'id': u'adc4f1634f448095757559005be2d1ab'}
-            
-            uname = h['user_ip']
-            
-            uname = uu.get(uname, uname)
-            
-            if uname not in rh['users']:
-                rh['users'][uname] = {'num_tasks':0,
-                                      'num_images':0,
-                                      'num_queries':0,
-                                      'queries':[],
-                                      'num_bad':0,
-                                      }            
 
-            if not the_query:
-                rh['users'][uname]['num_bad'] += 1
-                continue
-            
-            rh['users'][uname]['queries'] = list(sorted(set(rh['users'][uname]['queries'] + [the_query])))
-            #if uname == 'tg':
-            #    print ('tg', fn)
-            
-            """
-            h['data']['data'][0] =
-              {u'id': u'b2e8bf36899934df9b57841a722b3556',
-               u'ratings': [{u'_id': u'Overall', u'rating': 1},{u'_id': u'is_bad_nsfw', u'rating': 0},{u'_id': u'is_bad_spam', u'rating': 0},{u'_id': u'is_bad_watermarks', u'rating': 0}]}
-            """
-            for answers_set in h['data']['data']:
-                
-                ratings = answers_set['ratings']
-                
-                overall = [x for x in ratings if x['_id'] == 'Overall']
+class handle_metrics(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Per-stage latency percentiles of `/search` requests, merged across all web worker processes.
+        Cache hits are reported under `search_cached`, and requests shed by admission control under
+        `search_rejected`. `ioloop.lag` is how late the IOLoop ran periodic callbacks, i.e. how long
+        it was blocked. `admission` and `executor` have this worker's counters.
 
-                if overall:
-                    overall = overall[0]['rating']
-                else:
-                    overall = -1
-                
-                if overall < 1:
-                    continue
-                    
-                rh['users'][uname]['num_images'] += 1
-            
-            if not rh['users'][uname]['num_images']:
-                ## ignore tasks with 0 images rated.
-                continue
+        Args:
+            local: Set to 1 to only report this worker process.
+        
+        Example:
+            $ curl "http://127.0.0.1:23456/metrics"
+        """
+        
+        local = intget(self.get_argument('local', '0'))
+        
+        rh = self.metrics.summary(all_processes = not local)
+        
+        rh['admission'] = self.admission.stats()
+        rh['executor'] = self.executor.stats()
+        
+        self.write_json(rh,
+                        pretty = True,
+                        )
 
-            rh['users'][uname]['num_tasks'] += 1
+from collections import Counter
 
-            k = (uname,the_query)
-            if k not in uq:
-                rh['users'][uname]['num_queries'] += 1
-            uq.add(k)
+class handle_stats_annotation(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Annotation stats. Only submissions recorded since the last call are read, on the thread pool.
 
-        print qc.most_common()
+        """
         
-        self.write_json(rh)
+        yield self.executor.submit(self.annotation_stats.catch_up)
+        
+        self.write_json(self.annotation_stats.summary())
         
 
         
@@ -434,7 +601,7 @@ class handle_stats(BaseHandler):
                                                      )
             d = response.body
 
-            print ('ES_GOT',d)
+            log.debug('ES_GOT', d)
 
             h2 = json.loads(d)
             
@@ -469,7 +636,7 @@ except:
 
 try:
     import mc_crawlers
-    from mc_crawlers import get_neural_relevance, init_order_model, relevance_ann_query_to_concepts, reverse_image_lookup_index
+    from mc_crawlers import get_neural_relevance, init_order_model, relevance_ann_query_to_concepts
 except Exception as e:
     raise
     print ('IMPORT_ERROR',e)
@@ -478,6 +645,18 @@ except Exception as e:
 
 print ('get_neural_relevance',get_neural_relevance)
 
+## External reverse image lookup. Uploads and `q_id` data URIs use local image search instead, if this is unavailable:
+
+reverse_image_lookup_index = getattr(mc_crawlers, 'reverse_image_lookup_index', False)
+
+from mc_relevance import RelevanceBatcher
+
+## Scores hit lists of concurrent searches in micro-batches, on a worker thread:
+
+neural_relevance_batcher = get_neural_relevance and RelevanceBatcher(get_neural_relevance,
+                                                                     score_batch = getattr(mc_crawlers, 'get_neural_relevance_batch', False),
+                                                                     )
+
 order_model = False
 
 if get_neural_relevance:# and (not DO_FORWARDING):
@@ -555,25 +734,119 @@ from time import time
 
 
    
+import struct
+
+query_cache_magic = 'MCQC1\n'
+query_cache_prefix_len = len(query_cache_magic) + struct.calcsize('<II')
+
+
+def query_cache_filename(key,
+                         query_cache_dir = mc_config.MC_QUERY_CACHE_DIR,
+                         ext = '.bin',
+                         ):
+    """
+    Cache filename for `key`, sharded by the first 4 characters of the key.
+    """
+    dir_out_2 = join(query_cache_dir,
+                     ('/'.join(key[:4])) + '/',
+                     )
+    
+    return dir_out_2 + key + ext
+
+
 def query_cache_lookup(key,
                        max_age = 60 * 60 * 24 * 7, # 7 days
+                       stale_age = 0,
                        query_cache_dir = mc_config.MC_QUERY_CACHE_DIR,
                        skip_query_cache = False,
                        allow_skip_query_cache = mc_config.MC_ALLOW_SKIP_QUERY_CACHE_INT,
+                       offset = 0,
+                       limit = None,
                        ):
     """
     Simple file-based cache.
+
+    Only the results in `[offset:offset + limit]` are read from disk and decoded. The total number
+    of cached results is returned under the `num_cached_results` key.
+
+    Entries older than `max_age` are still returned for up to `stale_age` more seconds, with
+    `cache_stale` set, so that the caller can serve them while refreshing in the background.
+    Entries saved with their own `max_age` expire after at most that, and are never stale.
+
+    See `query_cache_save()` for the file format.
     """
 
     if skip_query_cache and allow_skip_query_cache:
-        print ('!!!SKIP_QUERY_CACHE',)
+        log.debug('!!!SKIP_QUERY_CACHE',)
         return False
     
-    dir_out_2 = join(query_cache_dir,
-                     ('/'.join(key[:4])) + '/',
-                     )
+    fn_out = query_cache_filename(key, query_cache_dir)
+    
+    if not exists(fn_out):
+        return query_cache_lookup_legacy(key,
+                                         max_age = max_age + stale_age,
+                                         query_cache_dir = query_cache_dir,
+                                         offset = offset,
+                                         limit = limit,
+                                         )
+    
+    try:
+        with open(fn_out, 'rb') as f:
+            
+            prefix = f.read(query_cache_prefix_len)
+            
+            if not prefix.startswith(query_cache_magic):
+                return False
+            
+            header_len, num_results = struct.unpack('<II', prefix[len(query_cache_magic):])
+            
+            rh = ujson.loads(f.read(header_len))
+            
+            age = time() - rh['time']
+            
+            if rh.get('max_age') is not None:
+                max_age = min(max_age, rh['max_age'])
+                stale_age = 0
+            
+            if age > max_age + stale_age:
+                return False
+            
+            start = min(max(0, offset), num_results)
+            end = num_results if limit is None else min(num_results, start + limit)
+            
+            table_pos = query_cache_prefix_len + header_len
+            records_pos = table_pos + 8 * (num_results + 1)
+            
+            f.seek(table_pos + 8 * start)
+            oo = struct.unpack('<%dQ' % (end - start + 1), f.read(8 * (end - start + 1)))
+            
+            f.seek(records_pos + oo[0])
+            buf = f.read(oo[-1] - oo[0])
+            
+    except KeyboardInterrupt:
+        raise
+    except:
+        return False
+    
+    rh['data']['results'] = [ujson.loads(buf[a - oo[0]:b - oo[0]]) for a, b in zip(oo, oo[1:])]
+    rh['data']['num_cached_results'] = num_results
+    rh['data']['cache_hit'] = True
+    rh['data']['cache_stale'] = age > max_age
+    
+    return rh['data']
+
+
+def query_cache_lookup_legacy(key,
+                              max_age = 60 * 60 * 24 * 7, # 7 days
+                              query_cache_dir = mc_config.MC_QUERY_CACHE_DIR,
+                              offset = 0,
+                              limit = None,
+                              ):
+    """
+    Lookup for cache entries written in the old single-JSON format, so that existing tokens keep working.
+    """
     
-    fn_out = dir_out_2 + key + '.json'
+    fn_out = query_cache_filename(key, query_cache_dir, ext = '.json')
     
     if exists(fn_out):
         try:
@@ -586,8 +859,14 @@ def query_cache_lookup(key,
         
         if time() - rh['time'] > max_age:
             return False
-
+        
+        results = rh['data']['results']
+        end = len(results) if limit is None else offset + limit
+        
+        rh['data']['results'] = results[offset:end]
+        rh['data']['num_cached_results'] = len(results)
         rh['data']['cache_hit'] = True
+        rh['data']['cache_stale'] = False
         
         #assert rh['data']['query_info']['query_args'].get('q'), rh['data']['query_info']['query_args'].keys()
         
@@ -599,40 +878,236 @@ def query_cache_lookup(key,
 def query_cache_save(key,
                      hh,
                      query_cache_dir = mc_config.MC_QUERY_CACHE_DIR,
+                     max_age = None,
                      ):
     """
     Simple file-based cache.
+
+    Results are stored as separately-encoded records behind an offset table, so that a page
+    request only has to decode the records it returns:
+
+        magic | header_len, num_results (uint32) | header JSON | offsets (uint64 * (num_results + 1)) | records
+
+    The header holds everything in `hh` except `results`, plus the save time, and `max_age` if set,
+    which limits how long `query_cache_lookup()` returns the entry.
     """
 
     from random import randint
     
     #assert hh['query_info']['query_args'].get('q'), hh['query_info']['query_args'].keys()
     
-    dir_out_2 = join(query_cache_dir,
-                     ('/'.join(key[:4])) + '/',
-                     )
+    fn_out = query_cache_filename(key, query_cache_dir)
+    
+    dir_out_2 = dirname(fn_out)
+    
+    if not exists(dir_out_2):
+        try:
+            makedirs(dir_out_2)
+        except OSError, e:
+            if e.errno != 17: ## 17 == File Exists, caused by concurrent threads.
+                raise
+    
+    records = [ujson.dumps(x) for x in hh['results']]
+    
+    oo = [0]
+    for x in records:
+        oo.append(oo[-1] + len(x))
+    
+    header = {'data':{k:v for k,v in hh.iteritems() if k != 'results'},
+              'time':int(time()),
+              }
+    
+    if max_age is not None:
+        header['max_age'] = max_age
+    
+    header = ujson.dumps(header)
+
+    fn_out_temp = fn_out + '.temp' + str(randint(1,10000000))
+    
+    with open(fn_out_temp, 'wb') as f:
+        f.write(query_cache_magic)
+        f.write(struct.pack('<II', len(header), len(records)))
+        f.write(header)
+        f.write(struct.pack('<%dQ' % len(oo), *oo))
+        f.write(''.join(records))
+
+    rename(fn_out_temp,
+           fn_out,
+           )
+
+
+import os
+import errno
+from os.path import getmtime
+from datetime import timedelta
+from tornado.concurrent import Future
+
+## Searches currently being computed by this worker process, {cache_key: Future}:
+
+query_inflight = {}
+
+
+## Searches requested by clients, cache hits included, one JSON line of query args each. Read by
+## `warm_query_cache()`. Each worker process writes its own file per hour:
+
+query_request_log_dir = join(mc_config.MC_QUERY_CACHE_DIR, 'requested')
+
+query_request_log_f = {}   # {(pid, hour): file}
+
+def query_request_log_write(query_args,
+                            log_dir = query_request_log_dir,
+                            ):
+    """
+    Record a requested search. Never raises.
+    """
+    
+    kk = (os.getpid(), int(time()) // 3600)
+    
+    try:
+        f = query_request_log_f.get(kk)
+        
+        if f is None:
+            for xx in query_request_log_f.values():
+                xx.close()
+            query_request_log_f.clear()
+            
+            if not exists(log_dir):
+                makedirs(log_dir)
+            
+            f = query_request_log_f[kk] = open(join(log_dir, '%d_%d.log' % (kk[1], kk[0])), 'ab')
+        
+        f.write(ujson.dumps(query_args) + '\n')
+        f.flush()
+        
+    except Exception as e:
+        log.warning('QUERY_REQUEST_LOG_FAILED', repr(e))
+
+
+def query_cache_try_lock(key,
+                         query_cache_dir = mc_config.MC_QUERY_CACHE_DIR,
+                         max_lock_age = 60,
+                         ext = '.lock',
+                         ):
+    """
+    Create a lock marker for `key` next to its cache file, visible to all worker processes.
+    
+    Returns True if this process now holds the lock. Locks left behind by crashed workers
+    are broken after `max_lock_age` seconds.
+    """
+    
+    fn_lock = query_cache_filename(key, query_cache_dir, ext = ext)
+    
+    dir_out_2 = dirname(fn_lock)
+    
+    if not exists(dir_out_2):
+        try:
+            makedirs(dir_out_2)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    
+    for x in xrange(2):
+        try:
+            os.close(os.open(fn_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        
+        try:
+            if time() - getmtime(fn_lock) < max_lock_age:
+                return False
+            unlink(fn_lock)
+        except OSError:
+            ## Released or broken by another process in the meantime, retry:
+            pass
+    
+    return False
+
+
+def query_cache_unlock(key,
+                       query_cache_dir = mc_config.MC_QUERY_CACHE_DIR,
+                       ext = '.lock',
+                       ):
+    """
+    Release lock marker created by `query_cache_try_lock()`.
+    """
+    
+    try:
+        unlink(query_cache_filename(key, query_cache_dir, ext = ext))
+    except OSError:
+        pass
+
+
+@tornado.gen.coroutine
+def query_cache_wait(key,
+                     offset = 0,
+                     limit = None,
+                     timeout = 30,
+                     poll_interval = 0.1,
+                     query_cache_dir = mc_config.MC_QUERY_CACHE_DIR,
+                     ):
+    """
+    Wait for another worker process, holding the lock for `key`, to save its results to the cache.
+    
+    Returns the cached results, or False if the lock was released without anything being
+    cached, or on timeout.
+    """
+    
+    fn_lock = query_cache_filename(key, query_cache_dir, ext = '.lock')
+    
+    t0 = time()
+    
+    while time() - t0 < timeout:
+        
+        yield tornado.gen.sleep(poll_interval)
+        
+        rr = query_cache_lookup(key,
+                                offset = offset,
+                                limit = limit,
+                                query_cache_dir = query_cache_dir,
+                                )
+        
+        if rr is not False:
+            raise tornado.gen.Return(rr)
+        
+        if not exists(fn_lock):
+            break
+    
+    raise tornado.gen.Return(False)
+
+
+@tornado.gen.coroutine
+def query_cache_refresh(key,
+                        body,
+                        headers = {},
+                        refresh_url = mc_config.MC_QUERY_CACHE_REFRESH_URL,
+                        ):
+    """
+    Recompute a stale cache entry in the background, by re-sending the original search to the local
+    search endpoint with the `X-Cache-Refresh` header set. Only one refresh per key runs at a time,
+    across all worker processes.
+    """
     
-    fn_out = dir_out_2 + key + '.json'
+    if not query_cache_try_lock(key, max_lock_age = 120, ext = '.refresh'):
+        return
     
-    if not exists(dir_out_2):
-        try:
-            makedirs(dir_out_2)
-        except OSError, e:
-            if e.errno != 17: ## 17 == File Exists, caused by concurrent threads.
-                raise
+    headers = dict(headers)
+    headers['X-Cache-Refresh'] = '1'
     
-    rh = {'data':hh,
-          'time':int(time()),
-          }
-
-    fn_out_temp = fn_out + '.temp' + str(randint(1,10000000))
+    try:
+        yield AsyncHTTPClient().fetch(refresh_url,
+                                      method = 'POST',
+                                      connect_timeout = 30,
+                                      request_timeout = 60,
+                                      body = body,
+                                      headers = headers,
+                                      )
+    except Exception as e:
+        print ('QUERY_CACHE_REFRESH_FAILED', key, e)
     
-    with open(fn_out_temp, 'w') as f:
-        f.write(json.dumps(rh))
-
-    rename(fn_out_temp,
-           fn_out,
-           )
+    finally:
+        query_cache_unlock(key, ext = '.refresh')
 
 
 class handle_list_facets(BaseHandler):
@@ -823,9 +1298,9 @@ debug_options = [{'name':'q',
                   },
                  {'name':'pretty',
                   'description':'Indent and pretty-print JSON output.',
-                  'default':1,
+                  'default':0,
                   'type':'number',
-                  'options':[1, 0],
+                  'options':[0, 1],
                   },
                  {'name':'filter_incomplete',
                   'description':"Filter documents for which all features haven't been generated / ingested yet.",
@@ -975,69 +1450,47 @@ for xx in rating_options:
     xx['name'] = xx['name'].replace('WATERMARK___' ,'WATERMARK')
 
 
+from heapq import nlargest
+from math import log as math_log
+
 def do_beam(graph, max_beam = 5):
     """
+    Beam search over a lattice of per-position candidates, [[(weight, obj), ...], ...]. Paths are
+    scored by the product of their weights, compared as sums of log weights. Only the best `max_beam`
+    partial paths are kept at each depth, which is exact for the top `max_beam` complete paths.
+
     Example:
     
         do_beam([[(5,'a'), (4, 'b'), (3, 'c')], [(5,'d'), (4, 'e'), (3, 'f')], [(5,'g'), (4, 'h'), (3, 'i')],])
 
-        -> [(125, ['a', 'd', 'g']), (100, ['a', 'e', 'g']), (100, ['a', 'd', 'h']), (80, ['a', 'e', 'h']), (75, ['a', 'f', 'g'])]
+        -> [(125, ['a', 'd', 'g']), (100, ['b', 'd', 'g']), (100, ['a', 'e', 'g']), (100, ['a', 'd', 'h']), (80, ['b', 'e', 'g'])]
     """
     
     if (not graph) or (not graph[0]):
         return []
     
-    longest_path = 0.0
-    
-    w0 = 1
-    p0 = []
-    for xx in graph:
-        w0 *= xx[0][0]
-        p0.append(xx[0][1])
-    
-    keep = [(w0, p0)]
-
-    #print ('START_KEEP',keep)
+    def log_weight(w):
+        if w > 0:
+            return math_log(w)
+        return float('-inf')
     
-    graph = [list(sorted(x, reverse=True)) for x in graph]
+    ## (log_score, weight, path):
     
-    queue = [(graph[0][x][0], 0, [graph[0][x][1]]) for x in xrange(len(graph[0]))]
+    beam = [(0.0, 1, [])]
     
-    while queue:
-        
-        zz = queue.pop(0)
-        
-        #print ('POP',zz)
-        
-        (cur_weight, c, path) = zz
-        
-        if c + 1 == len(graph):
-            continue
-        
-        for c2, (cur2_weight, cur2_obj) in enumerate(graph[c + 1]): #[:max_depth]
-
-            #print ('VIS',c + 1, c2)
-            
-            new_weight = cur_weight * cur2_weight
-            new_path = path + [cur2_obj]
-            longest_path = max(float(len(new_path)), longest_path)
-
-            if len(new_path) == len(graph):
-                keep.append((new_weight, new_path))
-
-            queue.append((new_weight, c + 1, new_path))
+    for layer in graph:
         
-        q2 = [(longest_path / len(x[-1]), x) for x in queue]
+        layer = nlargest(max_beam, layer)
         
-        q2 = list(sorted(q2, reverse=True))[:max_beam]
-
-        queue = [y for x,y in q2]
-
-        keep.sort(reverse = True)
-        keep = keep[:max_beam]
+        beam = nlargest(max_beam,
+                        [(score + log_weight(w), weight * w, path + [obj])
+                         for score, weight, path in beam
+                         for w, obj in layer
+                         ],
+                        key = lambda x: (x[0], x[2]),
+                        )
     
-    return keep
-
+    return [(weight, path) for score, weight, path in beam]
 
 
 def query_correct(query, order_model, num = 4, cutoff = 0.5):
@@ -1048,6 +1501,9 @@ def query_correct(query, order_model, num = 4, cutoff = 0.5):
     - Inform probabilities based on a real language model.
     - Word segmentation based on a language model.
     - Vector-space suggestions of more frequent synonyms for rare words.
+
+    Candidates for unknown words come from the precomputed `mc_spelling` index, so only words within
+    2 edits are suggested.
     
     input:
          'brown hotdog'
@@ -1061,13 +1517,14 @@ def query_correct(query, order_model, num = 4, cutoff = 0.5):
 
     query = query.lower() ## ADDED
     
-    from difflib import get_close_matches
-    from editdistance import eval as eval_dist
+    from mc_spelling import get_spelling_index
     
     if not order_model:
         return []
     
     word_dict = order_model['worddict']
+
+    spelling_index = get_spelling_index(word_dict)
     
     in_orig = []
     cand = []
@@ -1083,15 +1540,15 @@ def query_correct(query, order_model, num = 4, cutoff = 0.5):
             num_found += 1
         else:
             in_orig.append(0)
-            cand.append([(max(0,(100.0 - eval_dist(w, w2))) / 100.0, w2) for w2 in get_close_matches(w, word_dict, n = num, cutoff = cutoff)] \
+            cand.append([(max(0,(100.0 - dist)) / 100.0, w2) for dist, w2 in spelling_index.lookup(w, num = num, cutoff = cutoff)] \
                         # + [(0.0000001, w)]
                         )
     
     if num_found == len(query_s):
-        print ('YES_FOUND_ALL',query_s)
+        log.debug('YES_FOUND_ALL', query_s)
         return []
 
-    print ('NOT_FOUND_ALL',query_s, cand)
+    log.debug('NOT_FOUND_ALL', query_s, cand)
 
     try:
         rr = do_beam(cand, max_beam = num)
@@ -1109,7 +1566,7 @@ def query_correct(query, order_model, num = 4, cutoff = 0.5):
         yy3.append((xx, yy2))
     rr = yy3
     
-    print ('SUGGEST',in_orig, rr)
+    log.debug('SUGGEST', in_orig, rr)
 
     r2 = [{'query':' '.join(y), 'highlighted':zip(in_orig, y)} for x, y in rr]
     
@@ -1118,11 +1575,454 @@ def query_correct(query, order_model, num = 4, cutoff = 0.5):
 
 DO_XANN = False
 
+## `_source` projections for the ES queries behind each search endpoint. Large inline thumbnails and
+## the `dedupe_*` hash terms are never needed after retrieval, so they are not sent over the wire:
+
+thumb_source_fields = ['image_thumb', 'thumbnail_base64']
+
+heavy_source_fields = thumb_source_fields + ['dedupe_*']
+
+## Everything that reranking, the post-ingestion normalizers, the NSFW / license filters and
+## neural relevance read. Used when only IDs are returned, i.e. `include_docs` = 0:
+
+ranking_source_fields = ['native_id', 'node_id', 'origin', 'provider', 'source', 'source_tags', 'source_dataset',
+                         'title', 'description', 'keywords', 'xann', 'artist', 'artist_name', 'artist_names',
+                         'aesthetics', 'aes_unsplash_out_v1', 'score_*', 'boosted', 'nsfw',
+                         'max_width', 'sizes', 'image_url', 'url_shown_at', 'date_created*',
+                         'license*', 'licenses', 'post_ingestion_version',
+                         ]
+
+source_projections = {'search':{'exclude':heavy_source_fields},
+                      'search_ids_only':{'include':ranking_source_fields, 'exclude':heavy_source_fields},
+                      'dupe_terms':False,
+                      }
+
+
+def source_projection(the_input,
+                      endpoint = 'search',
+                      ):
+    """
+    Return the `_source` filter for the ES query behind `endpoint`, adjusted for the request options.
+    """
+    
+    if (endpoint == 'search') and (not the_input.get('include_docs', 1)):
+        endpoint = 'search_ids_only'
+    
+    proj = source_projections[endpoint]
+
+    if proj is False:
+        return False
+    
+    rh = {}
+    
+    if proj.get('include'):
+        rh['include'] = list(proj['include'])
+    
+    exclude = proj.get('exclude') or []
+    
+    if the_input.get('include_thumb'):
+        exclude = [x for x in exclude if x not in thumb_source_fields]
+
+    if exclude:
+        rh['exclude'] = list(exclude)
+    
+    return rh
+
+
+## Search filters, applied as ES `bool` clauses so every fetched candidate is usable:
+
+blocked_ids_default = [u'pexels_85601',
+                       'feb4186c66cd5255e34ba2fdce5a386c',
+                       'f148a4e1c3a985871a3e529755d93202',
+                       '3aced17eabda5ac3afaf0e3e0cb7786e',
+                       'f0dda8781292b1e3f1ccbf764a9dee94',
+                       '1ab346ea9420f2bb62f0cae82bf9d32b',
+                       ]
+
+blocked_ids_cache = {'fn':None, 'mtime':None, 'ids':frozenset(blocked_ids_default)}
+
+def load_blocked_ids(fn = mc_config.MC_BLOCKED_IDS_FILE):
+    """
+    Blocked document IDs: `blocked_ids_default`, plus one ID per line of `fn`. Reloaded whenever `fn` changes.
+    """
+    
+    try:
+        mtime = getmtime(fn)
+    except OSError:
+        mtime = None
+    
+    if (blocked_ids_cache['fn'] != fn) or (blocked_ids_cache['mtime'] != mtime):
+        
+        ids = set(blocked_ids_default)
+        
+        if mtime is not None:
+            with open(fn) as f:
+                ids.update([x.strip() for x in f if x.strip() and (not x.startswith('#'))])
+        
+        blocked_ids_cache.update({'fn':fn, 'mtime':mtime, 'ids':frozenset(ids)})
+        
+        print ('LOADED_BLOCKED_IDS', fn, len(ids))
+    
+    return blocked_ids_cache['ids']
+
+
+## Native ID tokens whose `license_tags` are overwritten by `mc_normalize.apply_post_ingestion_normalizers()`.
+## Like its rules, these match anywhere in the native ID, not only at the start:
+
+license_token_tags = {'pexels_':['CC0'],
+                      'getty_':['Non-Commercial Use'],
+                      }
+
+## Everything ingested, except for these, is open-licensed and counts as "Creative Commons", as tagged
+## by `handle_search`:
+
+license_not_cc_tokens = ['getty_', 'eyeem_']
+
+def native_id_contains(token):
+    """
+    ES clause matching docs whose `native_id` contains `token`. The license clauses are constant, and used in
+    filter context, so ES can cache them instead of scanning the `native_id` terms for each search.
+    """
+    return {"wildcard": {"native_id": '*' + token + '*'}}
+
+def license_filter_clause(filter_licenses):
+    """
+    ES filter matching docs with ANY of `filter_licenses`, after post-ingestion normalization.
+    """
+    
+    should = [native_id_contains(token)
+              for token, tags
+              in sorted(license_token_tags.items())
+              if set(tags).intersection(filter_licenses)
+              ]
+    
+    should.append({"bool": {"must": {"bool": {"should": [{"match_phrase": {"license_tags": x}} for x in filter_licenses]}},
+                            "must_not": [native_id_contains(token) for token in sorted(license_token_tags)],
+                            }})
+    
+    if 'Creative Commons' in filter_licenses:
+        should.append({"bool": {"must_not": [native_id_contains(token) for token in license_not_cc_tokens]}})
+    
+    return {"bool": {"should": should, "minimum_should_match": 1}}
+
+
+def search_filters(the_input,
+                   is_id_search = False,
+                   filter_licenses = True,
+                   ):
+    """
+    Blocklist, NSFW and license filters for a search, as ES `bool` clauses {'filter':[...], 'must_not':[...]}.
+    """
+    
+    rh = {'filter':[], 'must_not':[]}
+    
+    blocked_ids = load_blocked_ids()
+    
+    if blocked_ids:
+        rh['must_not'].append({"ids": {"values": sorted(blocked_ids)}})
+    
+    if (not is_id_search) and (not the_input['allow_nsfw']):
+        rh['must_not'].append({"term": {"nsfw": True}})
+    
+    if filter_licenses and (not is_id_search) and the_input['filter_licenses'] and ('ALL' not in the_input['filter_licenses']):
+        rh['filter'].append(license_filter_clause(the_input['filter_licenses']))
+    
+    return rh
+
+
+def filtered_query(query,
+                   filters,
+                   ):
+    """
+    Return a copy of ES request body `query`, with its `query` part restricted by `search_filters()` output.
+    """
+    
+    if (not filters) or not (filters['filter'] or filters['must_not']):
+        return query
+    
+    rh = dict(query)
+    rh['query'] = {"bool": {"must": query['query'],
+                            "filter": filters['filter'],
+                            "must_not": filters['must_not'],
+                            }}
+    return rh
+
+
+## Seconds each candidate source is given, before search continues without it:
+
+retrieval_timeouts = {'text':8.0,
+                      'remote':8.0,
+                      'xann':3.0,
+                      }
+
+
+class SearchBackendError(Exception):
+    """
+    Search backend failure, reported to the client as `error` / `error_message`.
+    """
+    
+    def __init__(self,
+                 error,
+                 error_message,
+                 ):
+        Exception.__init__(self, error, error_message)
+        self.error = error
+        self.error_message = error_message
+
+
+@tornado.gen.coroutine
+def gather_hits(sources,
+                timeouts = retrieval_timeouts,
+                ):
+    """
+    Wait for concurrently-running candidate sources, {source_name: Future}, each until its deadline
+    in `timeouts`. Sources that miss their deadline contribute no hits.
+    
+    Returns ({source_name: hits}, [names of sources that timed out]).
+    """
+    
+    timed_out = []
+    
+    def abandoned_done(name, ff):
+        ## Retrieve the late result, so a late failure is logged here instead of as "Future exception never retrieved":
+        if ff.exception() is not None:
+            log.warning('RETRIEVAL_FAILED_AFTER_TIMEOUT', name, repr(ff.exception()))
+    
+    @tornado.gen.coroutine
+    def wait_one(name):
+        try:
+            hits = yield tornado.gen.with_timeout(timedelta(seconds = timeouts.get(name, 8.0)),
+                                                  sources[name],
+                                                  )
+        except tornado.gen.TimeoutError:
+            log.warning('RETRIEVAL_TIMEOUT', name)
+            timed_out.append(name)
+            sources[name].add_done_callback(lambda ff: abandoned_done(name, ff))
+            hits = []
+        raise tornado.gen.Return(hits)
+    
+    names = list(sources)
+    
+    rr = yield [wait_one(x) for x in names]
+    
+    raise tornado.gen.Return((dict(zip(names, rr)), timed_out))
+
 class handle_search(BaseHandler):
     
     #disable XSRF checking for this URL:
     def check_xsrf_cookie(self): 
         pass
+
+    @tornado.gen.coroutine
+    def query_single_flight(self,
+                            key,
+                            offset = 0,
+                            limit = None,
+                            timeout = 30,
+                            ):
+        """
+        Coalesce identical concurrent searches, keyed by the query cache key.
+        
+        If an identical search is already running in this worker, or in another worker process,
+        wait for it and return its results from the cache. Otherwise returns False, and this
+        request becomes the one computing `key`. Waiting requests are released in `on_finish()`.
+        """
+        
+        rr = False
+        is_locked = False
+        
+        if key in query_inflight:
+            try:
+                yield tornado.gen.with_timeout(timedelta(seconds = timeout),
+                                               query_inflight[key],
+                                               )
+            except tornado.gen.TimeoutError:
+                pass
+            
+            rr = query_cache_lookup(key,
+                                    offset = offset,
+                                    limit = limit,
+                                    )
+        
+        else:
+            is_locked = query_cache_try_lock(key)
+            
+            if not is_locked:
+                rr = yield query_cache_wait(key,
+                                            offset = offset,
+                                            limit = limit,
+                                            timeout = timeout,
+                                            )
+        
+        if (rr is False) and (key not in query_inflight):
+            if not is_locked:
+                is_locked = query_cache_try_lock(key)
+            
+            query_inflight[key] = Future()
+            self.inflight_key = key
+            self.inflight_locked = is_locked
+        
+        raise tornado.gen.Return(rr)
+    
+    @tornado.gen.coroutine
+    def es_hits(self,
+                the_input,
+                source,
+                error_name = 'ELASTICSEARCH_JSON_ERROR',
+                ):
+        """
+        Run a search and return its hits. Raises `SearchBackendError` on failure.
+        """
+        
+        rr = yield self.es.search(index = the_input['index_name'],
+                                  type = the_input['doc_type'],
+                                  source = source,
+                                  )
+        
+        try:
+            if len(rr.body) > mc_config.MC_EXECUTOR_MIN_JSON_BYTES_INT:
+                hh = yield self.executor.submit(json.loads, rr.body)
+            else:
+                hh = json.loads(rr.body)
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            raise SearchBackendError(error_name,
+                                     'Elasticsearch down or timeout? - ' + repr(rr.body)[:1000],
+                                     )
+        
+        if 'error' in hh:
+            raise SearchBackendError('ELASTICSEARCH_ERROR',
+                                     repr(hh)[:1000],
+                                     )
+        
+        raise tornado.gen.Return(hh['hits']['hits'])
+    
+    @tornado.gen.coroutine
+    def retrieve_remote_hits(self,
+                             the_input,
+                             remote_ids,
+                             verbose = False,
+                             filters = False,
+                             ):
+        """
+        Hydrate `remote_ids` into boosted hits, in the order of `remote_ids`. Hits excluded by `filters` are dropped.
+        """
+        
+        t1 = time()
+
+        ## Hydrate in batches of 50, with all batches in flight at once:
+        
+        batches = [remote_ids[ccc * 50:(ccc + 1) * 50] for ccc in xrange(10)]
+        batches = [x for x in batches if x]
+        
+        responses = yield [self.es_hits(the_input,
+                                        filtered_query({"query":{ "ids": { "values": xx_remote_ids } },
+                                                        "size": len(xx_remote_ids),
+                                                        "_source": source_projection(the_input),
+                                                        },
+                                                       filters,
+                                                       ),
+                                        error_name = 'ELASTICSEARCH_JSON_ERROR_REMOTE_IDS',
+                                        )
+                           for xx_remote_ids
+                           in batches
+                           ]
+        
+        remote_hits = [x for hits in responses for x in hits]
+        
+        log.debug('GOT_REMOTE_HITS', time() - t1, len(batches), len(remote_hits))
+
+        log.debug('GOT_REMOTE_HITS',len(remote_ids), '->', len(remote_hits), [x['_id'] for x in remote_hits[:10]])
+
+        ## Fix ordering...:
+
+        remote_hits = [x for x in remote_hits if x]
+        
+        tmp = {x['_id']:x for x in remote_hits}
+        r2 = []
+        for xx in remote_ids:
+            aa = tmp.get(xx)
+            if (aa is not False) and (aa is not None):
+                r2.append(aa)
+        remote_hits = r2
+        
+        for xx in remote_hits:
+            xx['_score'] = 10.0
+            xx['_source']['boosted'] = 1
+        
+        raise tornado.gen.Return(remote_hits)
+    
+    @tornado.gen.coroutine
+    def retrieve_xann_hits(self,
+                           the_input,
+                           verbose = False,
+                           filters = False,
+                           ):
+        """
+        Enrich for image content-based search, via the `xann` concept terms.
+        """
+        
+        #assert mc_crawlers.order_model_cache[0], 'BAD_DDD'
+
+        wd = self.order_model_cache['order_model']['worddict']
+
+        xann_any_good = False
+        the_q_text_2 = False
+        
+        for w in the_input['q_text'].split():
+            if w.startswith('xann'):
+                xann_any_good = True
+            if w in wd:
+                xann_any_good = True
+
+        if xann_any_good:
+            the_q_text_2 = relevance_ann_query_to_concepts(the_input['q_text'],
+                                                           the_order_model_cache = self.order_model_cache,
+                                                           )
+            
+            #the_q_text_2 = the_q_text_2.split() + [x for x in the_input['q_text'].split() if x.startswith('xann')]
+        
+        if not the_q_text_2:
+            raise tornado.gen.Return([])
+        
+        query2 = {"query": {"multi_match": {"query": the_q_text_2,
+                                           "fields": [ "xann" ],
+                                           "type":   "most_fields"
+                                           },
+                           },
+                  "size": 300,
+                  "_source": source_projection(the_input),
+                 }
+
+        t1 = time()
+        
+        xann_hits = yield self.es_hits(the_input, filtered_query(query2, filters))
+
+        for ii in xann_hits:
+            ii['_score'] *= 0.1
+
+        log.debug('XANN_GOT','time:',time() - t1, len(xann_hits))
+        
+        raise tornado.gen.Return(xann_hits)
+    
+    def on_finish(self):
+        """
+        Release searches that were waiting on this one.
+        """
+
+        BaseHandler.on_finish(self)
+        
+        key = getattr(self, 'inflight_key', False)
+        
+        if key:
+            if self.inflight_locked:
+                query_cache_unlock(key)
+            
+            ff = query_inflight.pop(key, None)
+            
+            if ff is not None:
+                ff.set_result(True)
     
     @tornado.gen.coroutine
     def post(self, verbose = False):
@@ -1164,21 +2064,33 @@ class handle_search(BaseHandler):
         the_query_seg = ''
         
         tt0 = time()
+
+        spans = self.spans
+
+        ## Shed load before doing any work:
+        
+        admitted = yield self.admit()
+        
+        if not admitted:
+            spans.endpoint = 'search_rejected'
+            return
         
         d = self.request.body
 
         if d.startswith('{'):
-            if verbose:
-                print ('OLD PARAMETERS FORMAT',d[:20])
+            log.debug('OLD PARAMETERS FORMAT',d[:20])
 
         else:
-            if verbose:
-                print ('NEW PARAMETERS FORMAT',)
+            log.debug('NEW PARAMETERS FORMAT',)
             d = self.get_argument('json','{}')            
         
         data = json.loads(d)
         
         is_debug_mode = intget(self.get_cookie('debug')) or intget(data.get('debug')) or intget(self.get_argument('debug','0'))
+
+        ## Background refresh of a stale cache entry, see `query_cache_refresh()`:
+        
+        is_cache_refresh = bool(self.request.headers.get('X-Cache-Refresh')) and (self.request.remote_ip in ['127.0.0.1', '::1'])
         
         if data.get('reconcile_task'):#data.get('rerank_eq', '').endswith('|RECONCILE_TASK'):
             
@@ -1193,7 +2105,7 @@ class handle_search(BaseHandler):
             #{'queryk':queryk, 'rating_type':rating_type, 'user_id':user_id}
             
             
-            print ('RECONCILE_TASK', ht)
+            log.debug('RECONCILE_TASK', ht)
             
             with open('/datasets/datasets/annotate/search_relevance_002/phase002_2-way.json') as f:
                 hr = json.loads(f.read())
@@ -1202,7 +2114,7 @@ class handle_search(BaseHandler):
 
             task_images = hr[ht['user_id']][ht['queryk']][ht['rating_type']]
 
-            print ('task_images',task_images)
+            log.debug('task_images',task_images)
             
             #{u'next_page': None, u'prev_page': None, u'query_info': {u'query_args': {u'doc_type': u'image', u'skip_query_cache': 0, u'allow_nsfw': 0, u'pretty': 1, u'q_text': u'donalds', u'rerank_eq': u'annotation_mode', u'index_name': u'getty_test', u'schema_variant': u'new', u'enrich_tags': 1, u'filter_incomplete': 0, u'include_thumb': False, u'canonical_id': 0, u'full_limit': 600, u'include_docs': 1, u'debug': 1, u'show_default_options': 1, u'q': u'donalds', u'token': [], u'filter_licenses': [u'Creative Commons'], u'filter_sources': u'ALL'}, u'query_elapsed_ms': 119, u'query_time': 1473322887}, u'results_count': u'RECONCILE: ITERATION 1', u'results': [{u'_source': {u'license': None, u'title': u'RECONCILE', u'sizes': {}, u'artist_name': None, u'source': None, u'image_url': None, u'keywords': []}, u'_score': -1.0, u'title': u'Previous: 1d37f4afa8124d2584957a7892dff48a=1, 7754d70c-9edc-4b30-9ae7-ca55508823a9=2', u'_previous_ratings': [[u'1d37f4afa8124d2584957a7892dff48a', 1], [u'7754d70c-9edc-4b30-9ae7-ca55508823a9', 2]], u'_id': u'f745d5493075b0d93ce1b25934a94cef', u'_has_conflict': False}, {u'_source': {u'license': None, u'title': u'RECONCILE', u'sizes': {}, u'artist_name': None, u'source': None, u'image_url': None, u'keywords': []}, u'_score': -1.0, u'title': u'Previous: 1d37f4afa8124d2584957a7892dff48a=1, 7754d70c-9edc-4b30-9ae7-ca55508823a9=3', u'_previous_ratings': [[u'1d37f4afa8124d2584957a7892dff48a', 1], [u'7754d70c-9edc-4b30-9ae7-ca55508823a9', 3]], u'_id': u'a076583d36107460cfd304a1728de6b1', u'_has_conflict': False}], u'default_options': [], u'reconcile_info': {u'min_voters': 2, u'queryk': u'{"q": "nba"}', u'set_key': u'2_1171821989289380032_Overall_1d37f4afa8124d2584957a7892dff48a', u'iteration': 1, u'rating_type': u'Overall'}, u'debug_options': []}
 
@@ -1249,8 +2161,7 @@ class handle_search(BaseHandler):
             
         if DO_FORWARDING:
             forward_url = mc_config.MC_DO_FORWARDING_URL
-            if verbose:
-                print ('FORWARDING', len(d), '->', forward_url,'headers:',dict(self.request.headers))
+            log.debug('FORWARDING', len(d), '->', forward_url,'headers:',dict(self.request.headers))
             response = yield AsyncHTTPClient().fetch(forward_url,
                                                      method = 'POST',
                                                      connect_timeout = 30,
@@ -1261,8 +2172,7 @@ class handle_search(BaseHandler):
                                                      )
             d2 = response.body
             h2 = json.loads(d2)
-            if verbose:
-                print ('FORWARDING_RECEIVED', len(d2))
+            log.debug('FORWARDING_RECEIVED', len(d2))
             #self.write(d2)
             #self.finish()
             self.write_json(h2)
@@ -1286,7 +2196,9 @@ class handle_search(BaseHandler):
         
         ###
 
-        if 'pingdom' not in self.request.headers.get("User-Agent",'').lower():
+        user_agent = self.request.headers.get("User-Agent",'').lower()
+        
+        if ('pingdom' not in user_agent) and ('mc_cache_warm' not in user_agent) and (not is_cache_refresh):
             
             ak = {'0_endpoint':'/search',
                   '1_query': data.get('q'),
@@ -1402,7 +2314,7 @@ class handle_search(BaseHandler):
         
         try:
             fileinfo = self.request.files['file'][0]
-            print ("FILE UPLOAD", fileinfo['filename'])
+            log.debug("FILE UPLOAD", fileinfo['filename'])
             q_id_file = fileinfo['body']
         except KeyboardInterrupt:
             raise
@@ -1419,6 +2331,19 @@ class handle_search(BaseHandler):
                              })
             return                
 
+        ## Treat `q_id` data URIs like uploads, so that both are cached by image content hash:
+        
+        if the_input['q_id'] and (the_input['q_id'].startswith(data_pat) or the_input['q_id'].startswith(data_pat_2)):
+            try:
+                q_id_file = the_input['q_id'][the_input['q_id'].index(',') + 1:].decode('base64')
+            except Exception as e:
+                self.write_json({'error':'PARAMS',
+                                 'error_message':'Bad q_id data URI - ' + repr(e),
+                                 })
+                return
+            the_input['q_id'] = None
+            the_input['q_id_file_hash'] = hashlib.md5(q_id_file).hexdigest()
+
 
         ## Remote ranking hints:
         
@@ -1428,8 +2353,7 @@ class handle_search(BaseHandler):
             if the_input['q_text'] and (get_remote_search is not False):
                 t1 = time()
                 remote_ids = get_remote_search(the_input['q_text'])
-                if verbose:
-                    print ('REMOTE_IDS','time:',time()-t1,len(remote_ids))
+                log.debug('REMOTE_IDS','time:',time()-t1,len(remote_ids))
 
         ## Neural reverse image search by image / text / id:
 
@@ -1508,8 +2432,7 @@ class handle_search(BaseHandler):
 
         query_args['debug'] = intget(self.get_cookie('debug')) or intget(data.get('debug')) or intget(self.get_argument('debug','0'))
 
-        if verbose:
-            print ('QUERY_ARGS',query_args)
+        log.debug('QUERY_ARGS',query_args)
         
         ## ignore those with default args:
         for k,v in query_args.items():
@@ -1519,8 +2442,14 @@ class handle_search(BaseHandler):
         
         if the_token:
             assert 'debug' in the_input,the_input
-            
-            rr = query_cache_lookup(the_token, skip_query_cache = the_input['skip_query_cache'])
+
+            with spans.span('cache_lookup'):
+                rr = query_cache_lookup(the_token,
+                                        stale_age = mc_config.MC_QUERY_CACHE_STALE_AGE_INT,
+                                        skip_query_cache = the_input['skip_query_cache'],
+                                        offset = the_input['offset'],
+                                        limit = the_input['limit'],
+                                        )
 
             if rr is False:
                 #self.set_status(500)
@@ -1530,26 +2459,72 @@ class handle_search(BaseHandler):
                 return                
 
         else:
-            the_token = consistent_json_hash(query_args)
+            ## `pretty` only changes formatting. It is hashed at its old default, so that existing cache keys stay valid:
+            
+            the_token = consistent_json_hash(dict(query_args, pretty = 1))
+            
+            if query_args.get('q') and (not q_id_file) and ('pingdom' not in user_agent) and ('mc_cache_warm' not in user_agent) and (not is_cache_refresh):
+                query_request_log_write(query_args)
+            
+            with spans.span('cache_lookup'):
+                rr = query_cache_lookup(the_token,
+                                        stale_age = mc_config.MC_QUERY_CACHE_STALE_AGE_INT,
+                                        skip_query_cache = the_input['skip_query_cache'] or is_cache_refresh,
+                                        allow_skip_query_cache = mc_config.MC_ALLOW_SKIP_QUERY_CACHE_INT or is_cache_refresh,
+                                        offset = the_input['offset'],
+                                        limit = the_input['limit'],
+                                        )
+
+            ## Serve stale entries immediately, and refresh them in the background. Uploads can't be
+            ## re-sent, so those are just served:
+            
+            if (rr is not False) and rr['cache_stale'] and (not q_id_file):
+                
+                refresh_headers = {k:self.request.headers[k]
+                                   for k in ['Cookie', 'User-Agent']
+                                   if k in self.request.headers
+                                   }
+                
+                tornado.ioloop.IOLoop.current().spawn_callback(query_cache_refresh,
+                                                               the_token,
+                                                               d,
+                                                               headers = refresh_headers,
+                                                               refresh_url = mc_config.MC_QUERY_CACHE_REFRESH_URL + \
+                                                                             (self.request.query and ('?' + self.request.query) or ''),
+                                                               )
+
+            ## Wait for identical in-progress searches, instead of repeating them. Not for uncached
+            ## match-all queries, or when explicitly skipping the cache:
             
-            rr = query_cache_lookup(the_token, skip_query_cache = the_input['skip_query_cache'])
+            if (rr is False) and \
+               (the_input['q_text'] or the_input['q_id'] or q_id_file or the_input['canonical_id']) and \
+               (not (the_input['skip_query_cache'] and mc_config.MC_ALLOW_SKIP_QUERY_CACHE_INT)):
+                
+                with spans.span('single_flight_wait'):
+                    rr = yield self.query_single_flight(the_token,
+                                                        offset = the_input['offset'],
+                                                        limit = the_input['limit'],
+                                                        )
 
             
         if rr is not False:
+
+            ## Cache hits get their own histograms:
+            
+            spans.endpoint = 'search_cached'
             
             # [u'query_info', u'results_count', u'results', 'cache_hit']
-            if verbose:
-                print ('QUERY_CACHE_LOOKUP', rr.keys())#['query_info']['query_args'])
+            log.debug('QUERY_CACHE_LOOKUP', rr.keys())#['query_info']['query_args'])
             #return
             #raw_input()
 
-            if verbose:
-                print ('CACHE_OR_TOKEN_HIT_QUERY','offset:', the_input['offset'], 'limit:', the_input['limit'], 'len(results)',len(rr['results']))
+            results_count = rr.pop('num_cached_results')
             
+            del rr['cache_stale']
             
-            results_count = len(rr['results'])
+            log.debug('CACHE_OR_TOKEN_HIT_QUERY','offset:', the_input['offset'], 'limit:', the_input['limit'], 'len(results)',results_count)
                                                 
-            if the_input['offset'] + the_input['limit'] >= len(rr['results']):
+            if the_input['offset'] + the_input['limit'] >= results_count:
                 rr['next_page'] = None
             else:
                 rr['next_page'] = {'token':the_token, 'pingback_token':the_token, 'offset':the_input['offset'] + the_input['limit'], 'limit':the_input['limit']}
@@ -1559,8 +2534,6 @@ class handle_search(BaseHandler):
             else:
                 rr['prev_page'] = {'token':the_token, 'pingback_token':the_token, 'offset':max(0, the_input['offset'] - the_input['limit']), 'limit':the_input['limit']}
 
-            rr['results'] = rr['results'][the_input['offset']:the_input['offset'] + the_input['limit']]
-
             if the_input['show_default_options']:
                 rr['default_options'] = default_options
             
@@ -1575,17 +2548,16 @@ class handle_search(BaseHandler):
             #assert (the_input['q_text'] or the_input['q_id'] or q_id_file or the_input['canonical_id']), ('NO QUERY?', the_input)
             #assert (rr['query_info']['query_args']['q_text'] or rr['query_info']['query_args']['q_id'] or q_id_file or rr['query_info']['query_args']['canonical_id']), ('NO QUERY?', rr['query_info']['query_args'])
 
-            if verbose:
-                print ('TOP_LEVEL_KEYS_1',rr.keys(), rr['query_info']['query_args'].get('q'))
-            self.write_json(rr,
-                            pretty = the_input['pretty'],
-                            max_indent_depth = data.get('max_indent_depth', False),
-                            )
+            log.debug('TOP_LEVEL_KEYS_1',rr.keys(), rr['query_info']['query_args'].get('q'))
+            yield self.write_json_streaming(rr,
+                                            pretty = the_input['pretty'],
+                                            max_indent_depth = data.get('max_indent_depth', False),
+                                            )
             
             return
 
         if verbose and rr:
-            print ('ZZZ',rr['query_info'])
+            log.debug('ZZZ',rr['query_info'])
         
             #assert (rr['query_info']['query_args']['q_text'] or rr['query_info']['query_args']['q_id'] or q_id_file or rr['query_info']['query_args']['canonical_id']), ('NO QUERY?', rr['query_info']['query_args'])
 
@@ -1597,7 +2569,10 @@ class handle_search(BaseHandler):
             
             rr = yield self.es.search(index = the_input['index_name'],
                                       type = the_input['doc_type'],
-                                      source = {"query": {"match_all": {}}, "size":20}
+                                      source = {"query": {"match_all": {}},
+                                                "size":20,
+                                                "_source": source_projection(the_input),
+                                                },
                                       )
 
             
@@ -1636,8 +2611,7 @@ class handle_search(BaseHandler):
 
             rr['query_info'] = {'query_args':query_args, 'query_time':int(tt0), 'query_elapsed_ms': int((time() - tt0) * 1000)}
 
-            if verbose:
-                print ('TOP_LEVEL_KEYS_2',rr.keys(), rr['query_info']['query_args'].get('q'))
+            log.debug('TOP_LEVEL_KEYS_2',rr.keys(), rr['query_info']['query_args'].get('q'))
             self.write_json(rr)
             return
 
@@ -1655,84 +2629,85 @@ class handle_search(BaseHandler):
             if the_input['canonical_id']:
                 ## Search by canonical_id:
 
-                if verbose:
-                    print ('CANONICAL_ID_SEARCH', the_input['canonical_id'])
+                log.debug('CANONICAL_ID_SEARCH', the_input['canonical_id'])
                 
                 query = {"query": {"constant_score": {"filter": {"term": {"canonical_id": the_input['canonical_id']}}}}}
             
-            elif q_id_file or (the_input['q_id'].startswith(data_pat) or the_input['q_id'].startswith(data_pat_2)):
+            elif q_id_file:
                 
                 #Resolve ID(s) for query based on content.
                 #Note that this is similar to `/dupe_lookup` with `include_docs` = True:
+
+                query = {}
                 
-                if True:
-                    if verbose:
-                        print ('NEURAL-CONTENT-BASED-SEARCH',)
+                if (reverse_image_lookup_index is not False) and (not mc_config.MC_LOCAL_IMAGE_SEARCH_INT):
+                    log.debug('NEURAL-CONTENT-BASED-SEARCH',)
 
-                    rr = reverse_image_lookup_index(q_image_bytes = q_id_file,
-                                                    #num_k = the_input['limit'],
-                                                    )
+                    with spans.span('image_lookup'):
+                        remote_ids = reverse_image_lookup_index(q_image_bytes = q_id_file,
+                                                                #num_k = the_input['limit'],
+                                                                )
                     
-                    #query = {"query":{ "ids": { "values": rr } } }
-                    query = {}
-                    remote_ids = rr
-                    
-                else:
-                    if verbose:
-                        print ('OLD-CONTENT-BASED-SEARCH',)
-                    
-                    model = mc_models.VECTORS_MODEL_NAMES['baseline']()
-
-                    if the_input['q_id'] and  (the_input['q_id'].startswith(data_pat) or the_input['q_id'].startswith(data_pat_2)):
-                        if verbose:
-                            print ('GOT_DATA_URI')
-                        terms = model.img_to_terms(img_data_uri = the_input['q_id'])
-                    else:
-                        if verbose:
-                            print ('GOT_RAW_BYTES')
-                        assert q_id_file
-                        terms = model.img_to_terms(img_bytes = q_id_file)
-
-                    if verbose:
-                        print ('TERMS',repr(terms)[:100])
-
-
-                    rr = yield self.es.search(index = the_input['index_name'],
-                                              type = the_input['doc_type'],
-                                              source = {"query": {"constant_score":{"filter":{"term": terms}}}},
-                                              )
-                    if verbose:
-                        print ('GOT_Q_ID_FILE_OR_Q_ID',repr(rr.body)[:100])
+                else:
+                    log.debug('LOCAL-CONTENT-BASED-SEARCH',)
 
+                    ## Decoding, hashing and lookup run on a thread pool. Results are cached by image content hash:
+                    
                     try:
-                        rr = json.loads(rr.body)
+                        hh = yield spans.track('image_lookup', self.local_image_search.search_async(q_id_file,
+                                                                                                   cache_key = the_input['q_id_file_hash'],
+                                                                                                   num = the_input['full_limit'],
+                                                                                                   ))
                     except Exception as e:
                         #self.set_status(500)
-                        self.write_json({'error':'ELASTICSEARCH_JSON_ERROR',
-                                         'error_message':'Elasticsearch down or timeout? - ' + repr(rr.body)[:1000],
+                        self.write_json({'error':'BAD_IMAGE',
+                                         'error_message':'Could not decode image - ' + repr(e)[:1000],
                                          })
                         return
 
+                    log.debug('LOCAL_IMAGE_SEARCH', hh['dedupe_hsh'], hh['ids'] is not False and len(hh['ids']))
 
-                    if 'error' in rr:
-                        #self.set_status(500)
-                        self.write_json({'error':'ELASTICSEARCH_ERROR',
-                                         'error_message':repr(rr)[:1000],
-                                         })
-                        return
+                    if hh['ids'] is not False:
+                        remote_ids = hh['ids']
+                    
+                    else:
+                        ## No local Hamming index, so only exact `dedupe_hsh` matches:
+                        
+                        rr = yield self.es.search(index = the_input['index_name'],
+                                                  type = the_input['doc_type'],
+                                                  source = {"query": {"constant_score":{"filter":{"term": {"dedupe_hsh": hh['dedupe_hsh']}}}},
+                                                            "_source": source_projection(the_input, 'dupe_terms'),
+                                                            "size": the_input['full_limit'],
+                                                            },
+                                                  )
+                        if log.enabled(DEBUG):
+                            log.debug('GOT_DEDUPE_HSH_HITS',repr(rr.body)[:100])
+
+                        try:
+                            rr = json.loads(rr.body)
+                        except Exception as e:
+                            #self.set_status(500)
+                            self.write_json({'error':'ELASTICSEARCH_JSON_ERROR',
+                                             'error_message':'Elasticsearch down or timeout? - ' + repr(rr.body)[:1000],
+                                             })
+                            return
 
 
-                    rr = [x['_id'] for x in rr['hits']['hits']]
+                        if 'error' in rr:
+                            #self.set_status(500)
+                            self.write_json({'error':'ELASTICSEARCH_ERROR',
+                                             'error_message':repr(rr)[:1000],
+                                             })
+                            return
 
-                    query = {"query":{ "ids": { "values": rr } } }
+                        remote_ids = [x['_id'] for x in rr['hits']['hits']]
                 
             else:
                 #ID-based search:
                 
                 is_id_search = True
 
-                if verbose:
-                    print ('ID-BASED-SEARCH', the_input['q_id'])
+                log.debug('ID-BASED-SEARCH', the_input['q_id'])
                 query = {"query":{ "ids": { "values": [ the_input['q_id'] ] } } }
         
         
@@ -1781,8 +2756,7 @@ class handle_search(BaseHandler):
             
             elif the_input['filter_sources'] and ('ALL' not in the_input['filter_sources']) and (not is_id_search) and (not neural_vectors_mode):
 
-                if verbose:
-                    print ('FILTER_SOURCES', the_input['filter_sources'])
+                log.debug('FILTER_SOURCES', the_input['filter_sources'])
                 
                 assert isinstance(the_input['filter_sources'], basestring)
 
@@ -1815,191 +2789,54 @@ class handle_search(BaseHandler):
 
                 #query["sort"] = [{"aesthetics.score" : {"order" : "desc"}}]
 
+        if isinstance(the_input['filter_licenses'], basestring):
+            the_input['filter_licenses'] = [the_input['filter_licenses']]
         
-        remote_hits = []
+        ## Blocklist, NSFW and license filtering, done by ES for all candidate sources:
         
-        #assert remote_ids,remote_ids
-        if remote_ids:
-            t1 = time()
-
-            rrr = []
-            remote_hits = []
-            
-            for ccc in xrange(10):
-
-                print ('LOOP_REMOTE_HITS', ccc)
-                
-                xx_remote_ids = remote_ids[ccc * 50:(ccc + 1) * 50]
-
-                if not xx_remote_ids:
-                    break
-                
-                rr = yield self.es.search(index = the_input['index_name'],
-                                          type = the_input['doc_type'],
-                                          source = {"query":{ "ids": { "values": xx_remote_ids } },
-                                                    "size": 50,
-                                                    },
-                                          )
-                #print ('GOT_REMOTE_HITS','time:',time() - t1,repr(rr.body)[:100])
-
-                hh = False
-
-                try:
-                    hh = json.loads(rr.body)
-                except KeyboardInterrupt:
-                    raise
-                except Exception as e:
-                    #print ('BAD_BODY',rr)
-                    #self.set_status(500)
-                    self.write_json({'error':'ELASTICSEARCH_JSON_ERROR_REMOTE_IDS',
-                                     'error_message':'Elasticsearch down or timeout? - remote_ids ' + repr(rr.body)[:1000],
-                                     })
-                    return
-
-                if 'error' in hh:
-                    #self.set_status(500)
-                    self.write_json({'error':'ELASTICSEARCH_ERROR',
-                                     'error_message':repr(hh)[:1000],
-                                     })
-                    return
-
-                print ('GOT_REMOTE_HITS', time() - t1, len(hh['hits']['hits']))
-
-                if hh['hits']['hits']:
-                    remote_hits.extend(hh['hits']['hits'])
-            
-
-            if verbose:
-                print ('GOT_REMOTE_HITS',len(remote_ids), '->', len(remote_hits), [x['_id'] for x in remote_hits[:10]])
-
-            ## Fix ordering...:
-
-            remote_hits = [x for x in remote_hits if x]
-            
-            #print ('REMOTE_IDS', remote_ids)
-            
-            tmp = {x['_id']:x for x in remote_hits}
-            r2 = []
-            for xx in remote_ids:
-                aa = tmp.get(xx)
-                if (aa is not False) and (aa is not None):
-                    r2.append(aa)
-            remote_hits = r2
-            
-            for xx in remote_hits:
-                #print ('RHIT', xx)
-                xx['_score'] = 10.0
-                xx['_source']['boosted'] = 1
-                
-            for xx in remote_hits:
-                assert xx['_source']['boosted'] == 1
-
-
-        xann_hits = []
+        filters = search_filters(the_input,
+                                 is_id_search = is_id_search,
+                                 filter_licenses = not (neural_vectors_mode or q_id_file),
+                                 )
+        
+        query = filtered_query(query, filters)
         
-        if DO_XANN and the_input['q_text'] and (not the_input['exclusive_to_text']):
-
-            ## enrich for image content-based search:
-
-            #assert mc_crawlers.order_model_cache[0], 'BAD_DDD'
-
-            wd = self.order_model_cache['order_model']['worddict']
-
-            xann_any_good = False
-            the_q_text_2 = False
-            
-            for w in the_input['q_text'].split():
-                if w.startswith('xann'):
-                    xann_any_good = True
-                if w in wd:
-                    xann_any_good = True
-            
-
-            if xann_any_good:
-                the_q_text_2 = relevance_ann_query_to_concepts(the_input['q_text'],
-                                                               the_order_model_cache = self.order_model_cache,
-                                                               )
-                
-                #the_q_text_2 = the_q_text_2.split() + [x for x in the_input['q_text'].split() if x.startswith('xann')]
-            
-            if the_q_text_2:
-                query2 = {"query": {"multi_match": {"query": the_q_text_2,
-                                                   "fields": [ "xann" ],
-                                                   "type":   "most_fields"
-                                                   },
-                                   },
-                          "size": 300,
-                         }
-
-
-                t1 = time()
-                rr = yield self.es.search(index = the_input['index_name'],
-                                          type = the_input['doc_type'],
-                                          source = query2,
-                                          )
-                
-                try:
-                    hh = json.loads(rr.body)
-                except KeyboardInterrupt:
-                    raise
-                except Exception as e:
-                    #self.set_status(500)
-                    self.write_json({'error':'ELASTICSEARCH_JSON_ERROR',
-                                     'error_message':'Elasticsearch down or timeout? - ' + repr(rr.body)[:1000],
-                                     })
-                    return
-                
-                xann_hits = hh['hits']['hits']
-
-                for ii in xann_hits:
-                    ii['_score'] *= 0.1
-
-                if verbose:
-                    print ('XANN_GOT','time:',time() - t1, repr(rr.body)[:100])
-                
-                
         query['from'] = the_input['offset']
         query['size'] = the_input['full_limit']
+        query['_source'] = source_projection(the_input)
         query['timeout'] = '5s'   ## TODO - RETURNS PARTIALLY ACCUMULATED HITS WHEN TIMEOUT OCCURS
 
-        if verbose:
-            print ('QUERY',query)
-
-        if neural_vectors_mode or q_id_file:
-            rr = []
-
-        else:
-            t1 = time()
-            rr = yield self.es.search(index = the_input['index_name'],
-                                      type = the_input['doc_type'],
-                                      source = query,
-                                      )
-
-            if verbose:
-                print ('GOT','time:',time() - t1, repr(rr.body)[:100])
-
-            hh = False
-
-            try:
-                hh = json.loads(rr.body)
-            except KeyboardInterrupt:
-                raise
-            except Exception as e:
-                #self.set_status(500)
-                self.write_json({'error':'ELASTICSEARCH_JSON_ERROR',
-                                 'error_message':'Elasticsearch down or timeout? - ' + repr(rr.body)[:1000],
-                                 })
-                return
-
-            if 'error' in hh:
-                #self.set_status(500)
-                self.write_json({'error':'ELASTICSEARCH_ERROR',
-                                 'error_message':repr(hh)[:1000],
-                                 })
-                return
+        log.debug('QUERY',query)
+        
+        ## Candidate retrieval. All sources run concurrently, and whatever arrives by each source's
+        ## deadline is merged:
 
-            rr = hh['hits']['hits']
-            
+        sources = {}
+        
+        if not (neural_vectors_mode or q_id_file):
+            sources['text'] = spans.track('es_query', self.es_hits(the_input, query))
+        
+        if remote_ids:
+            sources['remote'] = spans.track('remote_hydration', self.retrieve_remote_hits(the_input, remote_ids, verbose = verbose, filters = filters))
+        
+        if DO_XANN and the_input['q_text'] and (not the_input['exclusive_to_text']):
+            sources['xann'] = spans.track('xann_query', self.retrieve_xann_hits(the_input, verbose = verbose, filters = filters))
+        
+        try:
+            with spans.span('retrieval'):
+                hits, timed_out = yield gather_hits(sources)
+        except SearchBackendError as e:
+            #self.set_status(500)
+            self.write_json({'error':e.error,
+                             'error_message':e.error_message,
+                             })
+            return
+        
+        log.debug('GOT','time:',spans.spans['retrieval'] / 1000.0, {k:len(v) for k,v in hits.iteritems()})
+        
+        rr = hits.get('text', [])
+        remote_hits = hits.get('remote', [])
+        xann_hits = hits.get('xann', [])
             
         if neural_vectors_mode or q_id_file:
             rr = remote_hits
@@ -2010,34 +2847,11 @@ class handle_search(BaseHandler):
         
         #print ('HITS_A', len(rr))
         
-        ## NSFW filtering:
-
-        if (not is_id_search):# and (not neural_vectors_mode):
-            if not the_input['allow_nsfw']:
-
-                r2 = []
-                for xx in rr:
-                    if not xx['_source'].get('nsfw'):
-                        r2.append(xx)
-                rr = r2
-
-        #print ('HITS_B', len(rr))
-
-        
-        ## Prepend remote hits, filter ID dupes:
+        ## Prepend remote hits, filter ID dupes. NSFW and blocked IDs were already filtered by `search_filters()`:
 
         done = set()
         r2 = []
         for xx in rr:
-            if xx['_id'] in [u'pexels_85601',
-                             'feb4186c66cd5255e34ba2fdce5a386c',
-                             'f148a4e1c3a985871a3e529755d93202',
-                             '3aced17eabda5ac3afaf0e3e0cb7786e',
-                             'f0dda8781292b1e3f1ccbf764a9dee94',
-                             '1ab346ea9420f2bb62f0cae82bf9d32b',
-                             ]:
-                continue
-            
             if xx['_id'] in done:
                 continue
             done.add(xx['_id'])
@@ -2046,25 +2860,7 @@ class handle_search(BaseHandler):
 
         #print ('HITS_D', len(rr))
 
-        ## Remove inline thumbnail data URIs:
-        if not the_input['include_thumb']:
-            for x in rr:
-                if 'image_thumb' in x['_source']:
-                    del x['_source']['image_thumb']
-                if 'thumbnail_base64' in x['_source']:
-                    del x['_source']['thumbnail_base64']
-
-
-        ## Remove `dedupe_*` fields:
-
-        if False:
-            for xx in rr:
-                xx['_source']  = {x:y
-                                  for x,y
-                                  in xx['_source'].iteritems()
-                                  if not x.startswith('dedupe_')
-                                  }
-        
+        ## Inline thumbnails and `dedupe_*` fields were already dropped by `source_projection()`.
         
         ## Debug info:
         
@@ -2078,29 +2874,28 @@ class handle_search(BaseHandler):
             
                 ii['debug_info']['native_id'] = ii['_source'].get('native_id', False)                
                 ii['debug_info']['width'] = ii['_source'].get('sizes') and ii['_source'].get('sizes')[0].get('width', False)
-            if verbose:
-                print ('YES_DEBUG', is_debug_mode)
+            log.debug('YES_DEBUG', is_debug_mode)
         else:
-            if verbose:
-                print ('NO_DEBUG', is_debug_mode)
+            log.debug('NO_DEBUG', is_debug_mode)
                 
 
         ## Add in frontend image cached preview images:
         ## Skip items without preview:
 
-        from mc_ingest import lookup_cached_image
+        from mc_ingest import lookup_cached_images
         
         image_cache_failed = False
+
+        with spans.span('cached_images'):
+            all_urls = lookup_cached_images([ii['_id'] for ii in rr],
+                                            do_sizes = ['1024x1024',],
+                                            )
         
         r2 = []
-        for ii in rr:
+        for ii, urls in zip(rr, all_urls):
 
             ## From inline thumbnail:
             
-            urls = lookup_cached_image(_id = ii['_id'],
-                                       do_sizes = ['1024x1024',],
-                                       )
-            
             ii['_source']['url_direct_cache'] = {'url':urls['1024x1024']}
             
             ## Tag enrichment, using the image cache URLs:
@@ -2115,8 +2910,7 @@ class handle_search(BaseHandler):
                 except KeyboardInterrupt:
                     raise
                 except:
-                    if verbose:
-                        print ('ENRICH_TAGS_FAILED - API KEYS?',)
+                    log.debug('ENRICH_TAGS_FAILED - API KEYS?',)
                 
                 if not ii['_source'].get('keywords'):
                     ii['_source']['keywords'] = []
@@ -2137,7 +2931,11 @@ class handle_search(BaseHandler):
         
         ## Apply post-ingestion normalizers, if there are any:
                 
-        mc_normalize.apply_post_ingestion_normalizers(rr, schema_variant = the_input['schema_variant'])
+        with spans.span('normalize'):
+            yield self.executor.submit(mc_normalize.apply_post_ingestion_normalizers,
+                                       rr,
+                                       schema_variant = the_input['schema_variant'],
+                                       )
 
         frontend_required = [('artist_name',None),
                              ('keywords',[]),
@@ -2152,21 +2950,18 @@ class handle_search(BaseHandler):
         for ii in rr:
             for k,v in frontend_required:
                 if k not in ii['_source']:
-                    if verbose:
-                        print ('ADDED_FOR_FRONTEND',k,'=',v)
+                    log.debug('ADDED_FOR_FRONTEND',k,'=',v)
                     ii['_source'][k] = v
         
 
         ## Filter to only those exclusive to ann:
                     
         if the_input['exclusive_to_ann']:
-            if verbose:
-                print ('EXCLUSIVE_TO_ANN', len(rr))
+            log.debug('EXCLUSIVE_TO_ANN', len(rr))
             
             ann_tags = set(x.replace('xann','') for x in the_input['q_text'].split() if x.startswith('xann'))
 
-            if verbose:
-                print ('ANN_TAGS', ann_tags)
+            log.debug('ANN_TAGS', ann_tags)
             
             r2 = []
             for ii in rr:
@@ -2196,21 +2991,34 @@ class handle_search(BaseHandler):
             if (get_neural_relevance is not False) and the_input['q_text'] and (not neural_vectors_mode) and (not q_id_file): #is_debug_mode and
                 #assert mc_crawlers.order_model_cache[0], 'BAD_CCC'
                 xx = self.order_model_cache
-                neural_rel_scores, the_query_seg, score_at_1, score_at_10 = \
-                        get_neural_relevance(the_input['q_text'],
-                                             rr,
-                                             order_model = xx['order_model'],
-                                             )
+                
+                ff = neural_relevance_batcher.submit(the_input['q_text'],
+                                                     rr,
+                                                     order_model = xx['order_model'],
+                                                     )
+                
+                ## On failure or timeout, continue with the hits not scored for relevance:
+                
+                with spans.span('neural_relevance'):
+                    try:
+                        neural_rel_scores, the_query_seg, score_at_1, score_at_10 = \
+                                yield tornado.gen.with_timeout(timedelta(seconds = mc_config.MC_NEURAL_RELEVANCE_TIMEOUT_FLOAT),
+                                                               ff,
+                                                               )
+                    except Exception as e:
+                        log.warning('NEURAL_RELEVANCE_FAILED', repr(e))
+                        ff.add_done_callback(lambda ff: ff.exception())
                 
                 ## moved into get_neural_relevance:
-                for c, xx in enumerate(neural_rel_scores['result_scores']):
-                    #assert '_neural_rel_score' in rr[c], 'MISSING_KEY'
-                    #assert xx is not False, repr(xx)
-                    rr[c]['_neural_rel_score'] = xx
+                if neural_rel_scores is not False:
+                    for c, xx in enumerate(neural_rel_scores['result_scores']):
+                        #assert '_neural_rel_score' in rr[c], 'MISSING_KEY'
+                        #assert xx is not False, repr(xx)
+                        rr[c]['_neural_rel_score'] = xx
                 
         except Exception as e2:
             raise
-            print ('ERROR_NERUAL_RELEVANCE_OUTER',e2)
+            log.error('ERROR_NERUAL_RELEVANCE_OUTER',e2)
 
         ## Add xann to keywords:
 
@@ -2227,31 +3035,32 @@ class handle_search(BaseHandler):
             for ii in rr:
                 ii['_source']['artist_name_orig'] = ii['_source']['artist_name'] ## Back this up
 
-            rrm = ReRankingBasic(eq_name = the_input['rerank_eq'])
-            rr = rrm.rerank(q_text_orig, rr, is_debug_mode)
+            with spans.span('rerank'):
+                rrm = ReRankingBasic(eq_name = the_input['rerank_eq'])
+                rr = yield self.executor.submit(rrm.rerank, q_text_orig, rr, is_debug_mode)
 
 
         ## Diversity penalty:
 
         if (the_input['rerank_eq'] != 'annotation_mode') and (not is_id_search) and (not neural_vectors_mode) and (not q_id_file):
 
-            if verbose:
-                print ('------DIVERSITY_PENALTY',the_input['rerank_eq'])
+            log.debug('------DIVERSITY_PENALTY',the_input['rerank_eq'])
             
-            seen_artists = Counter()
-            r2 = []
-            for cc, ii in enumerate(rr):
-                xx = ii['_source']['artist_name_orig']
-                if xx in seen_artists:
-                    #print ('DIVERSITY_PENALTY', cc, xx)
-                    ii['_score'] *=  (0.0000001 ** seen_artists[xx])
-                if xx and ('simply mad' in xx.lower()):
-                    #print ('FOUND BAD',xx, ii['_score'])
-                    ii['_score'] *=  0.001
-                seen_artists[xx] += 1
-                r2.append((ii['_score'], ii))
-
-            rr = [y for x,y in sorted(r2, reverse = True)]
+            with spans.span('diversity_penalty'):
+                seen_artists = Counter()
+                r2 = []
+                for cc, ii in enumerate(rr):
+                    xx = ii['_source']['artist_name_orig']
+                    if xx in seen_artists:
+                        #print ('DIVERSITY_PENALTY', cc, xx)
+                        ii['_score'] *=  (0.0000001 ** seen_artists[xx])
+                    if xx and ('simply mad' in xx.lower()):
+                        #print ('FOUND BAD',xx, ii['_score'])
+                        ii['_score'] *=  0.001
+                    seen_artists[xx] += 1
+                    r2.append((ii['_score'], ii))
+
+                rr = [y for x,y in sorted(r2, reverse = True)]
                         
         ## Debug stats on frontend:
         
@@ -2336,22 +3145,15 @@ class handle_search(BaseHandler):
 
             ii['_source']['keywords'] = [x for x in ii['_source']['keywords'] if x.strip()]
                  
-        ## Note: swapping these for ES queries shortly:
-
-        if isinstance(the_input['filter_licenses'], basestring):
-            the_input['filter_licenses'] = [the_input['filter_licenses']]
         if isinstance(the_input['filter_sources'], basestring):
             the_input['filter_sources'] = [the_input['filter_sources']]
 
-        if verbose:
-            print ('filter_licenses_in',the_input['filter_licenses'])
+        log.debug('filter_licenses_in',the_input['filter_licenses'])
+        
+        ## License filtering was done by `search_filters()`. Only tag the open-licensed results here:
         
         if the_input['filter_licenses'] and ('ALL' not in the_input['filter_licenses']) and (not is_id_search) and (not neural_vectors_mode) and (not q_id_file):
-
-            dl = Counter()
             
-            filter_licenses_s = set(the_input['filter_licenses'])
-            r2 = []
             for ii in rr:
                 
                 native_id = ii['_source'].get('native_id', '')
@@ -2364,19 +3166,10 @@ class handle_search(BaseHandler):
                     ## The currently-ingested, except for these 2 datasets, should be all open-licensed:
                     if ('getty_' not in native_id) and ('eyeem_' not in native_id):
                         ii['_source']['license_tags'].append('Creative Commons') 
-                
-                ## ANY match:
-                if filter_licenses_s.intersection(ii['_source'].get('license_tags',[])):
-                    r2.append(ii)
-                else:
-                    dl[ii['_source']['source']['name']] += 1
-
-            if verbose:
-                print ('FILTER_LICENSES', the_input['filter_licenses'], len(rr),'->',len(r2), dl.most_common())
-            rr = r2
+            
+            log.debug('FILTER_LICENSES', the_input['filter_licenses'], len(rr))
 
-        if verbose:
-            print ('filter_sources_in',the_input['filter_sources'])
+        log.debug('filter_sources_in',the_input['filter_sources'])
 
         if False: #the_input['filter_sources'] and ('ALL' not in the_input['filter_sources']) and (not is_id_search):
             filter_sources_s = set(the_input['filter_sources'])
@@ -2384,8 +3177,7 @@ class handle_search(BaseHandler):
             for ii in rr:
                 if filter_sources_s.intersection(ii['_source'].get('source_tags',[])):
                     r2.append(ii)
-            if verbose:
-                print ('FILTER_SOURCES', the_input['filter_sources'], len(rr),'->',len(r2))
+            log.debug('FILTER_SOURCES', the_input['filter_sources'], len(rr),'->',len(r2))
             rr = r2
         
         
@@ -2423,8 +3215,7 @@ class handle_search(BaseHandler):
             rct += the_query_seg
 
 
-        if verbose:
-            print ('HITS_G', len(rr))
+        log.debug('HITS_G', len(rr))
         
         rr = {'results':rr,
               'results_count':rct,
@@ -2436,11 +3227,19 @@ class handle_search(BaseHandler):
 
         if the_input['q_text']:
             xx = self.order_model_cache
-            rr['query_suggestions'] = query_correct(the_input['q_text'], xx['order_model'])
+            with spans.span('query_correct'):
+                rr['query_suggestions'] = query_correct(the_input['q_text'], xx['order_model'])
         else:
             rr['query_suggestions'] = []
+
+        ## Results missing a timed-out source are only cached briefly, so that they aren't served for
+        ## the full cache lifetime, while still covering pagination and identical concurrent searches:
         
-        query_cache_save(the_token, rr)
+        with spans.span('cache_save'):
+            query_cache_save(the_token,
+                             rr,
+                             max_age = timed_out and mc_config.MC_QUERY_CACHE_PARTIAL_AGE_INT or None,
+                             )
         
         ## Wrap in pagination:
         
@@ -2471,26 +3270,15 @@ class handle_search(BaseHandler):
 
         #rr['query_info'] = {'query_args':query_args, 'query_time':int(tt0), 'query_elapsed_ms': int((time() - tt0) * 1000)}
 
-        if verbose:
-            print ('TOP_LEVEL_KEYS_3',rr.keys(), rr['query_info']['query_args'].get('q'))
-        self.write_json(rr,
-                        pretty = the_input['pretty'],
-                        max_indent_depth = data.get('max_indent_depth', False),
-                        )
+        log.debug('TOP_LEVEL_KEYS_3',rr.keys(), rr['query_info']['query_args'].get('q'))
+        yield self.write_json_streaming(rr,
+                                        pretty = the_input['pretty'],
+                                        max_indent_depth = data.get('max_indent_depth', False),
+                                        )
 
 
 from random import uniform, randint, choice, random, shuffle
 
-def weighted_choice(choices, total):
-    while True:
-        r = uniform(0, total)
-        cur = 0
-        for w, val in choices:
-            if cur + w >= r:
-                return val
-            cur += w
-   
-
 class handle_random_query(BaseHandler):
     
     #disable XSRF checking for this URL:
@@ -2505,6 +3293,7 @@ class handle_random_query(BaseHandler):
         Query Args:
             as_url:      Redirect to a URL instead of returning JSON, if "1".
             only_mwe:    Only multi-word queries, if "1",
+            weighted:    Choose queries in proportion to their typeahead weight if "1", otherwise uniformly.
             user_id:     User id for reconciliation mode.
         """
 
@@ -2593,7 +3382,7 @@ class handle_random_query(BaseHandler):
                         return
                     
         
-        if not exists(mc_config.MC_TYPEAHEAD_TSV_PATH):
+        if not (exists(mc_config.MC_TYPEAHEAD_INDEX_PATH) or exists(mc_config.MC_TYPEAHEAD_TSV_PATH)):
             #self.set_status(500)
             self.write_json({'error':'TSV_FILE_NOT_FOUND',
                              'error_message':'Please correct MC_TYPEAHEAD_TSV_PATH: ' + repr(mc_config.MC_TYPEAHEAD_TSV_PATH),
@@ -2608,19 +3397,11 @@ class handle_random_query(BaseHandler):
             q = choice(['technology', 'design', 'social media', 'privacy', 'bitcoin', 'internet of things', 'self driving cars', 'movies', 'television', 'music', 'gaming', 'politics', 'government', '2016 election', 'business', 'finance', 'economics', 'investing', 'creativity', 'ideas', 'humor', 'future', 'inspiration', 'travel', 'photography', 'architecture', 'art', 'climate change', 'transportation', 'sustainability', 'energy', 'health', 'mental health', 'psychology', 'science', 'education', 'history', 'space', 'virtual reality', 'artificial intelligence', 'feminism', 'women in tech', 'sports', 'nba', 'nfl', 'life lessons', 'productivity', 'self improvement', 'parenting', 'advice', 'startup', 'venture capital', 'entrepreneurship', 'leadership', 'culture', 'fashion', 'life', 'reading', 'relationships', 'this happened to me', 'diversity', 'racism', 'lgbtq', 'blacklivesmatter', 'fiction', 'books', 'poetry', 'satire', 'short story', 'food', 'future of food', 'cooking', 'writing', 'innovation', 'journalism'])
 
         else:
-            if intget(self.get_argument('only_mwe', 1)):
-                print ('YES_MWE')
-                aa, bb = self.rand_typeahead_mwe, self.rand_typeahead_mwe_total
-            else:
-                print ('NO_MWE')
-                aa, bb = self.rand_typeahead, self.rand_typeahead_total
-
-            if False:#choice([0, 0, 0, 0, 0, 1]):
-                ## Sometimes weighted:
-                q = weighted_choice(aa, bb)
-            else:
-                ## Sometimes totally random:
-                q = choice(aa)[1]
+            bb = intget(self.get_argument('only_mwe', 1))
+            
+            q = self.typeahead_index.sample(only_mwe = bb,
+                                            weighted = intget(self.get_argument('weighted', 1)),
+                                            )
         
         print ('random_query', q, bb)
         
@@ -2633,6 +3414,39 @@ class handle_random_query(BaseHandler):
                              })
         
         
+class handle_typeahead(BaseHandler):
+    
+    #disable XSRF checking for this URL:
+    def check_xsrf_cookie(self): 
+        pass
+    
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Highest-weighted query completions for a prefix.
+
+        Query Args:
+            q:     Query prefix.
+            limit: Maximum number of completions.
+        """
+        
+        q = self.get_argument('q', '')
+        limit = min(max(intget(self.get_argument('limit', 10)) or 10, 1), 100)
+        
+        if not (exists(mc_config.MC_TYPEAHEAD_INDEX_PATH) or exists(mc_config.MC_TYPEAHEAD_TSV_PATH)):
+            #self.set_status(500)
+            self.write_json({'error':'TSV_FILE_NOT_FOUND',
+                             'error_message':'Please correct MC_TYPEAHEAD_INDEX_PATH: ' + repr(mc_config.MC_TYPEAHEAD_INDEX_PATH),
+                             })
+            return
+        
+        rr = self.typeahead_index.complete(q, num = limit) if q.strip() else []
+        
+        self.write_json({'q':q,
+                         'results':[{'q':query, 'weight':weight} for weight, query in rr],
+                         })
+
+
 from uuid import uuid4
 
 def annotation_create_phase_2_tasks(via_cli = False):
@@ -2660,14 +3474,7 @@ class handle_record_relevance(BaseHandler):
         """
         
         ## TODO: Switch to real auth system:
-                
-        dir_out = join(mc_config.MC_ANNOTATE_DIR,
-                       'search_relevance',
-                       )
         
-        if not exists(dir_out):
-            makedirs(dir_out)
-            
         d = self.request.body
         hh = json.loads(d)
         
@@ -2680,7 +3487,7 @@ class handle_record_relevance(BaseHandler):
                              })
             return
         
-        print ('RECORD_RELEVANCE', hh)
+        log.debug('RECORD_RELEVANCE', hh)
 
         #assert hh['query_info']['query_args'].get('q'), ('NO_QUERY?',hh['query_info']['query_args'].keys())
         
@@ -2708,11 +3515,9 @@ class handle_record_relevance(BaseHandler):
                              })
             return
 
-        fn_out = join(dir_out,
-                      user_id + '_' + nonce + '.json',
-                      )
-
-        if exists(fn_out):
+        ## The nonce is claimed first, so concurrent double submits can't both be written, and released if the write fails:
+        
+        if not self.annotation_log.add_nonce(nonce_key(user_id, nonce)):
             #self.set_status(500)
             self.write_json({'error':'NONCE_USED',
                              'message':'Already recorded a response under provided nonce. Accidental double submit?',
@@ -2728,17 +3533,147 @@ class handle_record_relevance(BaseHandler):
               'headers':dict(self.request.headers),
               }
                 
-        with open(fn_out, 'w') as f:
-            f.write(json.dumps(rh))
+        try:
+            segment_name, offset = yield self.annotation_log.append(rh)
+        except Exception as e:
+            self.annotation_log.remove_nonce(nonce_key(user_id, nonce))
+            log.error('RECORD_RELEVANCE_FAILED', user_id, nonce, repr(e))
+            #self.set_status(500)
+            self.write_json({'error':'WRITE_FAILED',
+                             'message':'Could not record the response. Please retry.',
+                             })
+            return
         
-        print ('WROTE', fn_out, rh)
+        log.info('WROTE', segment_name, offset, user_id)
         
         self.write_json({'success':True,
-                         'fn':fn_out,
+                         'segment':segment_name,
+                         'offset':offset,
                          'message':'Success.'
                          })
 
 
+def warm_query_cache(num_typeahead = 500,
+                     num_recent = 500,
+                     recent_hours = 24,
+                     num_threads = 4,
+                     search_url = mc_config.MC_QUERY_CACHE_REFRESH_URL,
+                     log_dir = query_request_log_dir,
+                     keep_hours = 24 * 7,
+                     via_cli = False,
+                     ):
+    """
+    Pre-compute the query cache for the most common searches.
+    
+    Queries are taken from the highest-weighted typeahead queries in `MC_TYPEAHEAD_TSV_PATH`, and from
+    the most requested queries of the last `recent_hours`, as recorded by `query_request_log_write()`.
+    Searches that are already cached are cheap hits, and stale ones are refreshed in the background by
+    the server. Request logs older than `keep_hours` are deleted.
+    
+    Run periodically, e.g. from cron.
+    """
+    
+    import heapq
+    import requests
+    from multiprocessing.pool import ThreadPool
+    
+    option_names = set([x['name'] for x in default_options + debug_options])
+    
+    todo = []
+    
+    ## Top typeahead queries:
+    
+    if exists(mc_config.MC_TYPEAHEAD_TSV_PATH):
+        
+        rr = []
+        with open(mc_config.MC_TYPEAHEAD_TSV_PATH) as f:
+            for line in f:
+                try:
+                    score, query, _ = line.split('\t')
+                    rr.append((int(score), query))
+                except ValueError:
+                    continue
+        
+        for score, query in heapq.nlargest(num_typeahead, rr):
+            args = mc_config.MC_QUERY_CACHE_WARM_ARGS_JSON.copy()
+            args['q'] = query
+            todo.append(args)
+        
+        print ('WARM_TYPEAHEAD', len(todo))
+    
+    ## Most requested recent queries, replaying their original arguments:
+    
+    recent = Counter()
+    
+    t0 = time()
+    
+    hour = int(t0) // 3600
+    
+    for fn in (exists(log_dir) and listdir(log_dir) or []):
+        
+        if not fn.endswith('.log'):
+            continue
+        
+        try:
+            fn_hour = int(fn.split('_')[0])
+        except ValueError:
+            continue
+        
+        if hour - fn_hour >= keep_hours:
+            try:
+                unlink(join(log_dir, fn))
+            except OSError:
+                pass
+            continue
+        
+        if hour - fn_hour >= recent_hours:
+            continue
+        
+        with open(join(log_dir, fn)) as f:
+            for line in f:
+                try:
+                    query_args = ujson.loads(line)
+                except ValueError:
+                    ## Partially written:
+                    continue
+                
+                if not query_args.get('q'):
+                    continue
+                
+                args = {k:v for k,v in query_args.iteritems() if (k in option_names) and (v is not None)}
+                
+                recent[json.dumps(args, sort_keys = True)] += 1
+    
+    done = set([json.dumps(x, sort_keys = True) for x in todo])
+    
+    for args_s, count in recent.most_common(num_recent):
+        if args_s not in done:
+            todo.append(json.loads(args_s))
+    
+    print ('WARM_TOTAL', len(todo))
+    
+    def do_warm(args):
+        try:
+            r = requests.post(search_url,
+                              headers = {'User-Agent':'MC_CACHE_WARM 1.0'},
+                              json = args,
+                              timeout = 60,
+                              )
+            return r.status_code
+        except requests.exceptions.RequestException as e:
+            return repr(e)
+    
+    pool = ThreadPool(num_threads)
+    
+    for c, (args, status) in enumerate(zip(todo, pool.imap(do_warm, todo))):
+        if c % 100 == 0:
+            print ('WARMED', c, len(todo), args.get('q'), status)
+    
+    print ('DONE_WARM', len(todo), 'time:', time() - t0)
+
+
+import gc
+
 def web(port = 23456,
         via_cli = False,
         ):
@@ -2750,12 +3685,30 @@ def web(port = 23456,
     
     try:
         tornado.options.parse_command_line()
-        http_server = HTTPServer(Application(),
+        
+        app = Application()
+
+        if mc_config.MC_PRELOAD_MODELS_INT:
+            
+            ## Load models before forking, so the pages are shared between workers:
+            
+            app.warm_models()
+            
+            gc.collect()
+        
+        http_server = HTTPServer(app,
                                  xheaders=True,
                                  )
         http_server.bind(port)
         http_server.start(16) # Forks multiple sub-processes
         tornado.ioloop.IOLoop.instance().set_blocking_log_threshold(0.5)
+
+        app.metrics = Metrics()
+        IOLoopLagMonitor(app.metrics).start()
+
+        if not app.models_ready:
+            IOLoop.instance().add_callback(app.warm_models)
+        
         IOLoop.instance().start()
         
     except KeyboardInterrupt:
@@ -2765,6 +3718,9 @@ def web(port = 23456,
 
 
 functions=['web',
+           'warm_query_cache',
+           'annotation_log_import',
+           'image_index_build',
            ]
 
 def main():    
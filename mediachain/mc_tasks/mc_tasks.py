@@ -35,6 +35,21 @@ from random import random
 
 ####
 
+## Progress lines from per-record loops are printed at most once per `PROGRESS_INTERVAL` seconds. This script
+## runs standalone on task workers, so it doesn't use `mediachain.indexer.mc_log`:
+
+PROGRESS_INTERVAL = 5.0
+
+progress_times = {}
+
+def print_progress(key, *args):
+    tm = time()
+    if tm - progress_times.get(key, 0) < PROGRESS_INTERVAL:
+        return
+    progress_times[key] = tm
+    print ((key,) + args)
+
+
 def walk_files(dd, max_num = 0):
     """
     Simpler walking of all files under a directory.
@@ -283,10 +298,10 @@ def iter_compactsplit(fn_in_glob,
             
             tot_c += len(batch)
             
-            print ('iter_compactsplit', 'tot_c', tot_c, 'nn', nn, 'max_num', max_num,
-                   'c_per_sec: %.2f' % (tot_c / (time() - t0)),
-                   'nn_per_sec: %.2f' % (nn / (time() - t0)),
-                   )
+            print_progress('iter_compactsplit', 'tot_c', tot_c, 'nn', nn, 'max_num', max_num,
+                           'c_per_sec: %.2f' % (tot_c / (time() - t0)),
+                           'nn_per_sec: %.2f' % (nn / (time() - t0)),
+                           )
             
             if max_num and (nn >= max_num):
                 break
@@ -562,11 +577,11 @@ def iter_es(task_id = False,
                 #print ('RECREC',rec)
 
                 if c % 100 == 0:
-                    print ('iter_es', task_id, field_name,
-                           'c', c, 'nn', nn, 'max_num', max_num,
-                           'c_per_sec: %.2f' % (c / (time() - t0)),
-                           'nn_per_sec: %.2f' % (nn / (time() - t0)),
-                           )
+                    print_progress('iter_es', task_id, field_name,
+                                   'c', c, 'nn', nn, 'max_num', max_num,
+                                   'c_per_sec: %.2f' % (c / (time() - t0)),
+                                   'nn_per_sec: %.2f' % (nn / (time() - t0)),
+                                   )
 
                 assert skip_callback
                 
@@ -575,7 +590,7 @@ def iter_es(task_id = False,
                     sk = skip_callback(rec['_source']['native_id'])
                     if sk is False:
 
-                        print ('SKIP_2', rec['_source']['native_id'])
+                        print_progress('SKIP_2', rec['_source']['native_id'])
                         
                         ## todo re-add fastforward
 
@@ -681,14 +696,23 @@ def image_worker_es(rec):
     
     fn_cache = dr2 + _id + '.jpg'
     
-    try:
-        with open(fn_cache) as f:
-            image_bytes = f.read()    
-    except IOError as e:
-        if e.errno != errno.ENOENT:
-            raise
-        print ('NOT_FOUND_image_worker_es',fn_cache)
-        return False
+    from mediachain.indexer import mc_config
+    
+    image_bytes = None
+    
+    if mc_config.MC_IMAGE_STORE_INT:
+        from mediachain.indexer.mc_image_store import image_store
+        image_bytes = image_store().get('1024x1024/' + _id)
+    
+    if image_bytes is None:
+        try:
+            with open(fn_cache) as f:
+                image_bytes = f.read()    
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            print ('NOT_FOUND_image_worker_es',fn_cache)
+            return False
 
     t3 = time()
     #print ('image_worker_es_AA',time() - t3)